@@ -0,0 +1,96 @@
+"""Sharing by reference.
+
+A shared reminder or note is stored once, by its owner. Who else may see
+it is recorded in the ``acl`` collection, one entry per (item, principal)::
+
+    {'id': 'reminder:<item id>:<email>', 'item': 'reminder:<item id>',
+     'item_type': 'reminder', 'item_id': '...', 'principal': 'a@b.no',
+     'role': 'editor', 'owner': 'owner@b.no', 'granted_by': '...', 'created': '...'}
+
+The collection is indexed on ``item`` (who can see this?) and on
+``principal`` (what is shared with me?), so both questions are index
+lookups. Sharing with many people is one ``upsert_many``, i.e. one
+journal append. Edits and completions are made to the one record, so
+everybody sees them.
+
+The owner has no entry; ``role`` returns 'owner' for them. ``owner`` is
+kept on every entry because reminders are sharded by owner and can only
+be fetched with it.
+"""
+from datetime import datetime
+
+COLLECTION = 'acl'
+# Weakest first
+ROLES = ('viewer', 'editor', 'owner')
+ITEM_COLLECTIONS = {'reminder': 'reminders', 'note': 'shared_notes'}
+
+
+def item_key(item_type, item_id):
+    return f'{item_type}:{item_id}'
+
+
+def entry_id(item_type, item_id, principal):
+    return f'{item_type}:{item_id}:{principal.strip().lower()}'
+
+
+class AccessList:
+    def __init__(self, dm):
+        self.dm = dm
+
+    def grant(self, item_type, item_id, principals, role='editor', owner=None, granted_by=None):
+        """Give principals role on an item (one write). Returns the new entries."""
+        now = datetime.now().isoformat()
+        entries = []
+        for principal in dict.fromkeys(p.strip().lower() for p in principals if p and p.strip()):
+            if principal == (owner or '').lower():
+                continue
+            entries.append({
+                'id': entry_id(item_type, item_id, principal),
+                'item': item_key(item_type, item_id),
+                'item_type': item_type,
+                'item_id': item_id,
+                'principal': principal,
+                'role': role,
+                'owner': owner,
+                'granted_by': granted_by or owner,
+                'created': now,
+            })
+        if entries:
+            self.dm.upsert_many(COLLECTION, entries)
+        return entries
+
+    def revoke(self, item_type, item_id, principal):
+        return self.dm.delete(COLLECTION, entry_id(item_type, item_id, principal))
+
+    def revoke_all(self, item_type, item_id):
+        """Drop every entry of an item (when it is deleted)."""
+        for entry in self.entries(item_type, item_id):
+            self.dm.delete(COLLECTION, entry['id'])
+
+    def entries(self, item_type, item_id):
+        """Who an item is shared with. Do not modify the result."""
+        return self.dm.find(COLLECTION, 'item', item_key(item_type, item_id))
+
+    def principals(self, item_type, item_id):
+        return [entry['principal'] for entry in self.entries(item_type, item_id)]
+
+    def shared_with(self, principal, item_type=None):
+        """Entries of the items shared with principal. Do not modify the result."""
+        found = self.dm.find(COLLECTION, 'principal', principal.strip().lower())
+        return [e for e in found if item_type is None or e['item_type'] == item_type]
+
+    def entry(self, item_type, item_id, principal):
+        return self.dm.get_record(COLLECTION, entry_id(item_type, item_id, principal))
+
+    def role(self, item_type, item_id, principal, owner=None):
+        """principal's role on the item, or None without access."""
+        if not principal:
+            return None
+        if owner is not None and principal.lower() == owner.lower():
+            return 'owner'
+        entry = self.entry(item_type, item_id, principal)
+        return entry['role'] if entry else None
+
+    def can(self, item_type, item_id, principal, role='viewer', owner=None):
+        granted = self.role(item_type, item_id, principal, owner)
+        return granted is not None and ROLES.index(granted) >= ROLES.index(role)
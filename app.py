@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, g, has_app_context, Response
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user, UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
@@ -7,7 +7,8 @@ from wtforms import (
     StringField, PasswordField, SubmitField, TextAreaField,
     DateField, TimeField, SelectField
 )
-from wtforms.validators import DataRequired, Email, Length
+from wtforms.validators import DataRequired, Email, Length, Optional
+import hashlib
 import json
 import os
 import uuid
@@ -17,9 +18,22 @@ import random
 import string
 from flask_mail import Message, Mail
 from flask_wtf.csrf import CSRFProtect
-from apscheduler.schedulers.background import BackgroundScheduler
-import psutil  # For memory usage tracking
 import re  # For email validation
+import smtplib
+import time
+from storage import DataManager
+from database import ConnectionPool, DB_PATH
+from database_upgrade import run_migrations
+from dispatcher import SQL_SOURCE
+import recurrence
+import timekeys
+import changes
+import collab
+import note_messages
+from usercache import UserCache
+from acl import AccessList, ITEM_COLLECTIONS
+from events import EventBroker, Slots, format_sse, RESET, RETRY_MILLISECONDS
+from outbox import enqueue as enqueue_email, requeue_dead, outbox_stats, PRIORITY_BULK, PRIORITY_TRANSACTIONAL
 
 # Set up logger
 logger = logging.getLogger(__name__)
@@ -39,11 +53,35 @@ class Config:
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS', 'true').lower() in ['true', 'on', '1']
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    # How long a dispatch partition owns a reminder it is notifying
+    NOTIFICATION_CLAIM_SECONDS = int(os.environ.get('NOTIFICATION_CLAIM_SECONDS', 120))
+    # Outbox senders reconnect after this many messages on one SMTP connection
+    MAIL_MESSAGES_PER_CONNECTION = int(os.environ.get('MAIL_MESSAGES_PER_CONNECTION', 100))
     NOTIFICATION_ADVANCE_MINUTES = int(os.environ.get('NOTIFICATION_ADVANCE_MINUTES', 30))
+    # Reminders due within this many minutes of each other go out as one digest
+    DIGEST_WINDOW_MINUTES = int(os.environ.get('DIGEST_WINDOW_MINUTES', 5))
+    DIGEST_WINDOW_MINUTES_GENTLE = int(os.environ.get('DIGEST_WINDOW_MINUTES_GENTLE', 60))
+    # 'monolithic' (data/<type>.json) or 'sharded' (data/users/<user>/<type>.json)
+    DATA_LAYOUT = os.environ.get('DATA_LAYOUT', 'monolithic')
+    # Report User.get/get_by_email calls and loads per request (X-User-Lookups header and log)
+    USER_LOOKUP_DEBUG = os.environ.get('USER_LOOKUP_DEBUG', 'false').lower() in ['true', 'on', '1']
+    # Loaded users are kept between requests (see usercache.py)
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1000))
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 300))
+    # Signal invalidations to the other web processes through the data dir
+    USER_CACHE_SIGNAL = os.environ.get('USER_CACHE_SIGNAL', 'true').lower() in ['true', 'on', '1']
+    # Threads per web process (gunicorn --threads); open streams and long-polls
+    # may only take a share of them so ordinary requests are still served
+    WEB_THREADS = int(os.environ.get('WEB_THREADS', 32))
+    STREAM_MAX_CONNECTIONS = int(os.environ.get('STREAM_MAX_CONNECTIONS', max(1, WEB_THREADS // 4)))
+    LIVE_POLL_MAX_CONNECTIONS = int(os.environ.get('LIVE_POLL_MAX_CONNECTIONS', max(1, WEB_THREADS // 4)))
 
 # Apply configuration
 app.config.from_object(Config)
 
+# Profiles that prefer fewer, bundled notifications
+GENTLE_PROFILES = ('minimal', 'gentle')
+
 # Initialize extensions
 mail = Mail(app)
 login_manager = LoginManager()
@@ -57,79 +95,253 @@ if not app.secret_key:
     app.secret_key = app.config['SECRET_KEY']
 
 
-# Update the get_db_connection function with better error handling
+# SQLite connections come from a per-process pool (see database.py). Inside a
+# request or app context the same connection is reused via flask.g and only
+# handed back to the pool on teardown.
+db_pool = ConnectionPool(DB_PATH)
+
 def get_db_connection():
     """Get a SQLite database connection with proper error handling"""
     try:
-        conn = sqlite3.connect('smartreminder.db')
-        conn.row_factory = sqlite3.Row
-        return conn
+        if has_app_context():
+            conn = g.get('db_conn')
+            if conn is not None:
+                db_pool.record_shared()
+                return conn
+            conn = g.db_conn = db_pool.acquire()
+            return conn
+        return db_pool.acquire()
     except sqlite3.Error as e:
         logger.error(f"Database connection error: {e}")
         return None
 
 def return_db_connection(conn):
+    """Give a connection back to the pool (request-scoped ones on teardown)"""
     try:
-        if conn:
-            conn.close()
+        if not conn:
+            return
+        if has_app_context() and g.get('db_conn') is conn:
+            return
+        db_pool.release(conn)
     except Exception as e:
-        logger.error(f"Error closing database connection: {e}")
+        logger.error(f"Error returning database connection: {e}")
+
+@app.teardown_appcontext
+def release_request_db_connection(exc):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        db_pool.release(conn)
+
+# Data manager for fallback to JSON (journaled, see storage.py)
+dm = DataManager(
+    indexes={
+        'users': ('email',),
+        'reminders': ('user_id',),
+        'shared_reminders': ('shared_with',),
+        'shared_notes': ('user_id', 'access_code'),
+        'acl': ('item', 'principal'),
+    },
+    layout=app.config['DATA_LAYOUT'],
+    shards={
+        'reminders': {'key': 'user_id'},
+        'shared_reminders': {'key': 'shared_with'},
+        'shared_notes': {'key': 'user_id', 'cross_index': ('access_code',)},
+    },
+)
 
-# Data manager for fallback to JSON
-class DataManager:
-    def load_data(self, data_type):
-        try:
-            with open(f'data/{data_type}.json', 'r') as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            if data_type == 'users':
-                return {}
-            return []
-            
-    def save_data(self, data_type, data):
-        try:
-            os.makedirs('data', exist_ok=True)
-            with open(f'data/{data_type}.json', 'w') as f:
-                json.dump(data, f, indent=2)
-            return True
-        except Exception as e:
-            logger.error(f"Error saving data: {e}")
-            return False
+# Deling: én post per påminnelse/notat, og hvem som har tilgang i 'acl' (se acl.py)
+acl = AccessList(dm)
 
-dm = DataManager()
+# Endringslogg for /api/sync: hvem som ser en post i hver samling (se changes.py).
+# shared_reminders er de gamle kopiene per mottaker; bare slettingene fra
+# migrate-sharing havner der
+SYNC_AUDIENCES = {
+    'reminders': lambda r: reminder_audience(r),
+    'shared_reminders': lambda r: [r.get('shared_with')],
+    'shared_notes': lambda n: note_audience(n),
+}
+
+def log_changes(data_type, written):
+    """DataManager.on_write-krok: før skrivingene inn i change_log"""
+    conn = get_db_connection()
+    if not conn:
+        return
+    try:
+        changes.record_changes(conn, data_type, written, SYNC_AUDIENCES[data_type])
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Kunne ikke logge endringer i {data_type} for synkronisering: {e}")
+    finally:
+        return_db_connection(conn)
+
+def log_acl_changes(data_type, written):
+    """DataManager.on_write-krok for 'acl': den som får eller mister tilgang
+    får posten selv (eller en sletting) i change_log"""
+    conn = get_db_connection()
+    if not conn:
+        return
+    try:
+        for _, old, new in written:
+            entry = new or old
+            collection = ITEM_COLLECTIONS[entry['item_type']]
+            record = dm.get_record(collection, entry['item_id'], shard=entry.get('owner'))
+            if new is not None and record is not None:
+                changes.record_changes(conn, collection, [(entry['item_id'], None, record)],
+                                       lambda r: [new['principal']])
+            elif new is None:
+                changes.record_changes(conn, collection, [(entry['item_id'], {'id': entry['item_id']}, None)],
+                                       lambda r: [old['principal']])
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Kunne ikke logge tilgangsendringer for synkronisering: {e}")
+    finally:
+        return_db_connection(conn)
+
+for data_type in SYNC_AUDIENCES:
+    dm.on_write(data_type, log_changes)
+dm.on_write('acl', log_acl_changes)
+
+# Live-oppdateringer: skrivende ruter publiserer, /api/stream leverer (se events.py)
+broker = EventBroker()
+# Kommentar-linje så proxyer ikke lukker en stille strøm
+STREAM_KEEPALIVE_SECONDS = 15
+# Strømmen avsluttes etter en stund så tråden frigjøres; nettleseren kobler til igjen
+STREAM_MAX_SECONDS = int(os.environ.get('STREAM_MAX_SECONDS', 300))
+# Hver åpen strøm og long-poll holder en tråd: begrens dem per prosess. Over
+# grensen får strømmen et kort svar og nettleseren spør igjen etter så lenge
+stream_slots = Slots(app.config['STREAM_MAX_CONNECTIONS'])
+STREAM_BUSY_RETRY_MILLISECONDS = 30000
+
+# Live redigering av felles notater (se collab.py): dokumentene holdes i minnet
+# og skrives til lageret med jevne mellomrom, ikke ved hvert tastetrykk
+NOTE_CHECKPOINT_SECONDS = float(os.environ.get('NOTE_CHECKPOINT_SECONDS', 10))
+# Så lenge venter en long-poll på nye endringer
+LIVE_POLL_SECONDS = 25
+live_poll_slots = Slots(app.config['LIVE_POLL_MAX_CONNECTIONS'])
+LIVE_POLL_BUSY_SECONDS = 5
+
+def load_live_note(note_id):
+    note = dm.get_record('shared_notes', note_id)
+    if note is None:
+        return None
+    return note.get('content') or '', note.get('revision', 0)
+
+def save_live_note(note_id, content, revision):
+    def set_content(n):
+        # En annen prosess kan allerede ha lagret en nyere versjon
+        if n.get('revision', 0) >= revision:
+            return False
+        n['content'] = content
+        n['revision'] = revision
+        n['updated_at'] = datetime.now().isoformat()
+    note = dm.update('shared_notes', note_id, set_content)
+    if note:
+        broker.publish(note_audience(note), 'note.updated', {
+            'id': note_id, 'title': note.get('title'), 'content': content,
+            'updated_at': note.get('updated_at')})
+
+collab_hub = collab.CollabHub(load_live_note, save_live_note, checkpoint_interval=NOTE_CHECKPOINT_SECONDS)
+
+@app.cli.command('split-shards')
+def split_shards_command():
+    """Split monolithic JSON collections into per-user shards (DATA_LAYOUT=sharded)."""
+    if not dm.is_sharded('reminders'):
+        print("Set DATA_LAYOUT=sharded before running this migration")
+        return
+    for data_type, count in dm.split_shards().items():
+        print(f"{data_type}: {count} records moved")
+
+@app.cli.command('backfill-due-ts')
+def backfill_due_ts_command():
+    """Set due_ts/timezone on JSON reminders written before they existed (see timekeys.py)."""
+    for data_type in ('reminders', 'shared_reminders'):
+        stale = [timekeys.stamp(dict(r)) for r in dm.read_data(data_type) if not timekeys.is_stamped(r)]
+        if stale:
+            dm.upsert_many(data_type, stale)
+        print(f"{data_type}: {len(stale)} records stamped")
+
+@app.cli.command('migrate-note-messages')
+def migrate_note_messages_command():
+    """Move chat messages embedded in shared notes into the note_messages log."""
+    conn = db_pool.acquire()
+    try:
+        moved = 0
+        for note in list(dm.read_data('shared_notes')):
+            if 'messages' not in note:
+                continue
+            moved += note_messages.import_embedded(conn, note['id'], note['messages'])
+            # Only dropped once the log has them
+            dm.update('shared_notes', note['id'], lambda n: n.pop('messages', None))
+        print(f"{moved} message(s) moved")
+    finally:
+        db_pool.release(conn)
+
+@app.cli.command('migrate-sharing')
+def migrate_sharing_command():
+    """Replace per-recipient reminder copies and note member lists with ACL entries."""
+    granted = promoted = 0
+    for copy in list(dm.read_data('shared_reminders')):
+        original = dm.get_record('reminders', copy.get('original_id'), shard=copy.get('shared_by')) \
+            if copy.get('original_id') and copy.get('shared_by') else None
+        if original:
+            granted += len(acl.grant('reminder', original['id'], [copy.get('shared_with')],
+                                     owner=original['user_id'], granted_by=copy.get('shared_by')))
+        else:
+            # The original is deleted; the recipient keeps the copy as their own
+            own = {k: v for k, v in copy.items() if k not in ('original_id', 'shared_by', 'shared_with', 'is_shared')}
+            dm.upsert('reminders', dict(own, user_id=copy.get('shared_with')))
+            promoted += 1
+        dm.delete('shared_reminders', copy['id'], shard=copy.get('shared_with'))
+
+    def strip(*fields):
+        def mutate(record):
+            if not any(field in record for field in fields):
+                return False
+            for field in fields:
+                record.pop(field, None)
+        return mutate
+
+    for reminder in list(dm.read_data('reminders')):
+        if 'shared_with' not in reminder:
+            continue
+        granted += len(acl.grant('reminder', reminder['id'], reminder.get('shared_with') or [],
+                                 owner=reminder.get('user_id')))
+        dm.update('reminders', reminder['id'], strip('shared_with'), shard=reminder.get('user_id'))
+
+    for note in list(dm.read_data('shared_notes')):
+        if 'shared_with' not in note and 'members' not in note:
+            continue
+        shared_with = note.get('shared_with') or []
+        principals = [shared_with] if isinstance(shared_with, str) else list(shared_with)
+        principals += [m.get('email') for m in note.get('members') or []]
+        granted += len(acl.grant('note', note['id'], principals, owner=note.get('user_id')))
+        dm.update('shared_notes', note['id'], strip('shared_with', 'members'))
+    print(f"{granted} access entries granted, {promoted} orphaned copies kept as own reminders")
+
+@app.cli.command('outbox-requeue')
+def outbox_requeue_command():
+    """Retry every dead-lettered e-mail in the outbox."""
+    conn = db_pool.acquire()
+    try:
+        print(f"{requeue_dead(conn)} message(s) requeued")
+    finally:
+        db_pool.release(conn)
 
 # Initialize database
 def init_db():
-    """Initialize database tables"""
+    """Apply pending schema migrations (see database_upgrade.py)"""
+    conn = get_db_connection()
+    if not conn:
+        return False
     try:
-        conn = get_db_connection()
-        if conn:
-            cur = conn.cursor()
-            
-            # Create users table if it doesn't exist
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id TEXT PRIMARY KEY,
-                    username TEXT NOT NULL,
-                    email TEXT UNIQUE NOT NULL,
-                    password_hash TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            conn.commit()
-            cur.close()
-            logger.info("Database tables initialized!")
-            return True
+        applied = run_migrations(conn)
+        logger.info(f"Database initialized, {len(applied)} migration(s) applied")
+        return True
     except Exception as e:
         logger.error(f"Database initialization error: {e}")
         return False
     finally:
-        if conn:
-            return_db_connection(conn)
-
-# Initialize database on startup
-init_db()
+        return_db_connection(conn)
 
 # Login manager setup
 login_manager = LoginManager()
@@ -158,6 +370,11 @@ class ReminderForm(FlaskForm):
         ('Familie', 'Familie'), ('Annet', 'Annet')
     ])
     share_with = StringField('Del med (e-post, bruk komma for flere)')
+    recurrence = SelectField('Gjentas', choices=[
+        ('', 'Ikke gjentakende'), ('daily', 'Hver dag'),
+        ('weekly', 'Hver uke'), ('monthly', 'Hver måned')
+    ], default='')
+    recurrence_until = DateField('Gjentas til', validators=[Optional()])
     submit = SubmitField('Opprett påminnelse')
 
 class NoteForm(FlaskForm):
@@ -190,6 +407,28 @@ class User(UserMixin):
     
     @staticmethod
     def get(user_id):
+        """Brukeren med denne id-en; lastes høyst én gang per forespørsel (se loaded_users)"""
+        users = loaded_users()
+        if users is None:
+            return User._cached(user_id)
+        count_user_lookup(loaded=user_id not in users)
+        if user_id not in users:
+            users[user_id] = User._cached(user_id)
+        return users[user_id]
+
+    @staticmethod
+    def _cached(user_id):
+        """Fra user_cache mellom forespørslene, ellers fra databasen/JSON"""
+        user = user_cache.get(user_id)
+        if user is None:
+            generation = user_cache.generation()
+            user = User._load(user_id)
+            if user is not None:
+                user_cache.put(user_id, user, generation)
+        return user
+
+    @staticmethod
+    def _load(user_id):
         # Try database first
         conn = get_db_connection()
         if conn:
@@ -209,7 +448,7 @@ class User(UserMixin):
                 return_db_connection(conn)
         
         # Fallback to JSON
-        users = dm.load_data('users')
+        users = dm.read_data('users')
         if user_id in users:
             user_data = users[user_id]
             u = User(user_id, user_data['username'], user_data['email'], user_data.get('password_hash'))
@@ -219,6 +458,20 @@ class User(UserMixin):
     
     @staticmethod
     def get_by_email(email):
+        users = loaded_users()
+        if users is None:
+            return User._load_by_email(email)
+        known = next((u for u in users.values() if u is not None and u.email == email), None)
+        count_user_lookup(loaded=known is None)
+        if known is not None:
+            return known
+        user = User._load_by_email(email)
+        if user is not None:
+            users[user.id] = user
+        return user
+
+    @staticmethod
+    def _load_by_email(email):
         # Try database first
         conn = get_db_connection()
         if conn:
@@ -238,21 +491,23 @@ class User(UserMixin):
                 return_db_connection(conn)
         
         # Fallback to JSON
-        users = dm.load_data('users')
-        for user_id, user_data in users.items():
-            if user_data.get('email') == email:
-                u = User(
-                    user_id, 
-                    user_data.get('username', email), 
-                    email, 
-                    user_data.get('password_hash')
-                )
-                u._app_mode = user_data.get('app_mode', "DEFAULT")
-                return u
+        for user_id in dm.find_ids('users', 'email', email):
+            user_data = dm.get_record('users', user_id)
+            u = User(
+                user_id, 
+                user_data.get('username', email), 
+                email, 
+                user_data.get('password_hash')
+            )
+            u._app_mode = user_data.get('app_mode', "DEFAULT")
+            return u
         return None
 
     def save(self):
         """Save user to database and JSON"""
+        users = loaded_users()
+        if users is not None:
+            users[self.id] = self
         # Save to database if available
         conn = get_db_connection()
         if conn:
@@ -264,6 +519,8 @@ class User(UserMixin):
                 )
                 conn.commit()
                 cur.close()
+                # Først etter skrivingen, ellers kan en annen forespørsel hente den gamle raden inn i cachen igjen
+                user_cache.invalidate(self.id)
                 logger.info(f"User {self.email} saved to database")
                 return True
             except Exception as e:
@@ -272,15 +529,14 @@ class User(UserMixin):
                 return_db_connection(conn)
         
         # Always save to JSON as backup
-        users = dm.load_data('users')
-        users[self.id] = {
+        dm.upsert('users', {
             'username': self.username,
             'email': self.email,
             'password_hash': self.password_hash,
             'app_mode': self._app_mode,
             'created': datetime.now().isoformat()
-        }
-        dm.save_data('users', users)
+        }, record_id=self.id)
+        user_cache.invalidate(self.id)
         logger.info(f"User {self.email} saved to JSON")
         return True
 
@@ -299,6 +555,7 @@ class User(UserMixin):
                 conn.commit()
                 cur.close()
                 self._app_mode = mode
+                user_cache.invalidate(self.id)
                 return
             except Exception as e:
                 logger.error(f"Database error setting app_mode: {e}")
@@ -307,21 +564,58 @@ class User(UserMixin):
         
         # Fallback til JSON
         try:
-            users = dm.load_data('users')
-            if self.id in users:
-                users[self.id]['app_mode'] = mode
-                dm.save_data('users', users)
+            dm.update('users', self.id, lambda u: u.update(app_mode=mode))
             self._app_mode = mode
+            user_cache.invalidate(self.id)
         except Exception as e:
             logger.error(f"JSON error setting app_mode: {e}")
 
+user_cache = UserCache(max_size=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'],
+                       signal='user_invalidations' if app.config['USER_CACHE_SIGNAL'] else None, dm=dm)
+
+def loaded_users():
+    """Identitetskart for forespørselen: id -> User (None om den ikke finnes).
+
+    Lever i flask.g som databasekoblingen, så hjelpefunksjonene kan slå
+    opp brukeren fritt uten at den leses fra SQLite/users.json mer enn én
+    gang. Utenfor en app-kontekst finnes det ikke (None).
+    """
+    if not has_app_context():
+        return None
+    if 'loaded_users' not in g:
+        g.loaded_users = {}
+    return g.loaded_users
+
+def count_user_lookup(loaded):
+    lookups = g.setdefault('user_lookups', {'calls': 0, 'loads': 0})
+    lookups['calls'] += 1
+    lookups['loads'] += loaded
+
+def get_user_email(user_id):
+    user = User.get(user_id)
+    return user.email if user else None
+
+@app.after_request
+def report_user_lookups(response):
+    lookups = g.get('user_lookups')
+    if lookups and (app.debug or app.config['USER_LOOKUP_DEBUG']):
+        response.headers['X-User-Lookups'] = f"{lookups['calls']} calls, {lookups['loads']} loads"
+        logger.info(f"{request.method} {request.path}: User-oppslag {lookups['calls']}, lastet {lookups['loads']}")
+    return response
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.get(user_id)
 
 # Email functions
-def send_email(to, subject, template=None, html_content=None, **kwargs):
-    """Send email with template or direct HTML"""
+def send_email(to, subject, template=None, html_content=None, priority=PRIORITY_BULK, immediate=False,
+               dedupe_key=None, **kwargs):
+    """Queue email with template or direct HTML in the outbox (see outbox.py).
+
+    Returns True once the message is stored; worker.py delivers it. With
+    immediate=True it is sent synchronously instead (used by /test-email).
+    A message whose dedupe_key is already in the outbox is not queued again.
+    """
     try:
         if not app.config.get('MAIL_USERNAME') or not app.config.get('MAIL_PASSWORD'):
             logger.warning("E-post ikke sendt: Mangler MAIL_USERNAME eller MAIL_PASSWORD i konfigurasjonen")
@@ -340,27 +634,34 @@ def send_email(to, subject, template=None, html_content=None, **kwargs):
         
         # Opprett e-post
         try:
-            msg = Message(
-                subject=subject,
-                recipients=recipients,
-                sender=app.config.get('MAIL_DEFAULT_SENDER') or app.config.get('MAIL_USERNAME')
-            )
-            
             if template:
                 try:
-                    msg.html = render_template(template, **kwargs)
+                    html = render_template(template, **kwargs)
                 except Exception as e:
                     logger.error(f"Feil ved rendering av e-postmal {template}: {e}")
                     return False
             elif html_content:
-                msg.html = html_content
+                html = html_content
             else:
                 logger.error("E-post mangler både mal og HTML-innhold")
                 return False
-            
-            # Send e-posten
-            mail.send(msg)
-            logger.info(f"E-post sendt til {to}: {subject}")
+
+            sender = app.config.get('MAIL_DEFAULT_SENDER') or app.config.get('MAIL_USERNAME')
+            if immediate:
+                deliver_email({'recipients': recipients, 'sender': sender, 'subject': subject, 'html': html})
+                logger.info(f"E-post sendt til {to}: {subject}")
+                return True
+
+            # Legg e-posten i utboksen
+            conn = get_db_connection()
+            if not conn:
+                return False
+            try:
+                enqueue_email(conn, recipients, subject, html, priority=priority, sender=sender,
+                              dedupe_key=dedupe_key)
+            finally:
+                return_db_connection(conn)
+            logger.info(f"E-post lagt i kø til {to}: {subject}")
             return True
             
         except Exception as e:
@@ -371,162 +672,279 @@ def send_email(to, subject, template=None, html_content=None, **kwargs):
         logger.error(f"Feil ved sending av e-post til {to}: {e}")
         return False
 
-def check_reminders_for_notifications():
-    """Sjekk påminnelser og send varsler med minnelogging"""
+class MailSession:
+    """Én SMTP-tilkobling (mail.connect()) som gjenbrukes for mange e-poster.
+
+    Kobler til ved første send, åpner en ny tilkobling etter
+    MAIL_MESSAGES_PER_CONNECTION meldinger, og kobler til på nytt én gang
+    hvis serveren har brutt forbindelsen. Feil som gjelder selve meldingen
+    (f.eks. ukjent mottaker) kastes videre uten å bryte tilkoblingen.
+    """
+
+    def __init__(self, max_messages=None):
+        self.max_messages = max_messages or app.config['MAIL_MESSAGES_PER_CONNECTION']
+        self.connections = 0
+        self._conn = None
+        self._sent_on_connection = 0
+
+    def _connect(self):
+        conn = mail.connect()
+        conn.__enter__()  # connect, STARTTLS and login
+        self._conn = conn
+        self._sent_on_connection = 0
+        self.connections += 1
+
+    def _discard(self):
+        if self._conn is not None and self._conn.host is not None:
+            try:
+                self._conn.host.close()
+            except Exception:
+                pass
+        self._conn = None
+
+    def send(self, message):
+        msg = Message(
+            subject=message['subject'],
+            recipients=message['recipients'],
+            sender=message.get('sender') or app.config.get('MAIL_DEFAULT_SENDER') or app.config.get('MAIL_USERNAME')
+        )
+        msg.html = message['html']
+        with app.app_context():
+            if self._conn is not None and self._sent_on_connection >= self.max_messages:
+                self.close()
+            for attempt in (1, 2):
+                if self._conn is None:
+                    self._connect()
+                try:
+                    self._conn.send(msg)
+                    self._sent_on_connection += 1
+                    return
+                except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, TimeoutError) as e:
+                    self._discard()
+                    if attempt == 2:
+                        raise
+                    logger.info(f"SMTP-tilkoblingen ble brutt ({e}), kobler til på nytt")
+
+    def close(self):
+        if self._conn is None:
+            return
+        try:
+            self._conn.__exit__(None, None, None)  # QUIT
+        except smtplib.SMTPException:
+            self._discard()
+        self._conn = None
+
+def deliver_email(message):
+    """Send one message right away over its own SMTP connection; raises on failure"""
+    session = MailSession()
+    try:
+        session.send(message)
+    finally:
+        session.close()
+
+def load_pending_sql_reminders(since=None):
+    """Påminnelser i SQLite-tabellen som fortsatt skal varsles (for dispatcher.py)
+
+    since er dispatcherens high-water mark: rader som forfalt etter den,
+    mens ingen dispatcher kjørte, tas med så de kan varsles i etterkant.
+    """
     with app.app_context():
+        conn = get_db_connection()
+        if not conn:
+            return None
         try:
-            # Logg minnebruk
-            process = psutil.Process()
-            memory_mb = process.memory_info().rss / 1024 / 1024
-            logger.info(f"Minnebruk før påminnelsessjekk: {memory_mb:.2f} MB")
-            
-            now = datetime.now()
-            notification_time = now + timedelta(minutes=app.config['NOTIFICATION_ADVANCE_MINUTES'])
-            
-            # Hent data
-            conn = get_db_connection()
-            reminders_to_notify = []
-            
-            if conn:
-                try:
-                    cur = conn.cursor()
-                    # Hent påminnelser som skal varsles om
-                    cur.execute("""
-                        SELECT r.id, r.title, r.description, r.date, u.email, u.notification_advance
-                        FROM reminders r
-                        JOIN users u ON r.user_id = u.id
-                        WHERE r.completed = 0 
-                        AND r.notification_sent = 0
-                        AND u.email_notifications = 1
-                        AND r.date > datetime('now')
-                        AND r.date <= datetime('now', '+' || ? || ' minutes')
-                    """, (app.config['NOTIFICATION_ADVANCE_MINUTES'],))
-                    
-                    reminders_to_notify = cur.fetchall()
-                    cur.close()
-                except Exception as e:
-                    logger.error(f"Database error i påminnelsessjekk: {e}")
-                finally:
-                    return_db_connection(conn)
-            
-            # Fallback til JSON hvis databasen ikke er tilgjengelig
-            if not conn:
-                reminders = dm.load_data('reminders')
-                for reminder in reminders:
-                    if not reminder.get('completed') and not reminder.get('notification_sent'):
-                        try:
-                            reminder_dt = datetime.fromisoformat(reminder['datetime'].replace(' ', 'T'))
-                            if now <= reminder_dt <= notification_time:
-                                user = User.get_by_email(reminder['user_id'])
-                                if user and getattr(user, 'email_notifications', True):
-                                    reminders_to_notify.append((
-                                        reminder['id'],
-                                        reminder['title'],
-                                        reminder['description'],
-                                        reminder['datetime'],
-                                        user.email,
-                                        getattr(user, 'notification_advance', app.config['NOTIFICATION_ADVANCE_MINUTES'])
-                                    ))
-                        except Exception as e:
-                            logger.error(f"Feil ved prosessering av påminnelse {reminder.get('id')}: {e}")
-            
-            # Send varsler
-            notifications_sent = 0
-            for reminder in reminders_to_notify:
-                try:
-                    reminder_id, title, description, date, email, advance = reminder
-                    
-                    # Send e-postvarsel
+            # Rader som er importert eller endret siden sist mangler due_ts
+            if timekeys.stamp_sql_reminders(conn):
+                conn.commit()
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT r.id, r.title, r.description, r.date, u.email, u.notification_advance,
+                       r.due_ts, r.timezone, r.claim_until
+                FROM reminders r
+                JOIN users u ON r.user_id = u.id
+                WHERE r.completed = 0
+                AND r.notification_sent = 0
+                AND u.email_notifications = 1
+                AND r.due_ts > ?
+            """, (int(since if since is not None else time.time()),))
+            rows = cur.fetchall()
+            cur.close()
+            return [{
+                'id': row[0], 'title': row[1], 'description': row[2], 'datetime': row[3],
+                'user_id': row[4], 'notification_advance': row[5],
+                'due_ts': row[6], 'timezone': row[7], 'claim_until': row[8]
+            } for row in rows]
+        except Exception as e:
+            logger.error(f"Database error i påminnelsessjekk: {e}")
+            return None
+        finally:
+            return_db_connection(conn)
+
+def claim_notification(item, token):
+    """Reserver varslingen for token før den sendes.
+
+    False hvis påminnelsen allerede er varslet eller en annen prosess har
+    et gyldig krav på den. Kravet utløper etter NOTIFICATION_CLAIM_SECONDS.
+    """
+    now = time.time()
+    until = now + app.config['NOTIFICATION_CLAIM_SECONDS']
+    if item['source'] == SQL_SOURCE:
+        conn = get_db_connection()
+        try:
+            cur = conn.execute("""
+                UPDATE reminders SET claim_token = ?, claim_until = ?
+                WHERE id = ? AND completed = 0 AND notification_sent = 0
+                AND (claim_token IS NULL OR claim_token = ? OR claim_until < ?)
+            """, (token, until, item['id'], token, now))
+            conn.commit()
+            return cur.rowcount == 1
+        except Exception as e:
+            logger.error(f"Kunne ikke reservere varsel for {item['id']}: {e}")
+            return False
+        finally:
+            return_db_connection(conn)
+
+    def claim(r):
+        if r.get('completed'):
+            return False
+        if item.get('occurrence'):
+            if (r.get('last_notified') or '') >= item['occurrence']:
+                return False
+        elif r.get('notification_sent'):
+            return False
+        if r.get('claim_token') not in (None, token) and (r.get('claim_until') or 0) >= now:
+            return False
+        r['claim_token'] = token
+        r['claim_until'] = until
+    return dm.update('reminders', item['id'], claim, shard=item['email']) is not None
+
+def mark_notification_sent(item, token=None):
+    """Sett notification_sent på påminnelsen, i SQLite eller JSON etter kilde
+
+    Med token skjer det bare hvis kravet fra claim_notification fortsatt er vårt.
+    """
+    if item['source'] == SQL_SOURCE:
+        conn = get_db_connection()
+        try:
+            conn.execute("""
+                UPDATE reminders SET notification_sent = 1, claim_token = NULL, claim_until = NULL
+                WHERE id = ? AND (? IS NULL OR claim_token = ?)
+            """, (item['id'], token, token))
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Kunne ikke oppdatere notification_sent status: {e}")
+        finally:
+            return_db_connection(conn)
+        return
+
+    def mark_sent(r):
+        if token is not None and r.get('claim_token') != token:
+            return False
+        r.pop('claim_token', None)
+        r.pop('claim_until', None)
+        if item.get('occurrence'):
+            # Gjentakende: bare denne forekomsten er varslet, dispatcheren tar neste
+            if (r.get('last_notified') or '') < item['occurrence']:
+                r['last_notified'] = item['occurrence']
+        else:
+            r['notification_sent'] = True
+    dm.update('reminders', item['id'], mark_sent, shard=item['email'])
+
+def notification_digest_window(email):
+    """Hvor mange minutter fram i tid påminnelser slås sammen til én e-post.
+
+    Brukere med 'minimal'/'gentle' profil (eller notification_style i
+    preferansene) får et lengre vindu og dermed færre e-poster.
+    """
+    with app.app_context():
+        user = User.get_by_email(email)
+        if user:
+            profile = get_user_profile(user.id)
+            style = profile.get('preferences', {}).get('notification_style')
+            if profile.get('profile_type') in GENTLE_PROFILES or style in GENTLE_PROFILES:
+                return app.config['DIGEST_WINDOW_MINUTES_GENTLE']
+        return app.config['DIGEST_WINDOW_MINUTES']
+
+def send_reminder_notifications(items, token=None):
+    """Send varsler for påminnelser som dispatcheren har funnet forfalt.
+
+    Påminnelser til samme mottaker sendes som én samle-e-post (digest).
+    Med token (én per dispatch-partisjon i worker.py) reserveres hver
+    påminnelse først, og bare den som har kravet setter notification_sent,
+    så ingen påminnelse varsles to ganger.
+    Returnerer påminnelsene som ikke kunne varsles, så de kan prøves igjen.
+    """
+    failed = []
+    with app.app_context():
+        by_recipient = {}
+        for item in items:
+            by_recipient.setdefault(item['email'], []).append(item)
+
+        notifications_sent = 0
+        emails_sent = 0
+        for email, group in by_recipient.items():
+            try:
+                # JSON-brukere kan ha slått av varsler; SQL-spørringen filtrerer selv
+                json_items = [item for item in group if item['source'] != SQL_SOURCE]
+                if json_items:
+                    user = User.get_by_email(email)
+                    if not user or not getattr(user, 'email_notifications', True):
+                        group = [item for item in group if item['source'] == SQL_SOURCE]
+                        if not group:
+                            continue
+
+                if token is not None:
+                    group = [item for item in group if claim_notification(item, token)]
+                    if not group:
+                        continue
+                group.sort(key=lambda item: item['due_at'])
+                # Samme påminnelser gir samme nøkkel, så utboksen tar dem bare én gang
+                dedupe_key = 'reminders:' + hashlib.sha1(','.join(sorted(
+                    f"{item['id']}@{item.get('occurrence') or item['due_at']}" for item in group
+                )).encode('utf-8')).hexdigest()
+                reminders = [{
+                    'title': item['title'],
+                    'description': item['description'],
+                    'datetime': item['datetime'],
+                    'priority': item.get('priority')
+                } for item in group]
+
+                # Send e-postvarsel, én per mottaker
+                if len(group) == 1:
                     sent = send_email(
                         to=email,
-                        subject=f"Påminnelse: {title}",
+                        subject=f"Påminnelse: {group[0]['title']}",
                         template='emails/reminder_notification.html',
-                        reminder={
-                            'title': title,
-                            'description': description,
-                            'datetime': date
-                        }
+                        dedupe_key=dedupe_key,
+                        reminder=reminders[0]
                     )
-                    
-                    if sent:
-                        notifications_sent += 1
-                        # Marker påminnelsen som varslet
-                        if conn:
-                            try:
-                                cur = conn.cursor()
-                                cur.execute("UPDATE reminders SET notification_sent = 1 WHERE id = ?", (reminder_id,))
-                                conn.commit()
-                                cur.close()
-                            except Exception as e:
-                                logger.error(f"Kunne ikke oppdatere notification_sent status: {e}")
-                        else:
-                            # Oppdater JSON
-                            reminders = dm.load_data('reminders')
-                            for r in reminders:
-                                if r['id'] == reminder_id:
-                                    r['notification_sent'] = True
-                                    break
-                            dm.save_data('reminders', reminders)
-                    
-                except Exception as e:
-                    logger.error(f"Feil ved sending av varsel for påminnelse {reminder_id}: {e}")
-            
-            if notifications_sent > 0:
-                logger.info(f"Sendt {notifications_sent} varsler")
-              # Logg minnebruk etter ferdig            memory_mb = process.memory_info().rss / 1024 / 1024
-            logger.info(f"Minnebruk etter påminnelsessjekk: {memory_mb:.2f} MB")
-            
-            # Send notifications (limit to 5 per run to prevent memory issues)
-            sent_count = 0
-            for reminder, recipient_email in all_reminders[:5]:
-                subject = f"🔔 Påminnelse: {reminder['title']}"
-                html_content = f"""
-                <h2>Påminnelse: {reminder['title']}</h2>
-                <p>Dette er en påminnelse om at du har en oppgave som snart forfaller.</p>
-                <div style="background: #f8f9fa; padding: 15px; border-radius: 5px;">
-                    <h3>{reminder['title']}</h3>
-                    <p><strong>Beskrivelse:</strong> {reminder.get('description', 'Ingen beskrivelse')}</p>
-                    <p><strong>Tid:</strong> {reminder['datetime']}</p>
-                    <p><strong>Prioritet:</strong> {reminder['priority']}</p>
-                </div>
-                """
-                
-                success = send_email(
-                    to=recipient_email,
-                    subject=subject,
-                    html_content=html_content
-                )
-                
-                if success:
-                    notifications.append({
-                        'reminder_id': reminder['id'],
-                        'recipient': recipient_email,
-                        'sent_at': now.isoformat(),
-                        'type': 'reminder_notification'
-                    })
-                    sent_count += 1
-            
-            # Save updated notifications
-            if sent_count > 0:
-                dm.save_data('notifications', notifications)
-                logger.info(f"Sent {sent_count} reminder notifications")
-            
-            # Log memory usage after
-            memory_mb_after = process.memory_info().rss / 1024 / 1024
-            logger.info(f"Memory usage after reminder check: {memory_mb_after:.2f} MB")
-            
-        except Exception as e:
-            logger.error(f"Error checking reminders: {e}")
-
-# Initialize scheduler with reduced frequency
-scheduler = BackgroundScheduler()
-scheduler.add_job(
-    func=check_reminders_for_notifications,
-    trigger="interval",
-    minutes=15,  # Reduced from 5 to 15 minutes
-    id='check_reminders_for_notifications'
-)
-scheduler.start()
+                else:
+                    sent = send_email(
+                        to=email,
+                        subject=f"Påminnelser: {len(group)} oppgaver forfaller snart",
+                        template='emails/reminder_digest.html',
+                        dedupe_key=dedupe_key,
+                        reminders=reminders
+                    )
+                if not sent:
+                    failed.extend(group)
+                    continue
+
+                emails_sent += 1
+                notifications_sent += len(group)
+                # Marker påminnelsene som varslet
+                for item in group:
+                    mark_notification_sent(item, token)
+            except Exception as e:
+                logger.error(f"Feil ved sending av varsel til {email}: {e}")
+                failed.extend(group)
+
+        if notifications_sent > 0:
+            logger.info(f"Sendt {notifications_sent} varsler i {emails_sent} e-poster")
+    return failed
+
+# Reminder notifications are dispatched by worker.py (see dispatcher.py), not
+# by the web workers
 
 # Helper functions
 # Fix the empty exception blocks in get_user_profile
@@ -588,38 +1006,78 @@ def get_user_profile(user_id):
         return_db_connection(conn)
 
 def get_user_reminders(user_id):
-    """Get user's reminders"""
-    # Try database first
+    """Get user's reminders (SQLite-tabellen og JSON-lageret)"""
+    reminders = []
     conn = get_db_connection()
     if conn:
         try:
             cursor = conn.cursor()
             cursor.execute("""
-                SELECT id, title, description, due_date, category, priority, completed
+                SELECT id, title, description, due_date, category, priority, completed,
+                       due_ts, timezone
                 FROM reminders WHERE user_id = ?
-                ORDER BY due_date ASC
+                ORDER BY due_ts ASC
             """, (user_id,))
             
-            reminders = cursor.fetchall()
+            rows = cursor.fetchall()
             cursor.close()
-            return [{'id': r[0], 'title': r[1], 'description': r[2], 
+            reminders = [{'id': r[0], 'title': r[1], 'description': r[2], 
                     'datetime': r[3], 'category': r[4], 'priority': r[5], 
-                    'completed': r[6]} for r in reminders]
+                    'completed': r[6], 'due_ts': r[7], 'timezone': r[8]} for r in rows]
         except Exception as e:
             logger.error(f"Error getting user reminders: {e}")
         finally:
             return_db_connection(conn)
     
-    # Fallback to JSON
-    reminders = dm.load_data('reminders')
-    user_email = User.get(user_id).email if User.get(user_id) else None
-    return [r for r in reminders if r.get('user_id') == user_email]
+    # add_reminder skriver til JSON-lageret, så det må alltid tas med
+    user_email = get_user_email(user_id)
+    reminders += [with_next_occurrence(reminder_for(r, user_email)) for r in dm.find('reminders', 'user_id', user_email)]
+    return sorted(reminders, key=timekeys.sort_key)
+
+def with_next_occurrence(reminder):
+    """Gjentakende påminnelser vises med neste forekomst som datetime"""
+    if not recurrence.is_recurring(reminder):
+        return reminder
+    pending = recurrence.pending_occurrence(reminder)
+    return dict(reminder,
+                first_datetime=reminder.get('datetime'),
+                datetime=recurrence.format_occurrence(pending) if pending else reminder.get('datetime'),
+                due_ts=timekeys.to_epoch(pending, reminder.get('timezone')) if pending else timekeys.due_ts(reminder),
+                occurrence=recurrence.format_occurrence(pending) if pending else None,
+                recurrence_text=recurrence.describe(reminder['recurrence']))
 
 def get_shared_reminders(user_id):
-    """Get reminders shared with user"""
-    shared_reminders = dm.load_data('shared_reminders')
-    user_email = User.get(user_id).email if User.get(user_id) else None
-    return [r for r in shared_reminders if r.get('shared_with') == user_email]
+    """Get reminders shared with user (oppslag i ACL-en, så eierens post)"""
+    user_email = get_user_email(user_id)
+    if not user_email:
+        return []
+    shared = []
+    for entry in acl.shared_with(user_email, 'reminder'):
+        reminder = dm.get_record('reminders', entry['item_id'], shard=entry['owner'])
+        if reminder:
+            shared.append(with_next_occurrence(shared_reminder_view(reminder, entry['role'])))
+    return sorted(shared, key=timekeys.sort_key)
+
+def reminder_audience(reminder):
+    """Alle som ser en påminnelse: eieren og de den er delt med"""
+    return [reminder.get('user_id')] + acl.principals('reminder', reminder.get('id'))
+
+def shared_reminder_view(reminder, role):
+    """En delt påminnelse slik mottakeren ser den"""
+    return dict(reminder, is_shared=True, shared_by=reminder.get('user_id'), role=role, shared_with=[])
+
+def reminder_for(reminder, email):
+    """Påminnelsen slik email ser den: eieren får med hvem den er delt med"""
+    if reminder.get('user_id') == email:
+        return dict(reminder, shared_with=acl.principals('reminder', reminder['id']))
+    return shared_reminder_view(reminder, acl.role('reminder', reminder['id'], email))
+
+def publish_reminder(event_type, reminder):
+    """Send en påminnelseshendelse til eieren og alle den er delt med"""
+    reminder = with_next_occurrence(reminder)
+    broker.publish([reminder['user_id']], event_type, reminder_for(reminder, reminder['user_id']))
+    for entry in acl.entries('reminder', reminder['id']):
+        broker.publish([entry['principal']], event_type, shared_reminder_view(reminder, entry['role']))
 
 def calculate_user_stats(user_id):
     """Calculate user statistics"""
@@ -666,17 +1124,38 @@ def calculate_user_stats(user_id):
 
 def get_user_notes(user_id, limit=None):
     """Get user's notes"""
-    notes = dm.load_data('shared_notes')
-    user_email = User.get(user_id).email if User.get(user_id) else None
-    user_notes = [n for n in notes if n.get('user_id') == user_email]
-    return user_notes[:limit] if limit else user_notes
+    user_email = get_user_email(user_id)
+    user_notes = dm.find('shared_notes', 'user_id', user_email)
+    return [note_for(n) for n in (user_notes[:limit] if limit else user_notes)]
 
 def get_shared_notes(user_id, limit=None):
-    """Get notes shared with user"""
-    notes = dm.load_data('shared_notes')
-    user_email = User.get(user_id).email if User.get(user_id) else None
-    shared_notes = [n for n in notes if user_email in n.get('shared_with', [])]
-    return shared_notes[:limit] if limit else shared_notes
+    """Get notes shared with user (oppslag i ACL-en)"""
+    user_email = get_user_email(user_id)
+    if not user_email:
+        return []
+    entries = acl.shared_with(user_email, 'note')
+    shared_notes = []
+    for entry in entries[:limit] if limit else entries:
+        note = dm.get_record('shared_notes', entry['item_id'], shard=entry['owner'])
+        if note:
+            shared_notes.append(note_for(note))
+    return shared_notes
+
+def note_audience(note):
+    """Alle som ser et notat: eieren og de det er delt med"""
+    return {note.get('user_id')} | set(acl.principals('note', note.get('id')))
+
+def note_role(note, email):
+    """email sin rolle på notatet ('owner', 'editor', 'viewer'), eller None uten tilgang"""
+    return acl.role('note', note.get('id'), email, owner=note.get('user_id'))
+
+def note_for(note):
+    """Notatet med medlemmer og shared_with fra ACL-en, slik malene og JS-en viser det"""
+    entries = acl.entries('note', note['id'])
+    members = [{'email': note.get('user_id'), 'role': 'owner',
+                'joined_at': note.get('created_at') or note.get('created')}]
+    members += [{'email': e['principal'], 'role': e['role'], 'joined_at': e['created']} for e in entries]
+    return dict(note, members=members, shared_with=[e['principal'] for e in entries])
 
 def get_focus_stats(user_id):
     """Get focus session statistics"""
@@ -684,8 +1163,8 @@ def get_focus_stats(user_id):
 
 def get_available_users(user_id):
     """Get available users for sharing"""
-    users = dm.load_data('users')
-    current_user_email = User.get(user_id).email if User.get(user_id) else None
+    users = dm.read_data('users')
+    current_user_email = get_user_email(user_id)
     
     # Don't include the current user in the list
     available_users = []
@@ -699,24 +1178,6 @@ def get_available_users(user_id):
     
     return available_users
 
-try:
-    # Import APScheduler
-    from apscheduler.schedulers.background import BackgroundScheduler
-    import psutil  # For memory usage tracking
-
-    # Initialize scheduler with reduced frequency
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(
-        func=check_reminders_for_notifications,
-        trigger="interval",
-        minutes=15,  # Reduced from 5 to 15 minutes
-        id='check_reminders_for_notifications'
-    )
-    scheduler.start()
-except ImportError as e:
-    logger.warning(f"Scheduler dependencies not installed: {e}")
-    scheduler = None
-
 
 def get_dashboard_config(profile):
     """Get dashboard configuration based on profile"""
@@ -788,6 +1249,12 @@ def award_points(user_id, action, value=1):
         return_db_connection(conn)    
     return points
 
+@app.template_filter('as_datetime')
+def as_datetime_filter(value, fmt='%d.%m.%Y %H:%M'):
+    """ISO-tidspunkt som lesbar tekst i maler"""
+    dt = timekeys.parse_local(value)
+    return dt.strftime(fmt) if dt else (value or '')
+
 # Routes for static files
 @app.route('/favicon.ico')
 def favicon():
@@ -800,10 +1267,37 @@ def service_worker():
 @app.route('/health')
 def health_check():
     """Health check endpoint for monitoring"""
+    conn = get_db_connection()
+    outbox = worker = None
+    dispatch = {}
+    try:
+        if conn:
+            outbox = outbox_stats(conn)
+            row = conn.execute("SELECT holder, stats, updated_at FROM worker_stats WHERE name = 'scheduler'").fetchone()
+            if row:
+                worker = {'holder': row[0], 'age_seconds': round(time.time() - row[2], 1), **json.loads(row[1])}
+            # Én rad per dispatch-partisjon (worker.DispatchPartitions)
+            for name, holder, stats, updated_at in conn.execute(
+                    "SELECT name, holder, stats, updated_at FROM worker_stats WHERE name LIKE 'dispatch:%'"):
+                dispatch[name] = {'holder': holder, 'age_seconds': round(time.time() - updated_at, 1),
+                                  **json.loads(stats)}
+    except sqlite3.Error as e:
+        logger.error(f"Could not read outbox stats: {e}")
+    finally:
+        return_db_connection(conn)
     return jsonify({
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
-        'version': '1.0.0'
+        'version': '1.0.0',
+        'storage_cache': dm.cache_stats(),
+        'db_pool': db_pool.stats(),
+        'outbox': outbox,
+        'worker': worker,
+        'dispatch': dispatch,
+        'stream': dict(broker.stats(), slots=stream_slots.stats()),
+        'live_polls': live_poll_slots.stats(),
+        'live_notes': collab_hub.stats(),
+        'user_cache': user_cache.stats()
     })
 
 @app.route('/offline')
@@ -909,6 +1403,7 @@ def register():
                     to=email,
                     subject="Velkommen til Smart Påminner Pro!",
                     template='emails/welcome.html',
+                    priority=PRIORITY_TRANSACTIONAL,
                     user={'username': username}
                 )
             except Exception as e:
@@ -1007,50 +1502,37 @@ def add_reminder():
             'priority': form.priority.data,
             'category': form.category.data,
             'completed': False,
-            'created': datetime.now().isoformat(),
-            'shared_with': share_with
+            'created': datetime.now().isoformat()
         }
+        timekeys.stamp(new_reminder)
+        if form.recurrence.data:
+            # Regelen lagres én gang; forekomstene regnes ut ved behov (recurrence.py)
+            new_reminder['recurrence'] = recurrence.normalize_rule({
+                'freq': form.recurrence.data,
+                'until': form.recurrence_until.data.isoformat() if form.recurrence_until.data else None,
+            })
         
-        reminders = dm.load_data('reminders')
-        reminders.append(new_reminder)
-        dm.save_data('reminders', reminders)
+        dm.upsert('reminders', new_reminder)
         
         if share_with:
-            shared_reminders = dm.load_data('shared_reminders')
-            
-            for recipient in share_with:
-                shared_reminder = {
-                    'id': str(uuid.uuid4()),
-                    'original_id': reminder_id,
-                    'shared_by': current_user.email,
-                    'shared_with': recipient,
-                    'title': form.title.data,
-                    'description': form.description.data,
-                    'datetime': f"{form.date.data} {form.time.data}",
-                    'priority': form.priority.data,
-                    'category': form.category.data,
-                    'completed': False,
-                    'created': datetime.now().isoformat(),
-                    'is_shared': True
-                }
-                shared_reminders.append(shared_reminder)
-                
+            # Mottakerne ser den samme posten; tilgangen er én skriving til ACL-en
+            granted = acl.grant('reminder', reminder_id, share_with, role='editor', owner=current_user.email)
+            shared_reminder = with_next_occurrence(shared_reminder_view(new_reminder, 'editor'))
+            for entry in granted:
                 # Send email notification to the recipient regardless of whether they're a registered user
-                try:
-                    msg = Message(
-                        f"Delt påminnelse: {form.title.data}",
-                        recipients=[recipient]
-                    )
-                    msg.html = render_template(
-                        'emails/shared_reminder.html',
-                        reminder=shared_reminder,
-                        sender=current_user.email
-                    )
-                    mail.send(msg)
-                except Exception as e:
-                    logger.error(f"Failed to send email notification: {e}")
-            
-            dm.save_data('shared_reminders', shared_reminders)
+                send_email(
+                    to=entry['principal'],
+                    subject=f"Delt påminnelse: {form.title.data}",
+                    template='emails/shared_reminder.html',
+                    priority=PRIORITY_TRANSACTIONAL,
+                    reminder=shared_reminder,
+                    sender=current_user.email
+                )
+                broker.publish([entry['principal']], 'reminder.shared', shared_reminder)
+        broker.publish([current_user.email], 'reminder.created',
+                       with_next_occurrence(reminder_for(new_reminder, current_user.email)))
+        
+        if share_with:
             flash(f'Påminnelse "{form.title.data}" opprettet og delt med {len(share_with)} personer!', 'success')
         else:
             flash(f'Påminnelse "{form.title.data}" opprettet!', 'success')
@@ -1062,39 +1544,67 @@ def add_reminder():
 @app.route('/complete_reminder/<reminder_id>')
 @login_required
 def complete_reminder(reminder_id):
-    # Check my reminders
-    reminders = dm.load_data('reminders')
-    for reminder in reminders:
-        if reminder['id'] == reminder_id and reminder['user_id'] == current_user.email:
-            reminder['completed'] = True
-            reminder['completed_at'] = datetime.now().isoformat()
-            dm.save_data('reminders', reminders)
-            flash('Påminnelse fullført!', 'success')
-            return redirect(url_for('dashboard'))
-    
-    # Check shared reminders
-    shared_reminders = dm.load_data('shared_reminders')
-    for reminder in shared_reminders:
-        if reminder['id'] == reminder_id and reminder['shared_with'] == current_user.email:
-            reminder['completed'] = True
-            reminder['completed_at'] = datetime.now().isoformat()
-            dm.save_data('shared_reminders', shared_reminders)
-            flash('Delt påminnelse fullført!', 'success')
-            return redirect(url_for('dashboard'))
+    # Eieren og de med redigeringstilgang fullfører den samme posten
+    def mark_completed(reminder):
+        if not acl.can('reminder', reminder_id, current_user.email, 'editor', owner=reminder.get('user_id')):
+            return False
+        if recurrence.is_recurring(reminder):
+            # Fullfør bare gjeldende forekomst; serien er ferdig når det ikke kommer flere
+            pending = recurrence.pending_occurrence(reminder)
+            if pending is not None:
+                reminder['completed_through'] = recurrence.format_occurrence(pending)
+                if recurrence.pending_occurrence(reminder) is not None:
+                    reminder['completed_at'] = datetime.now().isoformat()
+                    return
+        reminder['completed'] = True
+        reminder['completed_at'] = datetime.now().isoformat()
+    
+    # Påminnelser ligger hos eieren; en delt finnes via ACL-oppføringen
+    entry = acl.entry('reminder', reminder_id, current_user.email)
+    owner = entry['owner'] if entry else current_user.email
+    reminder = dm.update('reminders', reminder_id, mark_completed, shard=owner)
+    if reminder:
+        publish_reminder('reminder.completed', reminder)
+        flash('Påminnelse fullført!' if owner == current_user.email else 'Delt påminnelse fullført!', 'success')
+        return redirect(url_for('dashboard'))
     
     flash('Påminnelse ikke funnet!', 'error')
     return redirect(url_for('dashboard'))
 
+@app.route('/skip_occurrence/<reminder_id>')
+@login_required
+def skip_occurrence(reminder_id):
+    """Hopp over neste forekomst av en gjentakende påminnelse (unntak i regelen)"""
+    def add_exception(reminder):
+        if reminder.get('user_id') != current_user.email or not recurrence.is_recurring(reminder):
+            return False
+        pending = recurrence.pending_occurrence(reminder)
+        if pending is None:
+            return False
+        rule = dict(reminder['recurrence'])
+        rule['exdates'] = list(rule.get('exdates', [])) + [recurrence.format_occurrence(pending)]
+        reminder['recurrence'] = recurrence.normalize_rule(rule)
+        if recurrence.pending_occurrence(reminder) is None:
+            reminder['completed'] = True
+
+    reminder = dm.update('reminders', reminder_id, add_exception, shard=current_user.email)
+    if reminder:
+        publish_reminder('reminder.updated', reminder)
+        flash('Forekomsten ble hoppet over.', 'success')
+    else:
+        flash('Påminnelse ikke funnet eller er ikke gjentakende!', 'error')
+    return redirect(url_for('dashboard'))
+
 @app.route('/delete_reminder/<reminder_id>')
 @login_required
 def delete_reminder(reminder_id):
-    reminders = dm.load_data('reminders')
-    original_count = len(reminders)
-    
-    reminders = [r for r in reminders if not (r['id'] == reminder_id and r['user_id'] == current_user.email)]
+    reminder = dm.get_record('reminders', reminder_id, shard=current_user.email)
     
-    if len(reminders) < original_count:
-        dm.save_data('reminders', reminders)
+    if reminder and reminder['user_id'] == current_user.email:
+        audience = reminder_audience(reminder)
+        dm.delete('reminders', reminder_id, shard=current_user.email)
+        acl.revoke_all('reminder', reminder_id)
+        broker.publish(audience, 'reminder.deleted', {'id': reminder_id})
         flash('Påminnelse slettet!', 'success')
     else:
         flash('Påminnelse ikke funnet eller tilhører ikke deg!', 'error')
@@ -1104,9 +1614,8 @@ def delete_reminder(reminder_id):
 @app.route('/notes')
 @login_required
 def notes():
-    notes = dm.load_data('shared_notes')
-    my_notes = [n for n in notes if n.get('user_id') == current_user.email]
-    shared_with_me = [n for n in notes if current_user.email in n.get('shared_with', [])]
+    my_notes = get_user_notes(current_user.id)
+    shared_with_me = get_shared_notes(current_user.id)
     
     form = NoteForm()
     
@@ -1132,13 +1641,14 @@ def add_note():
             'title': form.title.data,
             'content': form.content.data,
             'created': datetime.now().isoformat(),
-            'updated': datetime.now().isoformat(),
-            'shared_with': share_with
+            'updated': datetime.now().isoformat()
         }
         
-        notes = dm.load_data('shared_notes')
-        notes.append(new_note)
-        dm.save_data('shared_notes', notes)
+        dm.upsert('shared_notes', new_note)
+        acl.grant('note', note_id, share_with, role='editor', owner=current_user.email)
+        new_note = note_for(new_note)
+        broker.publish([current_user.email], 'note.created', new_note)
+        broker.publish(new_note['shared_with'], 'note.shared', new_note)
         
         flash('Notat opprettet!', 'success')
     
@@ -1311,7 +1821,8 @@ def test_email():
         
     success = send_email(
         to=recipient,        subject="Test fra Smart Påminner Pro",
-        html_content=f"<h2>Test e-post</h2><p>Hei {current_user.username if current_user.is_authenticated else 'Test'}!</p><p>Dette er en test e-post fra Smart Påminner Pro.</p>"
+        html_content=f"<h2>Test e-post</h2><p>Hei {current_user.username if current_user.is_authenticated else 'Test'}!</p><p>Dette er en test e-post fra Smart Påminner Pro.</p>",
+        immediate=True
     )
     
     return f"E-post {'sendt' if success else 'FEILET'} til {recipient}"
@@ -1329,9 +1840,8 @@ def setup_database():
 @login_required
 def shared_notes():
     # Get shared notes from JSON since DB is not available
-    notes = dm.load_data('shared_notes')
-    user_notes = [n for n in notes if n.get('user_id') == current_user.email]
-    shared_with_me = [n for n in notes if current_user.email in n.get('shared_with', [])]
+    user_notes = get_user_notes(current_user.id)
+    shared_with_me = get_shared_notes(current_user.id)
     all_notes = user_notes + shared_with_me
     
     return render_template('shared_notes.html', notes=all_notes)
@@ -1357,19 +1867,10 @@ def create_shared_note():
             'user_id': current_user.email,
             'access_code': access_code,
             'created_at': datetime.now().isoformat(),
-            'updated_at': datetime.now().isoformat(),
-            'members': [
-                {
-                    'email': current_user.email,
-                    'role': 'owner',
-                    'joined_at': datetime.now().isoformat()
-                }
-            ],
-            'messages': []
+            'updated_at': datetime.now().isoformat()
         }
-        notes = dm.load_data('shared_notes')
-        notes.append(new_note)
-        dm.save_data('shared_notes', notes)
+        dm.upsert('shared_notes', new_note)
+        broker.publish([current_user.email], 'note.created', note_for(new_note))
         flash('Notat opprettet! Del tilgangskoden med andre.', 'success')
         return redirect(url_for('view_shared_note', note_id=note_id))
     
@@ -1378,23 +1879,101 @@ def create_shared_note():
 @app.route('/shared-notes/view/<note_id>')
 @login_required
 def view_shared_note(note_id):
-    notes = dm.load_data('shared_notes')
-    note = next((n for n in notes if n.get('id') == note_id), None)
+    note = dm.get_record('shared_notes', note_id)
     
     if not note:
         flash('Notat ikke funnet', 'danger')
         return redirect(url_for('shared_notes'))
     
     # Check if user has access
-    user_email = current_user.email
-    is_member = any(m.get('email') == user_email for m in note.get('members', []))
-    is_owner = note.get('user_id') == user_email
-    
-    if not (is_member or is_owner):
+    if not note_role(note, current_user.email):
         flash('Du har ikke tilgang til dette notatet', 'danger')
         return redirect(url_for('shared_notes'))
     
-    return render_template('view_shared_note.html', note=note)
+    note = note_for(note)
+    # Vis det levende dokumentet, som kan være nyere enn siste lagring
+    note['content'], live_version = collab_hub.snapshot(note_id)
+    # Bare siste side av chatten; eldre meldinger med ?before=<seq>
+    messages, older, message_count = [], None, 0
+    conn = get_db_connection()
+    if conn:
+        try:
+            messages, older = note_messages.page(conn, note_id, before=request.args.get('before', type=int))
+            message_count = note_messages.count(conn, note_id)
+        except sqlite3.Error as e:
+            logger.error(f"Kunne ikke hente meldinger for notat {note_id}: {e}")
+        finally:
+            return_db_connection(conn)
+    return render_template('view_shared_note.html', note=note, live_version=live_version,
+                           messages=messages, older_messages=older, message_count=message_count)
+
+@app.route('/shared-notes/messages/<note_id>')
+@login_required
+def note_messages_api(note_id):
+    """Chatmeldinger side for side: de nyeste først, så ?before=<cursor> for eldre"""
+    note = dm.get_record('shared_notes', note_id)
+    if not note or not note_role(note, current_user.email):
+        return jsonify({'status': 'error', 'message': 'Notat ikke funnet'}), 404
+    limit = min(max(request.args.get('limit', note_messages.PAGE_SIZE, type=int), 1), 200)
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({'status': 'error', 'message': 'Database utilgjengelig'}), 503
+    try:
+        messages, older = note_messages.page(conn, note_id, before=request.args.get('before', type=int), limit=limit)
+        return jsonify({'status': 'success', 'messages': messages, 'before': older,
+                        'count': note_messages.count(conn, note_id)})
+    except sqlite3.Error as e:
+        logger.error(f"Kunne ikke hente meldinger for notat {note_id}: {e}")
+        return jsonify({'status': 'error', 'message': 'Kunne ikke hente meldinger'}), 500
+    finally:
+        return_db_connection(conn)
+
+@app.route('/shared-notes/live/<note_id>', methods=['GET', 'POST'])
+@login_required
+def live_note(note_id):
+    """Live redigering: GET gir tekst og versjon, eller med ?since=<versjon>
+    operasjonene etter den (long-poll med &wait=1). POST tar imot
+    {version, op, client_id} og svarer med operasjonen slik den ble brukt."""
+    note = dm.get_record('shared_notes', note_id)
+    if not note or not note_role(note, current_user.email):
+        return jsonify({'status': 'error', 'message': 'Notat ikke funnet'}), 404
+    snapshot = collab_hub.snapshot(note_id)
+    if snapshot is None:
+        return jsonify({'status': 'error', 'message': 'Notat ikke funnet'}), 404
+
+    try:
+        if request.method == 'GET':
+            since = request.args.get('since')
+            if since is None:
+                content, version = snapshot
+                return jsonify({'status': 'success', 'content': content, 'version': version})
+            if not request.args.get('wait'):
+                ops = collab_hub.since(note_id, int(since))
+                return jsonify({'status': 'success', 'ops': [dict(e, note_id=note_id) for e in ops]})
+            if not live_poll_slots.acquire():
+                # For mange venter allerede: svar med en gang og be klienten vente litt
+                ops = collab_hub.since(note_id, int(since))
+                return jsonify({'status': 'success', 'ops': [dict(e, note_id=note_id) for e in ops],
+                                'retry_after': LIVE_POLL_BUSY_SECONDS})
+            try:
+                ops = collab_hub.since(note_id, int(since), wait=LIVE_POLL_SECONDS)
+            finally:
+                live_poll_slots.release()
+            return jsonify({'status': 'success', 'ops': [dict(e, note_id=note_id) for e in ops]})
+
+        if not acl.can('note', note_id, current_user.email, 'editor', owner=note.get('user_id')):
+            return jsonify({'status': 'error', 'message': 'Du kan bare lese dette notatet'}), 403
+        data = request.get_json(silent=True) or {}
+        entry = collab_hub.submit(note_id, int(data.get('version', -1)), data.get('op'),
+                                  author=current_user.email, client_id=data.get('client_id'))
+    except collab.StaleVersion:
+        return jsonify({'status': 'reset', 'message': 'Versjonen er for gammel, last notatet på nytt'}), 409
+    except (collab.OperationError, TypeError, ValueError) as e:
+        return jsonify({'status': 'error', 'message': f'Ugyldig endring: {e}'}), 400
+
+    entry = dict(entry, note_id=note_id)
+    broker.publish(note_audience(note), 'note.ops', entry)
+    return jsonify(entry)
 
 @app.route('/shared-notes/join', methods=['GET', 'POST'])
 @login_required
@@ -1407,8 +1986,7 @@ def join_shared_note():
             flash('Tilgangskode er påkrevd', 'danger')
             return redirect(url_for('join_shared_note'))
         
-        notes = dm.load_data('shared_notes')
-        note = next((n for n in notes if n.get('access_code') == access_code), None)
+        note = dm.find_one('shared_notes', 'access_code', access_code)
         
         if not note:
             flash('Ugyldig tilgangskode', 'danger')
@@ -1416,25 +1994,15 @@ def join_shared_note():
         
         # Check if user is already a member
         user_email = current_user.email
-        is_member = any(m.get('email') == user_email for m in note.get('members', []))
-        
-        if is_member:
+        if note_role(note, user_email):
             flash('Du er allerede medlem av dette notatet', 'info')
             return redirect(url_for('view_shared_note', note_id=note.get('id')))
         
-        # Add user as member
-        note['members'].append({
-            'email': user_email,
-            'role': 'member',
-            'joined_at': datetime.now().isoformat()
-        })
-          # Update shared notes
-        for i, n in enumerate(notes):
-            if n.get('id') == note.get('id'):
-                notes[i] = note
-                break
-        
-        dm.save_data('shared_notes', notes)
+        # Add user as member (én ACL-oppføring; notatet selv skrives ikke)
+        acl.grant('note', note.get('id'), [user_email], role='editor', owner=note.get('user_id'))
+        note = note_for(note)
+        broker.publish(note_audience(note), 'note.member_joined', {
+            'id': note.get('id'), 'email': user_email, 'members': note['members']})
         
         flash('Du er nå medlem av notatet!', 'success')
         return redirect(url_for('view_shared_note', note_id=note.get('id')))
@@ -1444,10 +2012,12 @@ def join_shared_note():
 @app.route('/shared-notes/update/<note_id>', methods=['POST'])
 @login_required
 def update_shared_note(note_id):
-    content = request.form.get('content')
+    # Nettlesere sender linjeskift i skjemaer som \r\n, live-editoren bruker \n
+    content = (request.form.get('content') or '').replace('\r\n', '\n')
+    base = request.form.get('base')
+    version = request.form.get('version', type=int)
     
-    notes = dm.load_data('shared_notes')
-    note = next((n for n in notes if n.get('id') == note_id), None)
+    note = dm.get_record('shared_notes', note_id)
     
     if not note:
         flash('Notat ikke funnet', 'danger')
@@ -1455,24 +2025,31 @@ def update_shared_note(note_id):
     
     # Check if user has access
     user_email = current_user.email
-    is_member = any(m.get('email') == user_email for m in note.get('members', []))
-    is_owner = note.get('user_id') == user_email
-    
-    if not (is_member or is_owner):
+    if not acl.can('note', note_id, user_email, 'editor', owner=note.get('user_id')):
         flash('Du har ikke tilgang til å redigere dette notatet', 'danger')
         return redirect(url_for('shared_notes'))
     
-    # Update note
-    note['content'] = content
-    note['updated_at'] = datetime.now().isoformat()
-    
-    # Update notes list
-    for i, n in enumerate(notes):
-        if n.get('id') == note_id:
-            notes[i] = note
-            break
-    
-    dm.save_data('shared_notes', notes)
+    if base is None or version is None:
+        flash('Skjemaet er utdatert, last notatet på nytt', 'danger')
+        return redirect(url_for('view_shared_note', note_id=note_id))
+    base = base.replace('\r\n', '\n')
+
+    # Hele teksten som én operasjon mot teksten siden ble vist med, sendt inn
+    # med den versjonen: hub-en transformerer den over det andre har skrevet
+    # siden, så samtidige redigeringer ikke overskrives
+    if content != base:
+        try:
+            entry = collab_hub.submit(note_id, version, collab.replace_all(base, content), author=user_email)
+        except collab.StaleVersion:
+            flash('Notatet er endret av andre for lenge siden til at endringene dine kan flettes inn. '
+                  'Kopier teksten din og last notatet på nytt', 'danger')
+            return redirect(url_for('view_shared_note', note_id=note_id))
+        except collab.OperationError as e:
+            logger.error(f"Kunne ikke oppdatere notat {note_id}: {e}")
+            flash('Notatet kunne ikke lagres', 'danger')
+            return redirect(url_for('view_shared_note', note_id=note_id))
+        broker.publish(note_audience(note), 'note.ops', dict(entry, note_id=note_id))
+    collab_hub.checkpoint(note_id)
     
     flash('Notat oppdatert!', 'success')
     return redirect(url_for('view_shared_note', note_id=note_id))
@@ -1486,8 +2063,7 @@ def add_message_to_note(note_id):
         flash('Meldingsinnhold er påkrevd', 'danger')
         return redirect(url_for('view_shared_note', note_id=note_id))
     
-    notes = dm.load_data('shared_notes')
-    note = next((n for n in notes if n.get('id') == note_id), None)
+    note = dm.get_record('shared_notes', note_id)
     
     if not note:
         flash('Notat ikke funnet', 'danger')
@@ -1495,30 +2071,24 @@ def add_message_to_note(note_id):
     
     # Check if user has access
     user_email = current_user.email
-    is_member = any(m.get('email') == user_email for m in note.get('members', []))
-    is_owner = note.get('user_id') == user_email
-    
-    if not (is_member or is_owner):
+    if not note_role(note, user_email):
         flash('Du har ikke tilgang til dette notatet', 'danger')
         return redirect(url_for('shared_notes'))
     
-    # Add message
-    if 'messages' not in note:
-        note['messages'] = []
-    
-    note['messages'].append({
-        'sender': user_email,
-        'content': message_content,
-        'timestamp': datetime.now().isoformat()
-    })
-    
-    # Update notes list
-    for i, n in enumerate(notes):
-        if n.get('id') == note_id:
-            notes[i] = note
-            break
-    
-    dm.save_data('shared_notes', notes)
+    # Add message (eget logg-tabell; notatet selv skrives ikke, se note_messages.py)
+    conn = get_db_connection()
+    if not conn:
+        flash('Meldingen kunne ikke lagres', 'danger')
+        return redirect(url_for('view_shared_note', note_id=note_id))
+    try:
+        message = note_messages.post(conn, note_id, user_email, message_content)
+    except sqlite3.Error as e:
+        logger.error(f"Kunne ikke lagre melding i notat {note_id}: {e}")
+        flash('Meldingen kunne ikke lagres', 'danger')
+        return redirect(url_for('view_shared_note', note_id=note_id))
+    finally:
+        return_db_connection(conn)
+    broker.publish(note_audience(note), 'note.message', {'note_id': note_id, 'message': message})
     
     return redirect(url_for('view_shared_note', note_id=note_id))
 
@@ -1575,13 +2145,11 @@ def set_mode():
                 return_db_connection(conn)
         
         # Oppdater i JSON
-        users = dm.load_data('users')
-        if current_user.id in users:
-            users[current_user.id]['app_mode'] = mode
-            dm.save_data('users', users)
+        dm.update('users', current_user.id, lambda u: u.update(app_mode=mode))
         
         # Oppdater i current_user
         current_user._app_mode = mode
+        user_cache.invalidate(current_user.id)
         
         flash(f'Modus endret til: {mode}', 'success')
     except Exception as e:
@@ -1594,7 +2162,12 @@ def set_mode():
 @app.route('/api/reminders')
 @login_required
 def get_reminders_api():
-    """API for å hente påminnelser for bruk med JavaScript"""
+    """API for å hente påminnelser for bruk med JavaScript
+
+    Med ?start=YYYY-MM-DD&end=YYYY-MM-DD (maks ett år) får svaret også
+    'occurrences': én rad per forekomst i perioden, med gjentakende
+    påminnelser utvidet.
+    """
     try:
         # Hent brukerens egne påminnelser
         my_reminders = get_user_reminders(current_user.id)
@@ -1602,11 +2175,27 @@ def get_reminders_api():
         # Hent påminnelser delt med brukeren
         shared_reminders = get_shared_reminders(current_user.id)
         
-        return jsonify({
+        result = {
             'own_reminders': my_reminders,
             'shared_reminders': shared_reminders,
             'status': 'success'
-        })
+        }
+        if request.args.get('start') or request.args.get('end'):
+            range_start = recurrence.parse(request.args.get('start'))
+            range_end = recurrence.parse(request.args.get('end'))
+            if range_start is None or range_end is None or not range_start < range_end <= range_start + timedelta(days=366):
+                return jsonify({
+                    'status': 'error',
+                    'message': 'Ugyldig periode (start/end som YYYY-MM-DD, maks ett år)'
+                }), 400
+            occurrences = []
+            for reminder in my_reminders + shared_reminders:
+                # Utvid fra seriens første forekomst, ikke den neste som vises
+                series = dict(reminder, datetime=reminder.get('first_datetime', reminder.get('datetime')))
+                occurrences.extend(recurrence.expand(series, range_start, range_end))
+            occurrences.sort(key=timekeys.sort_key)
+            result['occurrences'] = occurrences
+        return jsonify(result)
     except Exception as e:
         logger.error(f"Feil ved henting av påminnelser via API: {e}")
         return jsonify({
@@ -1637,6 +2226,119 @@ def get_notes_api():
             'message': 'Kunne ikke hente notater'
         }), 500
 
+@app.route('/api/sync')
+@login_required
+def sync_api():
+    """Deltasynkronisering for PWA-en og Android-appen
+
+    ?since=<cursor> gir bare postene som er endret (og id-ene til de som er
+    slettet eller ikke lenger delt med brukeren) etter cursoren, pluss en ny
+    cursor. Uten since, eller med en cursor som er for gammel, kommer alt
+    med reset=true. Med more=true er det flere endringer å hente.
+    """
+    email = current_user.email
+    try:
+        since = request.args.get('since')
+        since = int(since) if since else None
+        limit = min(max(int(request.args.get('limit') or 500), 1), 1000)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Ugyldig cursor'}), 400
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({'status': 'error', 'message': 'Database utilgjengelig'}), 503
+    try:
+        result = {'changes': {name: [] for name in SYNC_AUDIENCES},
+                  'deleted': {name: [] for name in SYNC_AUDIENCES}}
+        reset = since is None
+        if not reset:
+            changed, cursor, more, reset = changes.changes_since(conn, email, since, limit)
+        if reset:
+            # Cursoren leses før dataene, så ingenting som skrives underveis går tapt
+            cursor, more = changes.current_cursor(conn), False
+            # Delte påminnelser er de samme postene som eierens, med is_shared
+            result['changes']['reminders'] = get_user_reminders(current_user.id) + get_shared_reminders(current_user.id)
+            notes = get_user_notes(current_user.id) + get_shared_notes(current_user.id)
+            result['changes']['shared_notes'] = list({n['id']: n for n in notes}.values())
+        else:
+            for collection, record_id, op in changed:
+                record = None
+                if op == changes.UPSERT and collection in ITEM_COLLECTIONS.values():
+                    # Posten ligger hos eieren, som ACL-oppføringen peker på
+                    item_type = 'note' if collection == 'shared_notes' else 'reminder'
+                    entry = acl.entry(item_type, record_id, email)
+                    record = dm.get_record(collection, record_id, shard=entry['owner'] if entry else email)
+                if record is None or email not in SYNC_AUDIENCES[collection](record):
+                    result['deleted'][collection].append(record_id)
+                elif collection == 'shared_notes':
+                    result['changes'][collection].append(note_for(record))
+                else:
+                    result['changes'][collection].append(with_next_occurrence(reminder_for(record, email)))
+    except (sqlite3.Error, ValueError) as e:
+        logger.error(f"Feil ved synkronisering: {e}")
+        return jsonify({'status': 'error', 'message': 'Kunne ikke synkronisere'}), 500
+    finally:
+        return_db_connection(conn)
+
+    result.update(status='success', cursor=cursor, more=more, reset=reset)
+    return jsonify(result)
+
+@app.route('/api/stream')
+@login_required
+def event_stream():
+    """Server-Sent Events med endringer i brukerens påminnelser og notater
+
+    Klienten laster listene én gang og bruker så hendelsene. Ved
+    gjenoppkobling sender nettleseren Last-Event-ID og får det den gikk
+    glipp av; kan det ikke spilles av, kommer 'reset' og klienten laster på nytt.
+    """
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    headers = {
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # nginx/Railway-proxyen skal ikke bufre strømmen
+    }
+    if not stream_slots.acquire():
+        # Alle strømplassene er tatt: send det som er gått glipp av og lukk. Med
+        # 200 (ikke 503) kobler EventSource til igjen av seg selv, med Last-Event-ID
+        events, reset, newest = broker.replay(current_user.email, last_event_id)
+        body = f"retry: {STREAM_BUSY_RETRY_MILLISECONDS}\n\n"
+        if reset:
+            body += f"event: {RESET}\ndata: {{}}\n\n"
+        elif events:
+            body += ''.join(format_sse(event) for event in events)
+        else:
+            body += f"id: {newest}\n\n"
+        return Response(body, mimetype='text/event-stream', headers=headers)
+    try:
+        sub = broker.subscribe(current_user.email, last_event_id)
+    except Exception:
+        stream_slots.release()
+        raise
+
+    def generate():
+        yield f"retry: {RETRY_MILLISECONDS}\n\n"
+        deadline = time.monotonic() + STREAM_MAX_SECONDS
+        while time.monotonic() < deadline:
+            if sub.reset:
+                yield f"event: {RESET}\ndata: {{}}\n\n"
+                return
+            event = sub.get(timeout=STREAM_KEEPALIVE_SECONDS)
+            yield format_sse(event) if event else ": keepalive\n\n"
+
+    def close():
+        broker.unsubscribe(sub)
+        stream_slots.release()
+
+    response = Response(generate(), mimetype='text/event-stream', headers=headers)
+    # Kalles av WSGI-serveren også når klienten forsvinner før generatoren har startet
+    response.call_on_close(close)
+    return response
+
 if __name__ == '__main__':
+    init_db()
+    # Only in the reloader's child process, which is the one serving requests
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        from worker import start_in_background
+        start_in_background()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
@@ -0,0 +1,179 @@
+"""Benchmark for the reminder notification pipeline.
+
+Seeds N users and M reminders whose notifications fall due over the next
+few seconds, in the JSON store or the SQLite reminders table, then runs
+the real worker (dispatcher, outbox and sender pool from worker.py)
+against an in-process SMTP sink (smtp_sink.py). Everything lives in a
+temp dir; your data and database are not touched.
+
+Reports end-to-end throughput, latency from each reminder's notification
+time to delivery at the sink (p50/p99), peak RSS of the process and the
+number of SMTP connections opened.
+
+Usage: python bench_notifications.py [--users 200] [--reminders 2000]
+           [--backend json|sqlite] [--spread 0] [--no-digest]
+           [--senders 8] [--provider-rate 1000] [--partitions 1]
+"""
+import argparse
+import email
+import os
+import re
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import timekeys
+from smtp_sink import SMTPSink
+
+TOKEN = re.compile(r'bench-(\d+)')
+# Start a little in the future so seeding and startup are not measured
+LEAD_SECONDS = 3
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else float('nan')
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+
+def seed(args, advance_minutes):
+    """Create users and reminders; returns {token: notify_at}."""
+    from app import dm, generate_password_hash
+
+    users = [(str(uuid.uuid4()), f'user{n}@bench{n % 20}.test') for n in range(args.users)]
+    password_hash = generate_password_hash('bench')
+    start = time.time() + LEAD_SECONDS
+    notify_at = {}
+    reminders = []
+    for n in range(args.reminders):
+        at = start + args.spread * n / max(1, args.reminders)
+        # due_ts has whole seconds; measure from what was stored
+        due_ts = int(at + advance_minutes * 60)
+        due = timekeys.from_epoch(due_ts).isoformat(sep=' ', timespec='seconds')
+        notify_at[n] = due_ts - advance_minutes * 60
+        reminders.append((str(uuid.uuid4()), users[n % len(users)], f'bench-{n}', due, due_ts))
+
+    conn = sqlite3.connect(os.environ['DATABASE_PATH'])
+    try:
+        with conn:
+            conn.executemany(
+                "INSERT INTO users (id, username, email, password_hash, email_notifications) VALUES (?, ?, ?, ?, 1)",
+                [(uid, address.split('@')[0], address, password_hash) for uid, address in users])
+            if args.backend == 'sqlite':
+                conn.executemany(
+                    "INSERT INTO reminders (id, user_id, title, date, due_ts, timezone, completed, notification_sent) "
+                    "VALUES (?, ?, ?, ?, ?, ?, 0, 0)",
+                    [(rid, uid, title, due, due_ts, timekeys.DEFAULT_TIMEZONE)
+                     for rid, (uid, _), title, due, due_ts in reminders])
+    finally:
+        conn.close()
+    if args.backend == 'json':
+        dm.upsert_many('reminders', [{
+            'id': rid, 'user_id': address, 'title': title, 'description': '', 'datetime': due,
+            'due_ts': due_ts, 'timezone': timekeys.DEFAULT_TIMEZONE, 'priority': 'Medium', 'completed': False,
+        } for rid, (_, address), title, due, due_ts in reminders])
+    return notify_at
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--reminders', type=int, default=2000)
+    parser.add_argument('--backend', choices=('json', 'sqlite'), default='json')
+    parser.add_argument('--spread', type=float, default=0,
+                        help="seconds over which notifications fall due (0: all at once, measures drain rate)")
+    parser.add_argument('--no-digest', action='store_true',
+                        help="DIGEST_WINDOW_MINUTES=0: only reminders due at the same second share an e-mail")
+    parser.add_argument('--senders', type=int, default=8, help="OUTBOX_SENDERS")
+    parser.add_argument('--provider-rate', type=float, default=1000,
+                        help="messages/s per recipient domain (20 domains are used)")
+    parser.add_argument('--partitions', type=int, default=1,
+                        help="DISPATCH_PARTITIONS (all held by this one process, one dispatcher thread each)")
+    parser.add_argument('--timeout', type=float, default=300)
+    args = parser.parse_args()
+
+    delivered = {}
+    lock = threading.Lock()
+
+    def on_message(received_at, data):
+        message = email.message_from_bytes(data)
+        body = b''.join(part.get_payload(decode=True) or b'' for part in message.walk()
+                        if not part.is_multipart()).decode('utf-8', 'replace')
+        with lock:
+            for token in TOKEN.findall(body):
+                delivered.setdefault(int(token), received_at)
+
+    sink = SMTPSink(on_message=on_message).start()
+    workdir = tempfile.mkdtemp(prefix='smartreminder-bench-')
+    root = os.path.dirname(os.path.abspath(__file__))
+    os.environ.update({
+        'DATABASE_PATH': os.path.join(workdir, 'bench.db'),
+        'MAIL_SERVER': sink.host, 'MAIL_PORT': str(sink.port), 'MAIL_USE_TLS': 'false',
+        'MAIL_USERNAME': 'bench', 'MAIL_PASSWORD': 'bench', 'MAIL_DEFAULT_SENDER': 'bench@localhost',
+        'OUTBOX_SENDERS': str(args.senders), 'OUTBOX_PROVIDER_RATE': str(args.provider_rate),
+        'DISPATCH_REFRESH_SECONDS': '1', 'DISPATCH_PARTITIONS': str(args.partitions),
+    })
+    if args.no_digest:
+        os.environ['DIGEST_WINDOW_MINUTES'] = '0'
+    os.chdir(workdir)  # the JSON store lives in ./data
+    sys.path.insert(0, root)
+    try:
+        from database_upgrade import upgrade_database
+        upgrade_database(os.environ['DATABASE_PATH'])
+        import logging
+        logging.disable(logging.INFO)
+        from app import app
+        import worker as worker_module
+
+        notify_at = seed(args, app.config['NOTIFICATION_ADVANCE_MINUTES'])
+        rss_before = peak_rss_mb()
+        stop = threading.Event()
+        worker = worker_module.build_worker()
+        thread = threading.Thread(target=worker.run, args=(stop,), daemon=True)
+        thread.start()
+
+        deadline = time.time() + LEAD_SECONDS + args.spread + args.timeout
+        while time.time() < deadline:
+            with lock:
+                if len(delivered) >= args.reminders:
+                    break
+            time.sleep(0.1)
+        stop.set()
+        thread.join()
+
+        # Digests may deliver a reminder before its own notification time;
+        # that counts as zero latency
+        latencies = [max(0.0, delivered[n] - notify_at[n]) for n in delivered]
+        early = sum(1 for n in delivered if delivered[n] < notify_at[n])
+        first = min(notify_at.values())
+        last = max(delivered.values()) if delivered else first
+        elapsed = max(last - first, 1e-9)
+        print(f"backend={args.backend} users={args.users} reminders={args.reminders} "
+              f"spread={args.spread}s digest={'off' if args.no_digest else 'on'} senders={args.senders} "
+              f"partitions={args.partitions}")
+        print(f"delivered:   {len(delivered)}/{args.reminders} reminders in {sink.messages} e-mails")
+        print(f"throughput:  {len(delivered) / elapsed * 60:.0f} reminders/min "
+              f"({sink.messages / elapsed:.1f} e-mails/s)")
+        print(f"latency:     p50 {percentile(latencies, 0.50) * 1000:.0f} ms, "
+              f"p99 {percentile(latencies, 0.99) * 1000:.0f} ms (notification time -> SMTP sink), "
+              f"{early} sent early in a digest")
+        print(f"peak RSS:    {peak_rss_mb():.1f} MB (after seeding: {rss_before:.1f} MB)")
+        print(f"SMTP:        {sink.connections} connections opened")
+        return 0 if len(delivered) == args.reminders else 1
+    finally:
+        sink.stop()
+        os.chdir(root)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
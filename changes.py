@@ -0,0 +1,103 @@
+"""Change log for delta sync (/api/sync).
+
+Every write to a synced collection (reminders, shared_reminders,
+shared_notes) adds one row per affected user to the ``change_log`` table:
+
+    seq        monotonically increasing (AUTOINCREMENT), the sync cursor
+    principal  the user who sees the change (e-mail)
+    collection, record_id
+    op         'upsert', or 'delete' as a tombstone
+
+The rows are written by a DataManager ``on_write`` hook, so every write
+path is covered; grants and revocations in the ACL (acl.py) are logged
+the same way for the principal they concern. A user who loses access to
+a record gets a tombstone for it. A client keeps the
+``seq`` it has seen and asks for what came after it; the index on
+(principal, seq) makes that cost proportional to the number of changes,
+not to the user's data.
+
+SQLite hands out AUTOINCREMENT values under its write lock and the row is
+committed in the same transaction, so rows become visible in ``seq``
+order and a cursor never skips a change committed later. ``prune`` drops
+rows older than the retention period; a cursor from before the oldest
+remaining row has lost changes and gets ``reset``, i.e. a full sync.
+"""
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+UPSERT = 'upsert'
+DELETE = 'delete'
+# Bookkeeping of the notification dispatcher, not something clients show
+IGNORED_FIELDS = frozenset(('claim_token', 'claim_until'))
+
+
+def _differs(old, new):
+    keys = (old.keys() | new.keys()) - IGNORED_FIELDS
+    return any(old.get(key) != new.get(key) for key in keys)
+
+
+def record_changes(conn, collection, changes, audience):
+    """Log writes from a DataManager ``on_write`` hook. Does not commit.
+
+    ``audience(record)`` returns the principals who can see a record.
+    Returns the number of rows written.
+    """
+    now = time.time()
+    rows = []
+    for record_id, old, new in changes:
+        before = set(audience(old)) if old else set()
+        after = set(audience(new)) if new else set()
+        if new is not None and (old is None or _differs(old, new)):
+            rows.extend((p, collection, record_id, UPSERT, now) for p in sorted(after))
+        rows.extend((p, collection, record_id, DELETE, now) for p in sorted(before - after))
+    conn.executemany("""
+        INSERT INTO change_log (principal, collection, record_id, op, changed_at) VALUES (?, ?, ?, ?, ?)
+    """, [row for row in rows if row[0]])
+    return len(rows)
+
+
+def current_cursor(conn):
+    """The newest seq; a full sync taken after reading it is complete up to here."""
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'").fetchone()
+    return row[0] if row else 0
+
+
+def changes_since(conn, principal, cursor, limit=500):
+    """What changed for principal after cursor.
+
+    Returns (changes, next_cursor, more, reset). ``changes`` has one
+    (collection, record_id, op) per record, its latest op. ``reset`` means
+    the cursor is too old (or unknown) and the client must do a full sync.
+    """
+    latest = current_cursor(conn)
+    oldest = conn.execute("SELECT MIN(seq) FROM change_log").fetchone()[0]
+    oldest = oldest if oldest is not None else latest + 1
+    if not oldest - 1 <= cursor <= latest:
+        return [], latest, False, True
+    rows = conn.execute("""
+        SELECT seq, collection, record_id, op FROM change_log
+        WHERE principal = ? AND seq > ?
+        ORDER BY seq LIMIT ?
+    """, (principal, cursor, limit + 1)).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    # Only the latest op per record, in the order of their last change
+    latest_op = {}
+    for seq, collection, record_id, op in rows:
+        latest_op.pop((collection, record_id), None)
+        latest_op[(collection, record_id)] = op
+    next_cursor = rows[-1][0] if more else max(latest, rows[-1][0] if rows else 0)
+    return [(c, rid, op) for (c, rid), op in latest_op.items()], next_cursor, more, False
+
+
+def prune(conn, max_age_seconds):
+    """Drop rows older than max_age_seconds and commit. Returns the number removed."""
+    row = conn.execute("SELECT MAX(seq) FROM change_log WHERE changed_at < ?",
+                       (time.time() - max_age_seconds,)).fetchone()
+    if row[0] is None:
+        return 0
+    cur = conn.execute("DELETE FROM change_log WHERE seq <= ?", (row[0],))
+    conn.commit()
+    return cur.rowcount
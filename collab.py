@@ -0,0 +1,393 @@
+"""Live collaborative editing of shared notes (operational transformation).
+
+An edit travels as a text operation, a list of components that walk over
+the document from the start (the format of ot.js)::
+
+    5        retain 5 characters
+    'abc'    insert 'abc'
+    -2       delete 2 characters
+
+Lengths count Unicode code points; the browser side (static/js/collab.js)
+works on ``Array.from(text)`` to match.
+
+A note being edited has a ``LiveDocument`` in memory: its text, a version
+number and the most recent operations. A client sends an operation
+together with the version it was made against. The server transforms it
+over everything applied since that version, applies it, bumps the version
+and broadcasts the transformed operation to the note's members (as a
+``note.ops`` event on /api/stream, or through the long-poll in app.py).
+Clients transform incoming operations against their own unacknowledged
+edit in the same way, so everybody converges on the same text. Only the
+operation is sent and kept, so traffic scales with the size of the edit.
+
+Several web processes can serve the same note. ``CollabHub`` hands out
+versions through the ``note_ops`` table: an operation is transformed and
+inserted under SQLite's write lock (BEGIN IMMEDIATE), after the process's
+copy of the document has caught up with the rows other processes wrote.
+Long-polls re-read the table every ``poll_interval`` seconds. The table
+only holds operations since the last checkpoint (plus ``history`` more),
+so a document is loaded as the stored text plus the rows after its
+revision, and nothing is lost if a process dies between checkpoints.
+
+``CollabHub`` writes dirty documents back to storage every
+``checkpoint_interval`` seconds instead of on every keystroke, and drops
+documents nobody has touched for ``idle_seconds``.
+"""
+import collections
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from database import DB_PATH
+
+logger = logging.getLogger(__name__)
+
+# Largest note the live editor accepts, in characters
+MAX_LENGTH = 200_000
+
+
+class OperationError(ValueError):
+    """An operation that is malformed or doesn't fit the document."""
+
+
+class StaleVersion(Exception):
+    """The client's version is older than the operations kept in memory."""
+
+
+def _is_count(component):
+    return isinstance(component, int) and not isinstance(component, bool)
+
+
+def _push(op, component):
+    """Append a component, merging it with the previous one of the same kind."""
+    if component == 0 or component == '':
+        return
+    if op:
+        last = op[-1]
+        if isinstance(last, str) and isinstance(component, str):
+            op[-1] = last + component
+            return
+        if _is_count(last) and _is_count(component) and (last > 0) == (component > 0):
+            op[-1] = last + component
+            return
+    op.append(component)
+
+
+def normalize(op):
+    """Validated, compacted copy of an operation."""
+    if not isinstance(op, list):
+        raise OperationError("An operation is a list")
+    normalized = []
+    for component in op:
+        if not (_is_count(component) or isinstance(component, str)):
+            raise OperationError(f"Invalid component {component!r}")
+        _push(normalized, component)
+    return normalized
+
+
+def base_length(op):
+    """Length of the document the operation applies to."""
+    return sum(abs(c) for c in op if _is_count(c))
+
+
+def apply(text, op):
+    if base_length(op) != len(text):
+        raise OperationError(f"Operation is for a text of {base_length(op)} characters, not {len(text)}")
+    parts = []
+    index = 0
+    for component in op:
+        if isinstance(component, str):
+            parts.append(component)
+        elif component > 0:
+            parts.append(text[index:index + component])
+            index += component
+        else:
+            index -= component
+    return ''.join(parts)
+
+
+def transform(a, b):
+    """(a', b') for concurrent a and b, so that b' after a equals a' after b.
+
+    When both insert at the same place, a's text comes first.
+    """
+    a_prime, b_prime = [], []
+    ia, ib = iter(a), iter(b)
+    x, y = next(ia, None), next(ib, None)
+    while x is not None or y is not None:
+        if isinstance(x, str):
+            _push(a_prime, x)
+            _push(b_prime, len(x))
+            x = next(ia, None)
+            continue
+        if isinstance(y, str):
+            _push(a_prime, len(y))
+            _push(b_prime, y)
+            y = next(ib, None)
+            continue
+        if x is None or y is None:
+            raise OperationError("Operations are for texts of different lengths")
+        if x > 0 and y > 0:
+            n = min(x, y)
+            _push(a_prime, n)
+            _push(b_prime, n)
+            x, y = x - n, y - n
+        elif x < 0 and y < 0:
+            # Both deleted the same characters
+            n = min(-x, -y)
+            x, y = x + n, y + n
+        elif x < 0:
+            n = min(-x, y)
+            _push(a_prime, -n)
+            x, y = x + n, y - n
+        else:
+            n = min(x, -y)
+            _push(b_prime, -n)
+            x, y = x - n, y + n
+        if x == 0:
+            x = next(ia, None)
+        if y == 0:
+            y = next(ib, None)
+    return a_prime, b_prime
+
+
+def replace_all(old, new):
+    """The operation turning old into new (common prefix and suffix kept)."""
+    prefix = 0
+    limit = min(len(old), len(new))
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    op = []
+    _push(op, prefix)
+    _push(op, -(len(old) - prefix - suffix))
+    _push(op, new[prefix:len(new) - suffix])
+    _push(op, suffix)
+    return op
+
+
+class LiveDocument:
+    def __init__(self, note_id, text, version=0, history=500):
+        self.note_id = note_id
+        self.text = text
+        self.version = version
+        self.ops = collections.deque(maxlen=history)  # {'version', 'op', 'author', 'client_id'}
+        self.saved_version = version
+        self.last_used = time.monotonic()
+        self.changed = threading.Condition()
+
+    @property
+    def dirty(self):
+        return self.version != self.saved_version
+
+    def prepare(self, base_version, op, author=None, client_id=None):
+        """(text, entry) for an operation made against base_version, not yet applied.
+
+        The caller holds ``changed``.
+        """
+        op = normalize(op)
+        oldest = self.version - len(self.ops)
+        if base_version > self.version:
+            raise OperationError(f"Unknown version {base_version}")
+        if base_version < oldest:
+            raise StaleVersion(base_version)
+        for entry in list(self.ops)[base_version - oldest:]:
+            op, _ = transform(op, entry['op'])
+        text = apply(self.text, op)
+        if len(text) > MAX_LENGTH:
+            raise OperationError("Note is too long")
+        return text, {'version': self.version + 1, 'op': op, 'author': author, 'client_id': client_id}
+
+    def commit(self, text, entry):
+        """Make a prepared entry the current version. The caller holds ``changed``."""
+        self.text = text
+        self.version = entry['version']
+        self.ops.append(entry)
+        self.last_used = time.monotonic()
+        self.changed.notify_all()
+
+    def submit(self, base_version, op, author=None, client_id=None):
+        """Apply an operation made against base_version; returns the applied entry."""
+        with self.changed:
+            self.last_used = time.monotonic()
+            text, entry = self.prepare(base_version, op, author, client_id)
+            self.commit(text, entry)
+            return entry
+
+    def since(self, version, wait=0):
+        """Operations after version, waiting up to wait seconds for one (long-poll)."""
+        with self.changed:
+            self.last_used = time.monotonic()
+            if version == self.version and wait:
+                self.changed.wait_for(lambda: self.version != version, timeout=wait)
+            oldest = self.version - len(self.ops)
+            if not oldest <= version <= self.version:
+                raise StaleVersion(version)
+            return list(self.ops)[version - oldest:]
+
+    def snapshot(self):
+        with self.changed:
+            return self.text, self.version
+
+
+class CollabHub:
+    """The live documents of this process, kept in step through ``note_ops``.
+
+    ``load(note_id)`` returns ``(text, version)`` or None; ``save(note_id,
+    text, version)`` writes a checkpoint and must not replace a newer one.
+    """
+
+    def __init__(self, load, save, path=DB_PATH, checkpoint_interval=10, idle_seconds=300,
+                 history=500, poll_interval=0.5):
+        self.load = load
+        self.save = save
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        self.idle_seconds = idle_seconds
+        self.history = history
+        self.poll_interval = poll_interval
+        self._documents = {}
+        self._lock = threading.Lock()
+        self._conn = None
+        self._db_lock = threading.Lock()
+        self._thread = None
+        self._stats = {'ops': 0, 'checkpoints': 0, 'reloads': 0}
+
+    def _connection(self):
+        # Under self._db_lock; autocommit, transactions are explicit
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+        return self._conn
+
+    def _reload(self, doc):
+        loaded = self.load(doc.note_id)
+        text, version = loaded if loaded is not None else ('', 0)
+        doc.text, doc.version, doc.saved_version = text, version, version
+        doc.ops.clear()
+        with self._lock:
+            self._stats['reloads'] += 1
+
+    def _catch_up(self, doc, conn):
+        """Apply the operations other processes added. Holds doc.changed and self._db_lock."""
+        for attempt in range(2):
+            rows = conn.execute("""
+                SELECT version, op, author, client_id FROM note_ops WHERE note_id = ? AND version > ? ORDER BY version
+            """, (doc.note_id, doc.version)).fetchall()
+            if rows and rows[0][0] != doc.version + 1:
+                # Pruned past us after a checkpoint elsewhere: start from the stored text
+                self._reload(doc)
+                continue
+            for version, op, author, client_id in rows:
+                op = json.loads(op)
+                doc.commit(apply(doc.text, op),
+                           {'version': version, 'op': op, 'author': author, 'client_id': client_id})
+            return
+
+    def document(self, note_id):
+        with self._lock:
+            doc = self._documents.get(note_id)
+            if doc is None:
+                loaded = self.load(note_id)
+                if loaded is None:
+                    return None
+                doc = self._documents[note_id] = LiveDocument(note_id, *loaded, history=self.history)
+            doc.last_used = time.monotonic()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._checkpoint_loop, name='note-checkpoints', daemon=True)
+                self._thread.start()
+        return doc
+
+    def snapshot(self, note_id):
+        """Current (text, version) of a note, or None."""
+        doc = self.document(note_id)
+        if doc is None:
+            return None
+        with doc.changed:
+            with self._db_lock:
+                self._catch_up(doc, self._connection())
+            return doc.text, doc.version
+
+    def submit(self, note_id, base_version, op, author=None, client_id=None):
+        """Apply an operation for every process; returns the applied entry."""
+        doc = self.document(note_id)
+        if doc is None:
+            return None
+        with doc.changed:
+            doc.last_used = time.monotonic()
+            with self._db_lock:
+                conn = self._connection()
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    self._catch_up(doc, conn)
+                    text, entry = doc.prepare(base_version, op, author, client_id)
+                    conn.execute("""
+                        INSERT INTO note_ops (note_id, version, op, author, client_id, created_at)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    """, (note_id, entry['version'], json.dumps(entry['op']), author, client_id, time.time()))
+                    conn.execute('COMMIT')
+                except BaseException:
+                    conn.execute('ROLLBACK')
+                    raise
+            doc.commit(text, entry)
+        with self._lock:
+            self._stats['ops'] += 1
+        return entry
+
+    def since(self, note_id, version, wait=0):
+        """Operations after version, waiting up to wait seconds for one (long-poll)."""
+        doc = self.document(note_id)
+        if doc is None:
+            return None
+        deadline = time.monotonic() + wait
+        with doc.changed:
+            while True:
+                with self._db_lock:
+                    self._catch_up(doc, self._connection())
+                remaining = deadline - time.monotonic()
+                if doc.version != version or remaining <= 0:
+                    return doc.since(version)
+                # Woken at once by a local submit; other processes' rows show up on the next read
+                doc.changed.wait(min(self.poll_interval, remaining))
+
+    def checkpoint(self, note_id=None):
+        """Save dirty documents (or just note_id) and forget idle ones."""
+        with self._lock:
+            docs = [d for d in self._documents.values() if note_id in (None, d.note_id)]
+        for doc in docs:
+            text, version = doc.snapshot()
+            if version != doc.saved_version:
+                try:
+                    self.save(doc.note_id, text, version)
+                    with self._db_lock:
+                        # Keep some history for clients and processes that are a little behind
+                        self._connection().execute("DELETE FROM note_ops WHERE note_id = ? AND version <= ?",
+                                                   (doc.note_id, version - self.history))
+                except Exception as e:
+                    logger.error(f"Checkpoint of note {doc.note_id} failed: {e}")
+                    continue
+                doc.saved_version = version
+                with self._lock:
+                    self._stats['checkpoints'] += 1
+        idle_before = time.monotonic() - self.idle_seconds
+        with self._lock:
+            for doc in docs:
+                if not doc.dirty and doc.last_used < idle_before:
+                    self._documents.pop(doc.note_id, None)
+
+    def _checkpoint_loop(self):
+        while True:
+            time.sleep(self.checkpoint_interval)
+            try:
+                self.checkpoint()
+            except Exception as e:
+                logger.error(f"Note checkpoints failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, documents=len(self._documents),
+                        dirty=sum(d.dirty for d in self._documents.values()))
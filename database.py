@@ -0,0 +1,100 @@
+"""SQLite connection pool for SmartReminder.
+
+Opening a connection and applying pragmas for every helper call is
+wasteful; the pool keeps a handful of configured connections per process
+and hands them out again. app.get_db_connection() pins one connection to
+``flask.g`` for the lifetime of a request (or app context), so all helpers
+used while rendering a page share it.
+"""
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.environ.get('DATABASE_PATH', 'smartreminder.db')
+
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout={busy_timeout_ms}',
+    'PRAGMA cache_size=-{cache_size_kib}',  # negative = KiB instead of pages
+)
+
+
+class ConnectionPool:
+    def __init__(self, path=DB_PATH, max_idle=8, busy_timeout_ms=5000, cache_size_kib=8192):
+        self.path = path
+        self.max_idle = max_idle
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cache_size_kib = cache_size_kib
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        # reused: handed out again from the idle list
+        # shared: served from flask.g without touching the pool at all
+        self._stats = {'created': 0, 'reused': 0, 'shared': 0, 'released': 0, 'closed': 0, 'in_use': 0}
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            conn.execute(pragma.format(busy_timeout_ms=self.busy_timeout_ms,
+                                       cache_size_kib=self.cache_size_kib))
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            if os.getpid() != self._pid:
+                # Forked (e.g. gunicorn --preload): never share the parent's connections
+                self._idle = []
+                self._pid = os.getpid()
+            conn = self._idle.pop() if self._idle else None
+            self._stats['in_use'] += 1
+            if conn is not None:
+                self._stats['reused'] += 1
+                return conn
+        try:
+            conn = self._connect()
+        except sqlite3.Error:
+            with self._lock:
+                self._stats['in_use'] -= 1
+            raise
+        with self._lock:
+            self._stats['created'] += 1
+        return conn
+
+    def record_shared(self):
+        with self._lock:
+            self._stats['shared'] += 1
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error as e:
+            logger.warning(f"Discarding broken database connection: {e}")
+            conn = None
+        with self._lock:
+            self._stats['in_use'] -= 1
+            self._stats['released'] += 1
+            if conn is not None and len(self._idle) < self.max_idle and os.getpid() == self._pid:
+                self._idle.append(conn)
+                return
+            self._stats['closed'] += 1
+        if conn is not None:
+            conn.close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._stats['closed'] += len(idle)
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+        return stats
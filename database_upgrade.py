@@ -1,109 +1,415 @@
-import sqlite3
+"""Versioned schema migrations for the SmartReminder SQLite database.
+
+Migrations are applied in order and recorded in the ``schema_version``
+table, each in its own transaction, so running this twice is a no-op and
+a failing migration stops the run instead of being half-applied. Run it at
+deploy time (entrypoint.sh does), not on import:
+
+    python database_upgrade.py            # apply pending migrations
+    python database_upgrade.py --status   # show applied/pending versions
+"""
+import argparse
 import logging
+import sqlite3
+import sys
+
+from database import DB_PATH
+from timekeys import stamp_sql_reminders
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def upgrade_database():
-    # Database connection
-    conn = sqlite3.connect('smartreminder.db')
-    
-    cursor = conn.cursor()
-    
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _add_columns(conn, table, columns):
+    """ALTER TABLE ... ADD COLUMN for each column that is not there yet."""
+    existing = _columns(conn, table)
+    for name, ddl in columns:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}")
+            logger.info(f"Added column {table}.{name}")
+
+
+def _dedupe(conn, table, key_columns):
+    """Keep the newest row per key so a unique index can be created."""
+    keys = ', '.join(key_columns)
+    conn.execute(f"""
+        DELETE FROM {table} WHERE rowid NOT IN (
+            SELECT MAX(rowid) FROM {table} GROUP BY {keys}
+        )
+    """)
+
+
+def base_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            app_mode TEXT DEFAULT 'DEFAULT',
+            notification_advance INTEGER DEFAULT 30,
+            email_notifications INTEGER DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS reminders (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            title TEXT NOT NULL,
+            description TEXT,
+            date TIMESTAMP,
+            due_date TIMESTAMP,
+            category TEXT DEFAULT 'general',
+            priority TEXT DEFAULT 'medium',
+            completed INTEGER DEFAULT 0,
+            notification_sent INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS notes (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            title TEXT NOT NULL,
+            content TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_statistics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            date DATE DEFAULT CURRENT_DATE,
+            reminders_completed INTEGER DEFAULT 0,
+            focus_sessions_completed INTEGER DEFAULT 0,
+            total_focus_time INTEGER DEFAULT 0,
+            streak_days INTEGER DEFAULT 0,
+            profile_type TEXT,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_profiles (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            profile_type TEXT DEFAULT 'standard',
+            preferences TEXT DEFAULT '{"notifications": true, "daily_goal": 5}',
+            accessibility_settings TEXT DEFAULT '{}',
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS focus_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            session_type TEXT DEFAULT 'pomodoro',
+            duration_minutes INTEGER,
+            started_at TIMESTAMP,
+            completed_at TIMESTAMP,
+            completed INTEGER DEFAULT 0,
+            notes TEXT,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    """)
+
+
+def columns_used_by_app(conn):
+    # Databases created by older scripts miss some of the columns app.py reads
+    _add_columns(conn, 'users', [
+        ('app_mode', "TEXT DEFAULT 'DEFAULT'"),
+        ('notification_advance', 'INTEGER DEFAULT 30'),
+        ('email_notifications', 'INTEGER DEFAULT 1'),
+    ])
+    _add_columns(conn, 'reminders', [
+        ('date', 'TIMESTAMP'),
+        ('due_date', 'TIMESTAMP'),
+        ('category', "TEXT DEFAULT 'general'"),
+        ('priority', "TEXT DEFAULT 'medium'"),
+        ('completed', 'INTEGER DEFAULT 0'),
+        ('notification_sent', 'INTEGER DEFAULT 0'),
+        ('difficulty_level', 'INTEGER DEFAULT 1'),
+        ('estimated_duration', 'INTEGER DEFAULT 15'),
+        ('energy_level', "TEXT DEFAULT 'medium'"),
+        ('context_tags', 'TEXT'),
+    ])
+    _add_columns(conn, 'user_statistics', [
+        ('points', 'INTEGER DEFAULT 0'),
+    ])
+
+
+def hot_path_indexes(conn):
+    # get_user_reminders / calculate_user_stats
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reminders_user_due ON reminders (user_id, due_date)")
+    # load_pending_sql_reminders (was check_reminders_for_notifications)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_reminders_pending_notification
+        ON reminders (completed, notification_sent, date)
+    """)
+    # get_user_profile; also what the unique index needs to be valid
+    _dedupe(conn, 'user_profiles', ['user_id'])
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_user_profiles_user ON user_profiles (user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_focus_sessions_user_started ON focus_sessions (user_id, started_at)")
+    # award_points upserts ON CONFLICT (user_id, date)
+    _dedupe(conn, 'user_statistics', ['user_id', 'date'])
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_user_statistics_user_date ON user_statistics (user_id, date)")
+
+
+def leases(conn):
+    # Leader election for worker.py: one row per lease, owned by holder until
+    # expires_at (unix time); the holder keeps pushing expires_at forward
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            acquired_at REAL NOT NULL
+        )
+    """)
+
+
+def outbox(conn):
+    # Durable e-mail queue drained by outbox.OutboxSender in worker.py
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            priority INTEGER NOT NULL DEFAULT 10,
+            recipients TEXT NOT NULL,
+            sender TEXT,
+            subject TEXT NOT NULL,
+            html TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            claimed_until REAL,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            sent_at REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_claim ON outbox (status, priority, next_attempt_at)")
+
+
+def worker_stats(conn):
+    # Latest stats published by the scheduler leader, read by /health
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS worker_stats (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            stats TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+
+
+def reminder_due_ts(conn):
+    # Canonical due time as UTC epoch seconds plus the zone of the local
+    # date string (see timekeys.py); queries compare due_ts, not TEXT dates
+    _add_columns(conn, 'reminders', [
+        ('due_ts', 'INTEGER'),
+        ('timezone', 'TEXT'),
+    ])
+    stamped = stamp_sql_reminders(conn)
+    logger.info(f"Backfilled due_ts for {stamped} reminders")
+    # Editing a date clears due_ts; stamp_sql_reminders fills it in again
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS reminders_due_ts_stale
+        AFTER UPDATE OF date, due_date ON reminders
+        BEGIN
+            UPDATE reminders SET due_ts = NULL WHERE id = NEW.id;
+        END
+    """)
+    conn.execute("DROP INDEX IF EXISTS idx_reminders_pending_notification")
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_reminders_pending_due
+        ON reminders (completed, notification_sent, due_ts)
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reminders_user_due_ts ON reminders (user_id, due_ts)")
+
+
+def dispatcher_state(conn):
+    # High-water mark of dispatcher.py, for catching up after a restart
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS dispatcher_state (
+            name TEXT PRIMARY KEY,
+            high_water REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+
+
+def notification_claims(conn):
+    # Dispatch partitions in worker.py claim a reminder before notifying it;
+    # notification_sent is only set by the holder of the claim token
+    _add_columns(conn, 'reminders', [
+        ('claim_token', 'TEXT'),
+        ('claim_until', 'REAL'),
+    ])
+    _add_columns(conn, 'outbox', [
+        ('dedupe_key', 'TEXT'),
+    ])
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_outbox_dedupe ON outbox (dedupe_key)")
+
+
+def change_log(conn):
+    # Change sequence with tombstones for /api/sync (see changes.py)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            principal TEXT NOT NULL,
+            collection TEXT NOT NULL,
+            record_id TEXT NOT NULL,
+            op TEXT NOT NULL,
+            changed_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_change_log_principal_seq ON change_log (principal, seq)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_change_log_changed_at ON change_log (changed_at)")
+
+
+def note_messages(conn):
+    # Chat of shared notes as an append-only log (see note_messages.py)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS note_messages (
+            note_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            sender TEXT,
+            content TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (note_id, seq)
+        ) WITHOUT ROWID
+    """)
+
+
+def live_events(conn):
+    # Live-update events for /api/stream, shared by all web processes (see events.py)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS events (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT NOT NULL,
+            type TEXT NOT NULL,
+            data TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_channel_seq ON events (channel, seq)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_created_at ON events (created_at)")
+
+
+def note_ops(conn):
+    # Operations of live-edited notes since their last checkpoint (see collab.py)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS note_ops (
+            note_id TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            author TEXT,
+            client_id TEXT,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (note_id, version)
+        ) WITHOUT ROWID
+    """)
+
+
+# (version, description, function). Append only; never renumber or edit an
+# applied migration, add a new one instead.
+MIGRATIONS = [
+    (1, 'base schema', base_schema),
+    (2, 'columns used by app.py', columns_used_by_app),
+    (3, 'hot-path indexes', hot_path_indexes),
+    (4, 'leases', leases),
+    (5, 'e-mail outbox', outbox),
+    (6, 'worker stats', worker_stats),
+    (7, 'reminder due_ts and timezone', reminder_due_ts),
+    (8, 'dispatcher high-water mark', dispatcher_state),
+    (9, 'notification claims', notification_claims),
+    (10, 'change log for delta sync', change_log),
+    (11, 'note chat messages', note_messages),
+    (12, 'live update events', live_events),
+    (13, 'live note operations', note_ops),
+]
+
+
+def _ensure_version_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.commit()
+
+
+def current_version(conn):
+    _ensure_version_table(conn)
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def run_migrations(conn):
+    """Apply all pending migrations. Returns the list of versions applied."""
+    _ensure_version_table(conn)
+    applied = []
+    for version, description, migrate in MIGRATIONS:
+        # BEGIN IMMEDIATE serializes concurrent deploys; re-check inside it
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            done = conn.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,)).fetchone()
+            if done:
+                conn.rollback()
+                continue
+            migrate(conn)
+            conn.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                         (version, description))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.error(f"Migration {version} ({description}) failed")
+            raise
+        logger.info(f"Applied migration {version}: {description}")
+        applied.append(version)
+    return applied
+
+
+def upgrade_database(path=DB_PATH):
+    conn = sqlite3.connect(path)
     try:
-        # SQL kommandoer for SQLite
-        sql_commands = [
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                id TEXT PRIMARY KEY,
-                username TEXT NOT NULL,
-                email TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                app_mode TEXT DEFAULT 'DEFAULT',
-                notification_advance INTEGER DEFAULT 30,
-                email_notifications INTEGER DEFAULT 1,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-            """,
-            """
-            CREATE TABLE IF NOT EXISTS reminders (
-                id TEXT PRIMARY KEY,
-                user_id TEXT NOT NULL,
-                title TEXT NOT NULL,
-                description TEXT,
-                date TIMESTAMP NOT NULL,
-                completed INTEGER DEFAULT 0,
-                notification_sent INTEGER DEFAULT 0,
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            );
-            """,
-            """
-            CREATE TABLE IF NOT EXISTS notes (
-                id TEXT PRIMARY KEY,
-                user_id TEXT NOT NULL,
-                title TEXT NOT NULL,
-                content TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            );
-            """,
-            """
-            CREATE TABLE IF NOT EXISTS user_statistics (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                date DATE DEFAULT CURRENT_DATE,
-                reminders_completed INTEGER DEFAULT 0,
-                focus_sessions_completed INTEGER DEFAULT 0,
-                total_focus_time INTEGER DEFAULT 0,
-                streak_days INTEGER DEFAULT 0,
-                profile_type TEXT,
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            );
-            """,
-            """
-            CREATE TABLE IF NOT EXISTS user_profiles (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                profile_type TEXT DEFAULT 'standard',
-                preferences TEXT DEFAULT '{"notifications": true, "daily_goal": 5}',
-                accessibility_settings TEXT DEFAULT '{}',
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            );
-            """
-        ]
-        
-        # Kjør hver kommando
-        for command in sql_commands:
-            cursor.execute(command)
-            print(f"✅ Executed: {command[:50]}...")
-        
-        # Legg til kolonner i reminders (med error handling)
-        alter_commands = [
-            "ALTER TABLE reminders ADD COLUMN difficulty_level INTEGER DEFAULT 1;",
-            "ALTER TABLE reminders ADD COLUMN estimated_duration INTEGER DEFAULT 15;",
-            "ALTER TABLE reminders ADD COLUMN energy_level TEXT DEFAULT 'medium';",
-            "ALTER TABLE reminders ADD COLUMN context_tags TEXT;"
-        ]
-        alter_commands.append("ALTER TABLE user_statistics ADD COLUMN points INTEGER DEFAULT 0;")
-        
-        for command in alter_commands:
-            try:
-                cursor.execute(command)
-                print(f"✅ Added column: {command}")
-            except sqlite3.OperationalError as e:
-                print(f"⚠️ Column might already exist: {e}")
-        
-        conn.commit()
-        print("🎉 Database upgrade completed successfully!")
-        
-    except Exception as e:
-        conn.rollback()
-        print(f"❌ Error: {e}")
+        applied = run_migrations(conn)
+        print(f"Database at version {current_version(conn)} ({len(applied)} migration(s) applied)")
+        return applied
+    finally:
+        conn.close()
+
+
+def print_status(path=DB_PATH):
+    conn = sqlite3.connect(path)
+    try:
+        _ensure_version_table(conn)
+        applied = {row[0]: row[1] for row in conn.execute("SELECT version, applied_at FROM schema_version")}
+        for version, description, _ in MIGRATIONS:
+            state = f"applied {applied[version]}" if version in applied else "pending"
+            print(f"{version:>4}  {description:<30} {state}")
     finally:
-        cursor.close()
         conn.close()
 
 
 if __name__ == "__main__":
-    upgrade_database()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Apply SmartReminder database migrations")
+    parser.add_argument('--status', action='store_true', help="list migrations and exit")
+    args = parser.parse_args()
+    try:
+        if args.status:
+            print_status()
+        else:
+            upgrade_database()
+    except Exception as e:
+        print(f"❌ Migration failed: {e}")
+        sys.exit(1)
@@ -0,0 +1,375 @@
+"""Due-reminder dispatcher for worker.py.
+
+Instead of rescanning every reminder on a 15-minute timer, the dispatcher
+keeps the instants at which notifications are due in a heap. It is filled
+once on start and then maintained incrementally through
+``DataManager.watch``: adding, completing or deleting a reminder (in this
+process or, after ``refresh``, in a web worker) just pushes or invalidates
+one heap entry. The thread sleeps until the earliest entry is due, waking
+every ``refresh_interval`` seconds only to stat() the reminder files for
+changes made by other processes.
+
+When a notification falls due, the recipient's other reminders that fall
+due within their coalescing window (``coalesce(email)`` minutes) are
+pulled forward and handed to ``notify`` in the same batch, so they can go
+out as one digest instead of one e-mail each.
+
+A recurring reminder (recurrence.py) has one heap entry, for its next
+occurrence, however long the series is.
+
+Progress is persisted as a high-water mark (``HighWaterMark``): every
+notification due before it has been handled. After a restart, reminders
+that fell due while no dispatcher was running (deploys, crashes) are
+notified late instead of skipped, at most ``catchup_batch`` per
+``catchup_pause`` seconds and no further back than ``catchup_max_age``.
+
+With ``partition=(k, K)`` a dispatcher only handles recipients whose
+``partition_of(email, K)`` is k, so worker.py can spread the reminders
+over several processes. Sending is guarded by a claim on the reminder
+(``claim_token``/``claim_until``, see app.send_reminder_notifications);
+a reminder claimed by someone else is looked at again when the claim
+expires.
+
+Heap entries are never removed in place; an entry is stale when
+``_scheduled`` no longer points at its sequence number, and is skipped when
+popped.
+"""
+import heapq
+import itertools
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+
+import recurrence
+import timekeys
+from database import DB_PATH
+
+logger = logging.getLogger(__name__)
+
+SQL_SOURCE = 'sqlite'
+RETRY_DELAY = 60  # seconds before a failed notification is tried again
+
+
+def partition_of(key, count):
+    """Stable partition number of a recipient (the same in every process)."""
+    return zlib.crc32(str(key).lower().encode('utf-8')) % count if count > 1 else 0
+
+
+class HighWaterMark:
+    """Dispatcher progress (epoch seconds) in the dispatcher_state table."""
+
+    def __init__(self, name='reminders', path=DB_PATH):
+        self.name = name
+        self.path = path
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+        return self._conn
+
+    def load(self):
+        try:
+            row = self._connection().execute(
+                "SELECT high_water FROM dispatcher_state WHERE name = ?", (self.name,)).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Could not read dispatcher high-water mark: {e}")
+            return None
+        return row[0] if row else None
+
+    def save(self, value):
+        try:
+            conn = self._connection()
+            with conn:
+                # Never move backwards, even if two dispatchers overlap briefly
+                conn.execute("""
+                    INSERT INTO dispatcher_state (name, high_water, updated_at) VALUES (?, ?, ?)
+                    ON CONFLICT (name) DO UPDATE SET
+                        high_water = MAX(high_water, excluded.high_water),
+                        updated_at = excluded.updated_at
+                """, (self.name, value, time.time()))
+        except sqlite3.Error as e:
+            logger.error(f"Could not save dispatcher high-water mark: {e}")
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class ReminderDispatcher:
+    def __init__(self, dm, notify, advance_minutes=30, refresh_interval=5, sql_source=None, coalesce=None,
+                 high_water=None, catchup_batch=100, catchup_pause=1.0, catchup_max_age=24 * 3600,
+                 partition=None, sql_resync_interval=900):
+        self.dm = dm
+        # notify(items) sends the notifications and returns the items that failed
+        self.notify = notify
+        self.advance_minutes = advance_minutes
+        self.refresh_interval = refresh_interval
+        # Optional callable returning pending rows of the SQLite reminders table
+        self.sql_source = sql_source
+        self.sql_resync_interval = sql_resync_interval
+        # Optional callable: recipient email -> coalescing window in minutes
+        self.coalesce = coalesce
+        # (k, K): only reminders whose recipient hashes to partition k
+        self.partition = partition
+        # Optional HighWaterMark; without it nothing missed before start is caught up
+        self.high_water = high_water
+        self.catchup_batch = catchup_batch
+        self.catchup_pause = catchup_pause
+        self.catchup_max_age = catchup_max_age
+        self._mark = None
+        self._saved_mark = None
+        self._lock = threading.Lock()
+        self._heap = []  # (notify_at, seq, reminder_id)
+        self._scheduled = {}  # {reminder_id: (seq, item)}
+        self._by_source = {}  # {collection file: {reminder_id, ...}}
+        self._by_recipient = {}  # {email: {reminder_id, ...}}
+        self._seq = itertools.count()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {'dispatched': 0, 'failed': 0, 'missed': 0, 'late': 0, 'stale': 0, 'wakeups': 0,
+                       'coalesced': 0}
+
+    # -- Queue maintenance ------------------------------------------------
+
+    def _item(self, reminder_id, record, source):
+        """What the notifier needs, or None if nothing should be sent."""
+        if not record or record.get('completed'):
+            return None
+        if self.partition is not None and partition_of(record.get('user_id'), self.partition[1]) != self.partition[0]:
+            return None
+        occurrence = None
+        if recurrence.is_recurring(record):
+            # Only the series' next occurrence is queued; marking it notified
+            # (last_notified) comes back through the watcher and queues the one after
+            upcoming = recurrence.notify_occurrence(record)
+            if upcoming is None:
+                return None
+            occurrence = recurrence.format_occurrence(upcoming)
+            due_at = timekeys.to_epoch(upcoming, record.get('timezone'))
+        elif record.get('notification_sent'):
+            return None
+        else:
+            # due_ts is written with the record (timekeys.stamp); no parsing here
+            due_at = timekeys.due_ts(record)
+        if due_at is None:
+            return None
+        advance = record.get('notification_advance') or self.advance_minutes
+        notify_at = due_at - advance * 60
+        claimed_until = record.get('claim_until') or 0
+        if claimed_until > notify_at:
+            # A send is (or was) in progress; if it never marks the reminder
+            # as sent, try again once its claim has expired
+            notify_at = claimed_until
+        return {
+            'id': reminder_id,
+            'source': source,
+            'title': record.get('title'),
+            'description': record.get('description'),
+            'priority': record.get('priority'),
+            'datetime': occurrence or record.get('datetime'),
+            'occurrence': occurrence,
+            'email': record.get('user_id'),
+            'due_at': due_at,
+            'notify_at': notify_at,
+            'retry': claimed_until > time.time() - self.catchup_max_age,
+        }
+
+    def _unschedule(self, reminder_id):
+        scheduled = self._scheduled.pop(reminder_id, None)
+        if scheduled is not None:
+            self._by_source.get(scheduled[1]['source'], set()).discard(reminder_id)
+            ids = self._by_recipient.get(scheduled[1]['email'])
+            if ids is not None:
+                ids.discard(reminder_id)
+                if not ids:
+                    del self._by_recipient[scheduled[1]['email']]
+
+    def _schedule(self, item, notify_at=None):
+        self._unschedule(item['id'])
+        seq = next(self._seq)
+        self._scheduled[item['id']] = (seq, item)
+        self._by_source.setdefault(item['source'], set()).add(item['id'])
+        self._by_recipient.setdefault(item['email'], set()).add(item['id'])
+        heapq.heappush(self._heap, (notify_at or item['notify_at'], seq, item['id']))
+        # Don't let dead entries pile up when reminders are edited a lot
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._scheduled):
+            self._heap = [(at, seq, rid) for at, seq, rid in self._heap
+                          if self._scheduled.get(rid, (None,))[0] == seq]
+            heapq.heapify(self._heap)
+        return self._heap[0][2] == item['id']
+
+    def _on_change(self, source, changes, reset):
+        """DataManager watcher; also used for the SQLite source."""
+        earlier = False
+        with self._lock:
+            if reset:
+                for reminder_id in list(self._by_source.get(source, ())):
+                    self._unschedule(reminder_id)
+            for reminder_id, record in changes:
+                item = self._item(reminder_id, record, source)
+                if item is None:
+                    self._unschedule(reminder_id)
+                else:
+                    earlier = self._schedule(item) or earlier
+        if earlier:
+            self._wakeup.set()
+
+    def resync_sql(self):
+        """Reload pending rows from the SQLite reminders table.
+
+        app.py writes reminders to the JSON store; the table is only fed by
+        imports and older deployments, so it is re-read on a slow timer
+        (``sql_resync_interval``).
+        """
+        if self.sql_source is None:
+            return
+        rows = self.sql_source(self._mark)
+        if rows is not None:
+            self._on_change(SQL_SOURCE, [(row['id'], row) for row in rows], True)
+
+    def _pop_due(self, now, limit):
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now and len(due) < limit:
+                _, seq, reminder_id = heapq.heappop(self._heap)
+                scheduled = self._scheduled.get(reminder_id)
+                if scheduled is None or scheduled[0] != seq:
+                    self._stats['stale'] += 1
+                    continue
+                self._unschedule(reminder_id)
+                item = scheduled[1]
+                if item['due_at'] <= now:
+                    # Fell due while nobody was dispatching: catch up if that
+                    # was after the high-water mark, otherwise it's too late
+                    # (or the date was already past when it was written)
+                    if not item.get('retry') and (self._mark is None or item['due_at'] < self._mark):
+                        self._stats['missed'] += 1
+                        continue
+                    self._stats['late'] += 1
+                due.append(item)
+        return due
+
+    def _advance_mark(self, now, force=False):
+        """Move the high-water mark up to the oldest notification still pending."""
+        next_at = self.next_at()
+        mark = now if next_at is None else min(now, next_at)
+        self._mark = mark if self._mark is None else max(self._mark, mark)
+        if self.high_water is not None and (force or self._saved_mark is None
+                                            or self._mark - self._saved_mark >= self.refresh_interval):
+            self.high_water.save(self._mark)
+            self._saved_mark = self._mark
+
+    def _pull_forward(self, due, now):
+        """Add each recipient's reminders due within their coalescing window."""
+        if self.coalesce is None or not due:
+            return due
+        windows = {}
+        for email in {item['email'] for item in due}:
+            try:
+                windows[email] = self.coalesce(email)
+            except Exception as e:
+                logger.error(f"Could not get coalescing window for {email}: {e}")
+        with self._lock:
+            for email, minutes in windows.items():
+                horizon = now + minutes * 60
+                for reminder_id in list(self._by_recipient.get(email, ())):
+                    item = self._scheduled[reminder_id][1]
+                    if item['notify_at'] <= horizon:
+                        self._unschedule(reminder_id)
+                        due.append(item)
+                        self._stats['coalesced'] += 1
+        return due
+
+    def next_at(self):
+        with self._lock:
+            while self._heap and self._scheduled.get(self._heap[0][2], (None,))[0] != self._heap[0][1]:
+                heapq.heappop(self._heap)
+                self._stats['stale'] += 1
+            return self._heap[0][0] if self._heap else None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['scheduled'] = len(self._scheduled)
+            stats['heap'] = len(self._heap)
+        stats['high_water'] = self._mark
+        stats['next_at'] = self.next_at()
+        return stats
+
+    # -- Thread -----------------------------------------------------------
+
+    def _dispatch(self, items):
+        try:
+            failed = self.notify(items) or []
+        except Exception as e:
+            logger.error(f"Dispatching {len(items)} reminder notification(s) failed: {e}")
+            failed = items
+        retry_at = time.time() + RETRY_DELAY
+        with self._lock:
+            self._stats['dispatched'] += len(items) - len(failed)
+            self._stats['failed'] += len(failed)
+            for item in failed:
+                # Late is better than never, within the catch-up limit
+                if item['due_at'] > retry_at - self.catchup_max_age and item['id'] not in self._scheduled:
+                    self._schedule(dict(item, retry=True), notify_at=retry_at)
+
+    def run(self):
+        started = time.time()
+        saved = self.high_water.load() if self.high_water is not None else None
+        self._mark = max(saved, started - self.catchup_max_age) if saved is not None else started
+        self._saved_mark = None
+        self.dm.watch('reminders', self._on_change)
+        try:
+            self.dm.refresh('reminders')
+            self.resync_sql()
+            self._wakeup.clear()  # set by the initial load; the loop looks at the heap anyway
+            logger.info(f"Dispatcher started with {len(self._scheduled)} pending notification(s), "
+                        f"high-water mark {time.ctime(self._mark)}")
+            next_refresh = time.time() + self.refresh_interval
+            next_resync = time.time() + self.sql_resync_interval
+            while not self._stop.is_set():
+                now = time.time()
+                if now >= next_refresh:
+                    self.dm.refresh('reminders')
+                    next_refresh = now + self.refresh_interval
+                if now >= next_resync:
+                    self.resync_sql()
+                    next_resync = now + self.sql_resync_interval
+                due = self._pull_forward(self._pop_due(now, self.catchup_batch), now)
+                if due:
+                    self._dispatch(due)
+                self._advance_mark(now)
+                next_at = self.next_at()
+                if next_at is not None and next_at <= now:
+                    # Backlog (catch-up after downtime): send it in paced batches
+                    wake_at = now + self.catchup_pause
+                else:
+                    wake_at = next_refresh if next_at is None else min(next_at, next_refresh)
+                self._wakeup.wait(max(0.0, wake_at - time.time()))
+                self._wakeup.clear()
+                self._stats['wakeups'] += 1
+        finally:
+            self.dm.unwatch('reminders', self._on_change)
+            if self.high_water is not None:
+                self._advance_mark(time.time(), force=True)
+                self.high_water.close()
+            with self._lock:
+                self._heap, self._scheduled, self._by_source, self._by_recipient = [], {}, {}, {}
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='reminder-dispatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
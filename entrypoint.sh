@@ -6,8 +6,20 @@ if [ -z "$SECRET_KEY" ]; then
     echo "WARNING: Setting a random SECRET_KEY. This will be lost on container restart."
 fi
 
-# Initialize the application with init_db function instead of importing db
-python -c "from app import app, init_db; print('Application initialized')"
+# Apply pending database migrations before any worker starts
+python database_upgrade.py || exit 1
+# JSON reminders from before due_ts existed (no-op once they are stamped)
+flask --app app backfill-due-ts
+# Chat messages still embedded in shared notes (no-op once moved)
+flask --app app migrate-note-messages
+# Shared reminder copies and note member lists into the ACL (no-op once converted)
+flask --app app migrate-sharing
 
-# Start the Flask application with Gunicorn
-exec gunicorn --bind 0.0.0.0:${PORT:-8080} "app:app"
\ No newline at end of file
+# One scheduler per container; replicas elect a leader through the lease table
+(while true; do python worker.py; echo "worker.py exited, restarting in 5s"; sleep 5; done) &
+
+# Start the Flask application with Gunicorn. Live events and note edits go
+# through SQLite (events.py, collab.py), so any number of processes can serve
+# them; open streams and long-polls may only take a share of each process's
+# threads (STREAM_MAX_CONNECTIONS, LIVE_POLL_MAX_CONNECTIONS)
+exec gunicorn --bind 0.0.0.0:${PORT:-8080} --workers ${WEB_CONCURRENCY:-2} --worker-class gthread --threads ${WEB_THREADS:-32} "app:app"
\ No newline at end of file
@@ -0,0 +1,234 @@
+"""Publish/subscribe for live updates (/api/stream).
+
+Write handlers in app.py call ``broker.publish(recipients, type, data)``
+once a change is stored, and every open /api/stream connection of those
+users receives it as a Server-Sent Event. The browser loads its lists
+once and then applies these small deltas instead of polling
+/api/reminders and /api/notes.
+
+Events go through the ``events`` table, one row per recipient, so every
+web process sees them: each process runs one poller thread that reads the
+rows after the last one it has seen (a primary-key range scan, every
+``poll_interval`` seconds or right away after a local publish) and hands
+them to its own subscribers. The row's seq is the event id, so a client
+reconnecting to any process with Last-Event-ID gets what it missed from
+the table. ``prune`` (a worker.py job) drops old rows; a Last-Event-ID
+from before the oldest row gets a ``reset`` event and the client reloads
+everything. The same happens to a client that falls behind and fills its
+bounded queue.
+
+An open stream holds a server thread, so the number of streams per
+process is capped (``Slots``); app.py answers with a short polling
+response instead once the cap is reached.
+"""
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+from database import DB_PATH
+
+logger = logging.getLogger(__name__)
+
+# Ask browsers to wait this long before reconnecting a dropped stream
+RETRY_MILLISECONDS = 5000
+RESET = 'reset'
+
+
+class Subscription:
+    def __init__(self, channel, size):
+        self.channel = channel
+        self.queue = queue.Queue(maxsize=size)
+        # Set when events were lost: the client must reload and reconnect
+        self.reset = False
+
+    def get(self, timeout):
+        """Next event, or None after timeout seconds without one."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Slots:
+    """At most ``limit`` concurrent holders; ``acquire`` never blocks."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._in_use = 0
+        self._rejected = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._in_use >= self.limit:
+                self._rejected += 1
+                return False
+            self._in_use += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._in_use -= 1
+
+    def stats(self):
+        with self._lock:
+            return {'limit': self.limit, 'in_use': self._in_use, 'rejected': self._rejected}
+
+
+def _event(row):
+    seq, event_type, data, created_at = row
+    return {'id': str(seq), 'type': event_type, 'data': json.loads(data), 'ts': int(created_at)}
+
+
+class EventBroker:
+    """Fans out events to the subscriptions of each channel (a user's e-mail)."""
+
+    def __init__(self, path=DB_PATH, queue_size=100, poll_interval=0.5):
+        self.path = path
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+        self._conn = None
+        self._db_lock = threading.Lock()
+        self._subscribers = {}  # {channel: set of Subscription}
+        self._lock = threading.Lock()
+        self._last = None  # newest seq handed to the subscribers
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._stats = {'published': 0, 'delivered': 0, 'resets': 0}
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+        return self._conn
+
+    def _query(self, sql, params=()):
+        with self._db_lock:
+            return self._connection().execute(sql, params).fetchall()
+
+    def _start(self):
+        # Under self._lock
+        if self._thread is None or not self._thread.is_alive():
+            if self._last is None:
+                self._last = self._query("SELECT COALESCE(MAX(seq), 0) FROM events")[0][0]
+            self._thread = threading.Thread(target=self._poll_loop, name='event-poller', daemon=True)
+            self._thread.start()
+
+    def _missed(self, channel, last_event_id, upto):
+        """(events of channel after last_event_id up to seq upto, reset)."""
+        last = int(last_event_id) if str(last_event_id).isdigit() else None
+        oldest = self._query("SELECT MIN(seq) FROM events")[0][0]
+        oldest = oldest if oldest is not None else upto + 1
+        if last is None or not oldest - 1 <= last <= upto:
+            return [], True
+        rows = self._query("""
+            SELECT seq, type, data, created_at FROM events
+            WHERE channel = ? AND seq > ? AND seq <= ? ORDER BY seq LIMIT ?
+        """, (channel, last, upto, self.queue_size + 1))
+        return [_event(row) for row in rows[:self.queue_size]], len(rows) > self.queue_size
+
+    def subscribe(self, channel, last_event_id=None):
+        """Register a subscription, replaying what it missed since last_event_id."""
+        sub = Subscription(channel, self.queue_size)
+        with self._lock:
+            self._start()
+            if last_event_id:
+                # Newer rows come from the poller
+                missed, sub.reset = self._missed(channel, last_event_id, self._last)
+                for event in missed:
+                    sub.queue.put_nowait(event)
+            self._subscribers.setdefault(channel, set()).add(sub)
+        return sub
+
+    def replay(self, channel, last_event_id=None):
+        """What a client missed, without subscribing: (events, reset, newest seq)."""
+        newest = self._query("SELECT COALESCE(MAX(seq), 0) FROM events")[0][0]
+        if not last_event_id:
+            return [], False, newest
+        events, reset = self._missed(channel, last_event_id, newest)
+        return events, reset, newest
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subscribers.get(sub.channel)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._subscribers[sub.channel]
+
+    def publish(self, channels, event_type, data):
+        """Store one event per channel; the pollers deliver them."""
+        channels = sorted({c for c in channels if c})
+        if not channels:
+            return
+        now = time.time()
+        payload = json.dumps(data, default=str)
+        try:
+            with self._db_lock:
+                conn = self._connection()
+                with conn:
+                    conn.executemany("INSERT INTO events (channel, type, data, created_at) VALUES (?, ?, ?, ?)",
+                                     [(channel, event_type, payload, now) for channel in channels])
+        except sqlite3.Error as e:
+            logger.error(f"Could not publish {event_type}: {e}")
+            return
+        with self._lock:
+            self._stats['published'] += len(channels)
+        # Our own subscribers shouldn't wait for the next poll
+        self._wakeup.set()
+
+    def poll(self):
+        """Deliver the rows written since the last poll. Returns how many."""
+        with self._lock:
+            rows = self._query("""
+                SELECT seq, channel, type, data, created_at FROM events WHERE seq > ? ORDER BY seq LIMIT 1000
+            """, (self._last,))
+            for seq, channel, event_type, data, created_at in rows:
+                self._last = seq
+                subs = self._subscribers.get(channel)
+                if not subs:
+                    continue
+                event = _event((seq, event_type, data, created_at))
+                for sub in list(subs):
+                    try:
+                        sub.queue.put_nowait(event)
+                        self._stats['delivered'] += 1
+                    except queue.Full:
+                        # Too slow: drop it rather than let the queue grow
+                        sub.reset = True
+                        self._stats['resets'] += 1
+                        subs.discard(sub)
+                if not subs:
+                    del self._subscribers[channel]
+        return len(rows)
+
+    def _poll_loop(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                while self.poll() == 1000:
+                    pass
+            except sqlite3.Error as e:
+                logger.error(f"Event poller: {e}")
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats,
+                        channels=len(self._subscribers),
+                        subscribers=sum(len(subs) for subs in self._subscribers.values()))
+
+
+def prune(conn, max_age_seconds):
+    """Drop events older than max_age_seconds and commit. Returns the number removed."""
+    cur = conn.execute("DELETE FROM events WHERE created_at < ?", (time.time() - max_age_seconds,))
+    conn.commit()
+    return cur.rowcount
+
+
+def format_sse(event):
+    """An event as a text/event-stream message."""
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'], default=str)}\n\n"
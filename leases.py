@@ -0,0 +1,102 @@
+"""Time-limited leases stored in SQLite, used for leader election.
+
+Every process that wants to run something only once per deployment (the
+reminder scheduler in worker.py) calls ``Lease.try_acquire()`` on a
+heartbeat. The row in the ``leases`` table belongs to whoever wrote it last
+until ``expires_at``; the holder renews it on every heartbeat, and anyone
+else can take it over once the holder has stopped renewing (crashed,
+killed, hung). The claim is a single UPSERT, so two contenders can never
+both win.
+
+The same mechanism splits reminder dispatching into partitions: worker.py
+takes ``dispatch:<k>/<K>`` leases and registers itself with a ``member:``
+lease so the processes can share the partitions evenly.
+"""
+import logging
+import os
+import socket
+import sqlite3
+import time
+import uuid
+
+from database import DB_PATH
+
+logger = logging.getLogger(__name__)
+
+
+def default_holder():
+    """host:pid:random, unique per process and readable in the table."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class Lease:
+    def __init__(self, name, ttl=30, holder=None, path=DB_PATH):
+        self.name = name
+        self.ttl = ttl
+        self.holder = holder or default_holder()
+        self.path = path
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+        return self._conn
+
+    def try_acquire(self):
+        """Take or renew the lease. Returns True while we hold it."""
+        now = time.time()
+        try:
+            conn = self._connection()
+            with conn:
+                conn.execute("""
+                    INSERT INTO leases (name, holder, expires_at, acquired_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (name) DO UPDATE SET
+                        holder = excluded.holder,
+                        expires_at = excluded.expires_at,
+                        acquired_at = CASE WHEN leases.holder = excluded.holder
+                                           THEN leases.acquired_at ELSE excluded.acquired_at END
+                    WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+                """, (self.name, self.holder, now + self.ttl, now, now))
+                row = conn.execute("SELECT holder FROM leases WHERE name = ?", (self.name,)).fetchone()
+        except sqlite3.Error as e:
+            # Can't prove we still hold it, so behave as if we don't
+            logger.error(f"Lease {self.name}: {e}")
+            self.close()
+            return False
+        return row is not None and row[0] == self.holder
+
+    def release(self):
+        """Give the lease up now so another process doesn't wait for the TTL."""
+        try:
+            conn = self._connection()
+            with conn:
+                conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (self.name, self.holder))
+        except sqlite3.Error as e:
+            logger.error(f"Lease {self.name}: could not release: {e}")
+        finally:
+            self.close()
+
+    def current_holder(self):
+        row = self._connection().execute(
+            "SELECT holder, expires_at FROM leases WHERE name = ?", (self.name,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return row[0]
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def live_holders(prefix, path=DB_PATH):
+    """{lease name: holder} for unexpired leases whose name starts with prefix."""
+    conn = sqlite3.connect(path, timeout=5)
+    try:
+        rows = conn.execute("SELECT name, holder FROM leases WHERE name LIKE ? AND expires_at >= ?",
+                            (prefix + '%', time.time())).fetchall()
+    finally:
+        conn.close()
+    return dict(rows)
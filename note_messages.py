@@ -0,0 +1,75 @@
+"""Chat messages of shared notes.
+
+Messages used to be a list inside each note record, so every message
+rewrote the note and the view rendered the whole history. They now live
+in the ``note_messages`` table, an append-only log keyed by
+(note_id, seq), where seq counts 1, 2, 3, ... per note:
+
+- ``post`` is a single INSERT that takes the next seq in the same
+  statement, under SQLite's write lock, so concurrent posts never collide.
+- ``page`` returns the latest messages, or those before a seq cursor for
+  older pages, walking the primary key backwards; a note with 10k
+  messages costs the same to open as one with ten.
+- Messages are never deleted, so ``count`` is the last seq.
+
+``import_embedded`` moves the old embedded lists over (``flask
+migrate-note-messages``).
+"""
+from datetime import datetime
+
+PAGE_SIZE = 50
+
+
+def _message(row):
+    seq, sender, content, created_at = row
+    return {'seq': seq, 'sender': sender, 'content': content, 'timestamp': created_at}
+
+
+def post(conn, note_id, sender, content, created_at=None):
+    """Append a message and commit. Returns it, with its seq."""
+    created_at = created_at or datetime.now().isoformat()
+    conn.execute("""
+        INSERT INTO note_messages (note_id, seq, sender, content, created_at)
+        SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ? FROM note_messages WHERE note_id = ?
+    """, (note_id, sender, content, created_at, note_id))
+    # Still inside the write transaction, so this is the row just inserted
+    seq = count(conn, note_id)
+    conn.commit()
+    return _message((seq, sender, content, created_at))
+
+
+def page(conn, note_id, before=None, limit=PAGE_SIZE):
+    """Up to limit messages before seq ``before`` (default: the latest), oldest first.
+
+    Returns (messages, cursor); pass the cursor as ``before`` for the
+    previous page. It is None when there is nothing older.
+    """
+    rows = conn.execute("""
+        SELECT seq, sender, content, created_at FROM note_messages
+        WHERE note_id = ? AND seq < ?
+        ORDER BY seq DESC LIMIT ?
+    """, (note_id, before if before is not None else 2 ** 62, limit)).fetchall()
+    messages = [_message(row) for row in reversed(rows)]
+    cursor = messages[0]['seq'] if messages and messages[0]['seq'] > 1 else None
+    return messages, cursor
+
+
+def count(conn, note_id):
+    return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM note_messages WHERE note_id = ?",
+                        (note_id,)).fetchone()[0]
+
+
+def import_embedded(conn, note_id, messages):
+    """Copy a note's embedded message list into the log and commit.
+
+    Skipped when the note already has messages in the log (an earlier,
+    interrupted run got this far). Returns the number of messages copied.
+    """
+    if count(conn, note_id):
+        return 0
+    conn.executemany("""
+        INSERT INTO note_messages (note_id, seq, sender, content, created_at) VALUES (?, ?, ?, ?, ?)
+    """, [(note_id, seq, m.get('sender'), m.get('content', ''), m.get('timestamp') or '')
+          for seq, m in enumerate(messages, start=1)])
+    conn.commit()
+    return len(messages)
@@ -0,0 +1,290 @@
+"""Durable e-mail outbox.
+
+Request handlers don't talk to the SMTP server any more: ``enqueue`` stores
+the rendered message in the ``outbox`` table and returns immediately. A
+bounded pool of sender threads in worker.py (``OutboxSender``) claims
+messages in small batches and delivers them. Each thread keeps one SMTP
+session open while there is work (see app.MailSession), so a burst of
+notifications costs one connect/STARTTLS/login per thread instead of one
+per message.
+
+- Priority lanes: lower ``priority`` is sent first, so transactional mail
+  (welcome, shared reminder) overtakes a backlog of reminder notifications.
+- Failed deliveries are retried with exponential backoff and jitter; after
+  ``max_attempts`` the message is parked with status ``dead`` (dead letter)
+  and can be requeued with ``requeue_dead``.
+- A claim marks the row ``sending`` until ``claimed_until``; rows left
+  behind by a crashed sender are picked up again after that.
+- Sends are paced per provider by a token bucket and the number in flight
+  adapts to how the SMTP server responds (AIMD, see throttle.py). The pool
+  has ``threads`` threads; the limiter decides how many may send at once.
+- Sent messages are kept for ``keep_sent_days`` and then purged, every
+  ``purge_interval`` seconds while the sender runs, so the claim queries
+  don't slow down as the table grows.
+"""
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+
+from throttle import AIMDLimiter, LatencyTracker, TokenBucket, is_throttle_error, provider_of
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_TRANSACTIONAL = 0
+PRIORITY_BULK = 10
+
+STATUSES = ('pending', 'sending', 'sent', 'dead')
+
+
+def enqueue(conn, recipients, subject, html, priority=PRIORITY_BULK, sender=None, dedupe_key=None):
+    """Store a message for delivery and commit. Returns the outbox id.
+
+    A message with the same dedupe_key as one already in the outbox is
+    dropped (returns None), so a retried or duplicated notification can't
+    be queued twice.
+    """
+    if isinstance(recipients, str):
+        recipients = [recipients]
+    now = time.time()
+    cur = conn.execute("""
+        INSERT OR IGNORE INTO outbox (priority, recipients, sender, subject, html, status,
+                                      attempts, next_attempt_at, created_at, dedupe_key)
+        VALUES (?, ?, ?, ?, ?, 'pending', 0, ?, ?, ?)
+    """, (priority, json.dumps(recipients), sender, subject, html, now, now, dedupe_key))
+    conn.commit()
+    return cur.lastrowid if cur.rowcount else None
+
+
+def requeue_dead(conn):
+    """Give every dead-lettered message a fresh set of attempts."""
+    cur = conn.execute("""
+        UPDATE outbox SET status = 'pending', attempts = 0, next_attempt_at = ?, last_error = NULL
+        WHERE status = 'dead'
+    """, (time.time(),))
+    conn.commit()
+    return cur.rowcount
+
+
+def outbox_stats(conn):
+    counts = dict.fromkeys(STATUSES, 0)
+    counts.update(conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+    row = conn.execute("SELECT MIN(created_at) FROM outbox WHERE status = 'pending'").fetchone()
+    counts['oldest_pending_age'] = round(time.time() - row[0], 1) if row[0] else 0
+    return counts
+
+
+class OutboxSender:
+    """Pool of threads draining the outbox.
+
+    ``open_session()`` returns an object with ``send(message)``, which gets
+    a dict with recipients, sender, subject and html and raises on failure,
+    ``close()`` and a ``connections`` count. A thread opens a session when
+    it finds work and closes it once the outbox is drained.
+    """
+
+    def __init__(self, path, open_session, threads=4, batch_size=10, max_attempts=6, base_delay=30,
+                 max_delay=3600, claim_timeout=300, poll_interval=2, keep_sent_days=7,
+                 purge_interval=3600, provider_rate=5.0, provider_rates=None):
+        self.path = path
+        self.open_session = open_session
+        self.threads = threads
+        self.batch_size = batch_size
+        # Messages per second per provider; provider_rates overrides by domain
+        self.provider_rate = provider_rate
+        self.provider_rates = provider_rates or {}
+        self._buckets = {}
+        self.limiter = AIMDLimiter(initial=min(2, threads), maximum=threads)
+        self.latency = LatencyTracker()
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.claim_timeout = claim_timeout
+        self.poll_interval = poll_interval
+        self.keep_sent_days = keep_sent_days
+        self.purge_interval = purge_interval
+        self._next_purge = 0.0
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._workers = []
+        self._lock = threading.Lock()
+        self._stats = {'sent': 0, 'retried': 0, 'dead': 0, 'connections': 0, 'purged': 0}
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA busy_timeout=10000')
+        return conn
+
+    def backoff(self, attempts):
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay * random.uniform(0.8, 1.2)
+
+    def claim(self, conn):
+        """Atomically take up to batch_size of the most urgent deliverable messages."""
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute("""
+                SELECT * FROM outbox
+                WHERE (status = 'pending' AND next_attempt_at <= ?)
+                   OR (status = 'sending' AND claimed_until < ?)
+                ORDER BY priority, next_attempt_at, id
+                LIMIT ?
+            """, (now, now, self.batch_size)).fetchall()
+            if rows:
+                conn.execute(f"""
+                    UPDATE outbox SET status = 'sending', attempts = attempts + 1, claimed_until = ?
+                    WHERE id IN ({', '.join('?' * len(rows))})
+                """, [now + self.claim_timeout] + [row['id'] for row in rows])
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return rows
+
+    def _finish(self, conn, row, error=None):
+        if error is None:
+            conn.execute("UPDATE outbox SET status = 'sent', sent_at = ?, last_error = NULL WHERE id = ?",
+                         (time.time(), row['id']))
+            key = 'sent'
+        elif row['attempts'] + 1 >= self.max_attempts:
+            conn.execute("UPDATE outbox SET status = 'dead', last_error = ? WHERE id = ?",
+                         (str(error)[:500], row['id']))
+            logger.error(f"Outbox message {row['id']} dead-lettered after {row['attempts'] + 1} attempts: {error}")
+            key = 'dead'
+        else:
+            conn.execute("""
+                UPDATE outbox SET status = 'pending', next_attempt_at = ?, last_error = ? WHERE id = ?
+            """, (time.time() + self.backoff(row['attempts'] + 1), str(error)[:500], row['id']))
+            logger.warning(f"Outbox message {row['id']} failed (attempt {row['attempts'] + 1}), will retry: {error}")
+            key = 'retried'
+        with self._lock:
+            self._stats[key] += 1
+
+    def _bucket(self, provider):
+        with self._lock:
+            bucket = self._buckets.get(provider)
+            if bucket is None:
+                bucket = self._buckets[provider] = TokenBucket(self.provider_rates.get(provider, self.provider_rate))
+            return bucket
+
+    def _send(self, session, message):
+        """Send one message within the provider's rate and the concurrency limit."""
+        wait = self._bucket(provider_of(message['recipients'])).reserve()
+        if wait > 0:
+            self._stop.wait(wait)
+        while not self.limiter.acquire(timeout=1):
+            if self._stop.is_set():
+                raise RuntimeError("Outbox sender stopping")
+        started = time.monotonic()
+        throttled = False
+        try:
+            session.send(message)
+        except Exception as e:
+            throttled = is_throttle_error(e)
+            raise
+        finally:
+            self.limiter.release(throttled)
+            self.latency.add(time.monotonic() - started)
+
+    def process_batch(self, conn, session):
+        """Claim and deliver a batch over session. Returns the number claimed."""
+        rows = self.claim(conn)
+        for row in rows:
+            message = {
+                'id': row['id'],
+                'recipients': json.loads(row['recipients']),
+                'sender': row['sender'],
+                'subject': row['subject'],
+                'html': row['html'],
+            }
+            try:
+                self._send(session, message)
+            except Exception as e:
+                self._finish(conn, row, e)
+            else:
+                self._finish(conn, row)
+        return len(rows)
+
+    def purge_sent(self, conn):
+        """Delete sent messages older than keep_sent_days. Returns the number removed."""
+        cutoff = time.time() - self.keep_sent_days * 86400
+        cur = conn.execute("DELETE FROM outbox WHERE status = 'sent' AND sent_at < ?", (cutoff,))
+        with self._lock:
+            self._stats['purged'] += cur.rowcount
+        return cur.rowcount
+
+    def _purge_if_due(self, conn):
+        # One thread purges per interval, whichever gets here first
+        with self._lock:
+            if time.monotonic() < self._next_purge:
+                return
+            self._next_purge = time.monotonic() + self.purge_interval
+        removed = self.purge_sent(conn)
+        if removed:
+            logger.info(f"Purged {removed} sent outbox messages")
+
+    def _close_session(self, session):
+        try:
+            session.close()
+        except Exception as e:
+            logger.warning(f"Closing SMTP session failed: {e}")
+        with self._lock:
+            self._stats['connections'] += session.connections
+
+    def _run(self):
+        conn = self._connect()
+        session = None
+        try:
+            while not self._stop.is_set():
+                try:
+                    self._purge_if_due(conn)
+                    if session is None:
+                        session = self.open_session()
+                    if self.process_batch(conn, session):
+                        continue
+                except sqlite3.Error as e:
+                    logger.error(f"Outbox sender: {e}")
+                # Drained: don't hold an idle SMTP connection open
+                if session is not None:
+                    self._close_session(session)
+                    session = None
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+        finally:
+            if session is not None:
+                self._close_session(session)
+            conn.close()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def start(self):
+        self._stop.clear()
+        self._next_purge = 0.0
+        self._workers = [
+            threading.Thread(target=self._run, name=f'outbox-sender-{n}', daemon=True)
+            for n in range(self.threads)
+        ]
+        for thread in self._workers:
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        for thread in self._workers:
+            thread.join()
+        self._workers = []
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            buckets = dict(self._buckets)
+        stats['latency'] = self.latency.percentiles()
+        stats['concurrency'] = self.limiter.state()
+        stats['providers'] = {provider: bucket.state() for provider, bucket in buckets.items()}
+        return stats
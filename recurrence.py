@@ -0,0 +1,209 @@
+"""Recurrence rules for reminders (a small subset of iCalendar RRULE).
+
+A recurring reminder is stored once, with its first occurrence in
+``datetime`` and a rule next to it::
+
+    'recurrence': {
+        'freq': 'daily' | 'weekly' | 'monthly',
+        'interval': 1,              # every n days/weeks/months
+        'byweekday': [0, 2, 4],     # weekly only, Monday = 0; default: the start's weekday
+        'until': '2025-12-31',      # optional, inclusive
+        'count': 30,                # optional, number of occurrences
+        'exdates': ['2025-06-02 08:00:00'],  # skipped occurrences
+    }
+
+Occurrences are never stored. ``iter_occurrences`` jumps arithmetically to
+the period containing ``after``, so finding the next occurrence costs
+O(1) no matter how long the series has run, and ``occurrences_between``
+expands only the requested range.
+
+Occurrences are wall-clock times in the reminder's ``timezone``, so a
+daily 08:00 stays at 08:00 across daylight saving changes; convert them
+with ``timekeys.to_epoch``.
+
+Per series, ``completed_through`` and ``last_notified`` record the latest
+completed and notified occurrence; everything up to them is done.
+"""
+import calendar
+from datetime import datetime, timedelta
+
+import timekeys
+from timekeys import parse_local as parse
+
+FREQUENCIES = ('daily', 'weekly', 'monthly')
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Give up after this many periods without an occurrence (e.g. everything excluded)
+MAX_EMPTY_PERIODS = 1000
+
+
+def format_occurrence(dt):
+    return dt.strftime(DATETIME_FORMAT)
+
+
+def normalize_rule(rule):
+    """Validated copy of a rule, or None if it isn't a usable rule."""
+    if not isinstance(rule, dict) or rule.get('freq') not in FREQUENCIES:
+        return None
+    normalized = {'freq': rule['freq'], 'interval': max(1, int(rule.get('interval') or 1))}
+    if rule['freq'] == 'weekly' and rule.get('byweekday'):
+        normalized['byweekday'] = sorted({int(day) % 7 for day in rule['byweekday']})
+    if rule.get('until'):
+        normalized['until'] = str(rule['until'])
+    if rule.get('count'):
+        normalized['count'] = max(1, int(rule['count']))
+    exdates = {format_occurrence(dt) for dt in map(parse, rule.get('exdates') or ()) if dt}
+    if exdates:
+        normalized['exdates'] = sorted(exdates)
+    return normalized
+
+
+def _add_months(dt, months):
+    month = dt.month - 1 + months
+    year, month = dt.year + month // 12, month % 12 + 1
+    day = min(dt.day, calendar.monthrange(year, month)[1])
+    return dt.replace(year=year, month=month, day=day)
+
+
+def _period(start, rule, k):
+    """Occurrences of the k-th period (before until/count/exdates)."""
+    interval = rule['interval']
+    if rule['freq'] == 'daily':
+        return [start + timedelta(days=k * interval)]
+    if rule['freq'] == 'monthly':
+        # Day 31 in a 30-day month falls on the 30th, like most calendar apps
+        return [_add_months(start, k * interval)]
+    week = start - timedelta(days=start.weekday()) + timedelta(weeks=k * interval)
+    days = rule.get('byweekday') or [start.weekday()]
+    return [dt for dt in (week + timedelta(days=day) for day in days) if dt >= start]
+
+
+def _period_of(start, rule, when):
+    """Index of the period that contains when (never negative)."""
+    if when <= start:
+        return 0
+    interval = rule['interval']
+    if rule['freq'] == 'daily':
+        return (when - start).days // interval
+    if rule['freq'] == 'monthly':
+        months = (when.year - start.year) * 12 + when.month - start.month
+        return max(0, months // interval - 1)
+    first_monday = start - timedelta(days=start.weekday())
+    return (when - first_monday).days // (7 * interval)
+
+
+def _occurrences_before(start, rule, k):
+    """How many occurrences periods 0..k-1 produce (for count)."""
+    if k == 0:
+        return 0
+    if rule['freq'] != 'weekly':
+        return k
+    per_week = len(rule.get('byweekday') or [start.weekday()])
+    return len(_period(start, rule, 0)) + (k - 1) * per_week
+
+
+def iter_occurrences(start, rule, after=None):
+    """Occurrences (datetimes) strictly after ``after``, in order."""
+    start = parse(start)
+    rule = normalize_rule(rule)
+    if start is None or rule is None:
+        return
+    after = parse(after) if after is not None else None
+    until = parse(rule['until']) if rule.get('until') else None
+    if until is not None and until.time() == datetime.min.time():
+        until = until.replace(hour=23, minute=59, second=59)  # a date means the whole day
+    exdates = set(rule.get('exdates', ()))
+    count = rule.get('count')
+
+    k = _period_of(start, rule, after) if after is not None else 0
+    index = _occurrences_before(start, rule, k)
+    empty = 0
+    while empty < MAX_EMPTY_PERIODS:
+        produced = False
+        for dt in _period(start, rule, k):
+            index += 1
+            if count is not None and index > count:
+                return
+            if until is not None and dt > until:
+                return
+            if (after is not None and dt <= after) or format_occurrence(dt) in exdates:
+                continue
+            produced = True
+            yield dt
+        empty = 0 if produced else empty + 1
+        k += 1
+
+
+def next_occurrence(start, rule, after=None):
+    return next(iter_occurrences(start, rule, after), None)
+
+
+def occurrences_between(start, rule, range_start, range_end, limit=1000):
+    """Occurrences with range_start <= dt < range_end, at most limit of them."""
+    range_start, range_end = parse(range_start), parse(range_end)
+    found = []
+    for dt in iter_occurrences(start, rule, after=range_start - timedelta(microseconds=1)):
+        if dt >= range_end or len(found) >= limit:
+            break
+        found.append(dt)
+    return found
+
+
+def is_recurring(reminder):
+    return normalize_rule(reminder.get('recurrence')) is not None
+
+
+def pending_occurrence(reminder, now=None):
+    """The occurrence of a series the user should do next, or None when it has ended.
+
+    Occurrences before today that were never completed have lapsed; the
+    next one is the first occurrence today or later that isn't completed.
+    """
+    now = now or timekeys.local_now(reminder.get('timezone'))
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(microseconds=1)
+    done = parse(reminder.get('completed_through'))
+    after = max(done, today) if done else today
+    return next_occurrence(reminder.get('datetime'), reminder.get('recurrence'), after=after)
+
+
+def notify_occurrence(reminder, now=None):
+    """The next occurrence to notify about: not yet due, completed or notified."""
+    after = now or timekeys.local_now(reminder.get('timezone'))
+    for marker in ('completed_through', 'last_notified'):
+        value = parse(reminder.get(marker))
+        if value and value > after:
+            after = value
+    return next_occurrence(reminder.get('datetime'), reminder.get('recurrence'), after=after)
+
+
+def expand(reminder, range_start, range_end, limit=1000):
+    """Copies of a reminder for each occurrence in [range_start, range_end).
+
+    Non-recurring reminders give themselves if they fall in the range.
+    """
+    tz = reminder.get('timezone')
+    if not is_recurring(reminder):
+        ts = timekeys.due_ts(reminder)
+        if ts is not None and timekeys.to_epoch(range_start, tz) <= ts < timekeys.to_epoch(range_end, tz):
+            return [dict(reminder, due_ts=ts, occurrence=format_occurrence(timekeys.from_epoch(ts, tz)))]
+        return []
+    done = parse(reminder.get('completed_through'))
+    return [dict(reminder, datetime=format_occurrence(dt), occurrence=format_occurrence(dt),
+                 due_ts=timekeys.to_epoch(dt, tz),
+                 completed=bool(reminder.get('completed') or (done and dt <= done)))
+            for dt in occurrences_between(reminder.get('datetime'), reminder['recurrence'],
+                                          range_start, range_end, limit)]
+
+
+def describe(rule):
+    """Short Norwegian description for the UI, e.g. 'Hver 2. uke'."""
+    rule = normalize_rule(rule)
+    if rule is None:
+        return ''
+    names = {'daily': ('Hver dag', 'dag'), 'weekly': ('Hver uke', 'uke'), 'monthly': ('Hver måned', 'måned')}
+    every, unit = names[rule['freq']]
+    text = every if rule['interval'] == 1 else f"Hver {rule['interval']}. {unit}"
+    if rule.get('until'):
+        text += f" til {rule['until']}"
+    elif rule.get('count'):
+        text += f" ({rule['count']} ganger)"
+    return text
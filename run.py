@@ -62,7 +62,8 @@ def check_environment():
 
 def run_app():
     """Run the SmartReminder application."""
-    from app import app
+    from app import app, init_db
+    init_db()
     
     # Check if port is specified
     port = int(os.environ.get('PORT', 5000))
@@ -71,6 +72,11 @@ def run_app():
     print(f"\nStarting SmartReminder on port {port} (debug={debug})")
     print("Press CTRL+C to quit\n")
     
+    # Background jobs normally run in worker.py; start them here for local runs
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        from worker import start_in_background
+        start_in_background()
+
     # Run the app
     app.run(host='0.0.0.0', port=port, debug=debug)
 
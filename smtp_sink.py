@@ -0,0 +1,114 @@
+"""Minimal SMTP sink for local testing and benchmarks.
+
+Accepts every message (including AUTH, so Flask-Mail can log in), keeps
+none of them and counts connections and messages. Point the app at it with
+
+    python smtp_sink.py --port 1025
+    MAIL_SERVER=localhost MAIL_PORT=1025 MAIL_USE_TLS=false python worker.py
+
+STARTTLS is not supported. Used in-process by bench_notifications.py.
+"""
+import argparse
+import socketserver
+import threading
+import time
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def _reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        sink = self.server.sink
+        sink._count('connections')
+        self._reply('220 smtp-sink ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip().upper()
+            if command.startswith('EHLO'):
+                self.wfile.write(b'250-smtp-sink\r\n250-8BITMIME\r\n250 AUTH PLAIN LOGIN\r\n')
+            elif command.startswith('AUTH LOGIN'):
+                # Username and password prompts; the answers are ignored
+                self._reply('334 VXNlcm5hbWU6')
+                self.rfile.readline()
+                self._reply('334 UGFzc3dvcmQ6')
+                self.rfile.readline()
+                self._reply('235 ok')
+            elif command.startswith('AUTH'):
+                self._reply('235 ok')
+            elif command.startswith('DATA'):
+                self._reply('354 end with .')
+                lines = []
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data in (b'.\r\n', b'.\n'):
+                        break
+                    lines.append(data[1:] if data.startswith(b'..') else data)
+                sink._received(b''.join(lines))
+                self._reply('250 queued')
+            elif command.startswith('QUIT'):
+                self._reply('221 bye')
+                return
+            else:  # HELO, MAIL, RCPT, RSET, NOOP
+                self._reply('250 ok')
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SMTPSink:
+    def __init__(self, host='127.0.0.1', port=0, on_message=None):
+        self._server = _Server((host, port), _Handler)
+        self._server.sink = self
+        self.host, self.port = self._server.server_address
+        # on_message(received_at, raw_message) is called for every accepted message
+        self.on_message = on_message
+        self._lock = threading.Lock()
+        self.connections = 0
+        self.messages = 0
+        self.bytes = 0
+        self._thread = None
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            setattr(self, key, getattr(self, key) + amount)
+
+    def _received(self, data):
+        received_at = time.time()
+        with self._lock:
+            self.messages += 1
+            self.bytes += len(data)
+        if self.on_message is not None:
+            self.on_message(received_at, data)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='smtp-sink', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SMTP server that accepts and discards all mail")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1025)
+    args = parser.parse_args()
+    sink = SMTPSink(args.host, args.port).start()
+    print(f"SMTP sink listening on {sink.host}:{sink.port}, Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(5)
+            print(f"connections: {sink.connections}, messages: {sink.messages}")
+    except KeyboardInterrupt:
+        sink.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -75,6 +75,46 @@ function loadPageModules() {
     }
 }
 
+// Live updates from /api/stream (Server-Sent Events). Page scripts register
+// a handler per event type; the first one opens the connection.
+window.liveUpdates = (function() {
+    const handlers = {};
+    let source = null;
+    
+    function dispatch(type, data) {
+        (handlers[type] || []).forEach(handler => handler(data));
+    }
+    
+    function listen(type) {
+        if (type === 'reset') return;
+        source.addEventListener(type, e => dispatch(type, JSON.parse(e.data)));
+    }
+    
+    function connect() {
+        if (source || !('EventSource' in window)) return;
+        source = new EventSource('/api/stream');
+        Object.keys(handlers).forEach(listen);
+        source.addEventListener('reset', () => {
+            // Events were lost: reload everything and start a fresh stream
+            source.close();
+            source = null;
+            dispatch('reset', {});
+            connect();
+        });
+    }
+    
+    return {
+        on: function(type, handler) {
+            if (!handlers[type]) {
+                handlers[type] = [];
+                if (source) listen(type);
+            }
+            handlers[type].push(handler);
+            connect();
+        }
+    };
+})();
+
 function loadScript(src) {
     return new Promise((resolve, reject) => {
         const script = document.createElement('script');
@@ -0,0 +1,272 @@
+// Live editing of a shared note (see collab.py for the operation format).
+// Edits are sent as small operations; other members' operations arrive as
+// note.ops events on /api/stream, or through long-polling without it.
+
+// The operations (code points, like collab.py) are plain functions so the
+// tests can run them next to collab.py under node.
+const collabOps = (function() {
+    function chars(text) {
+        return Array.from(text);
+    }
+
+    function push(op, c) {
+        if (c === 0 || c === '') return;
+        const last = op[op.length - 1];
+        if (typeof last === 'string' && typeof c === 'string') {
+            op[op.length - 1] = last + c;
+        } else if (typeof last === 'number' && typeof c === 'number' && (last > 0) === (c > 0)) {
+            op[op.length - 1] = last + c;
+        } else {
+            op.push(c);
+        }
+    }
+
+    function apply(text, op) {
+        const source = chars(text);
+        let index = 0;
+        let result = '';
+        op.forEach(c => {
+            if (typeof c === 'string') {
+                result += c;
+            } else if (c > 0) {
+                result += source.slice(index, index + c).join('');
+                index += c;
+            } else {
+                index -= c;
+            }
+        });
+        return result;
+    }
+
+    // Same as collab.transform: (a', b'), a's inserts first
+    function transform(a, b) {
+        const aPrime = [], bPrime = [];
+        let i = 0, j = 0;
+        let x = a[i++], y = b[j++];
+        while (x !== undefined || y !== undefined) {
+            if (typeof x === 'string') {
+                push(aPrime, x);
+                push(bPrime, chars(x).length);
+                x = a[i++];
+                continue;
+            }
+            if (typeof y === 'string') {
+                push(aPrime, chars(y).length);
+                push(bPrime, y);
+                y = b[j++];
+                continue;
+            }
+            let n;
+            if (x > 0 && y > 0) {
+                n = Math.min(x, y);
+                push(aPrime, n);
+                push(bPrime, n);
+                x -= n; y -= n;
+            } else if (x < 0 && y < 0) {
+                n = Math.min(-x, -y);
+                x += n; y += n;
+            } else if (x < 0) {
+                n = Math.min(-x, y);
+                push(aPrime, -n);
+                x += n; y -= n;
+            } else {
+                n = Math.min(x, -y);
+                push(bPrime, -n);
+                x -= n; y += n;
+            }
+            if (x === 0) x = a[i++];
+            if (y === 0) y = b[j++];
+        }
+        return [aPrime, bPrime];
+    }
+
+    function diff(oldText, newText) {
+        const a = chars(oldText), b = chars(newText);
+        let prefix = 0;
+        const limit = Math.min(a.length, b.length);
+        while (prefix < limit && a[prefix] === b[prefix]) prefix++;
+        let suffix = 0;
+        while (suffix < limit - prefix && a[a.length - 1 - suffix] === b[b.length - 1 - suffix]) suffix++;
+        const op = [];
+        push(op, prefix);
+        push(op, -(a.length - prefix - suffix));
+        push(op, b.slice(prefix, b.length - suffix).join(''));
+        push(op, suffix);
+        return op;
+    }
+
+    // Where a position (in code points) ends up after an operation
+    function movePosition(position, op) {
+        let index = 0, moved = position;
+        for (const c of op) {
+            if (index > position) break;
+            if (typeof c === 'string') {
+                moved += chars(c).length;
+            } else if (c > 0) {
+                index += c;
+            } else {
+                moved -= Math.min(-c, Math.max(0, position - index));
+                index -= c;
+            }
+        }
+        return moved;
+    }
+
+    // Someone else's operation (made against the server text before it) arriving
+    // while `pending` is unacknowledged and the textarea holds `value`. `shadow`
+    // is the server text with `pending` applied; both must move past `op`, and
+    // the edits typed since are rebased on top of it.
+    function rebase(shadow, pending, value, op) {
+        const local = diff(shadow, value);
+        if (pending) {
+            [pending, op] = transform(pending, op);
+        }
+        const [rebased, visible] = transform(local, op);
+        shadow = apply(shadow, op);
+        return {pending: pending, shadow: shadow, text: apply(shadow, rebased), op: visible};
+    }
+
+    return {chars: chars, apply: apply, transform: transform, diff: diff, movePosition: movePosition, rebase: rebase};
+})();
+
+if (typeof module !== 'undefined') module.exports = collabOps;
+
+(function() {
+    if (typeof document === 'undefined') return;
+    const {chars, diff, movePosition, rebase} = collabOps;
+    const textarea = document.getElementById('noteContent');
+    if (!textarea || !textarea.dataset.liveUrl) return;
+
+    const liveUrl = textarea.dataset.liveUrl;
+    const noteId = textarea.dataset.noteId;
+    const csrfToken = document.querySelector('#noteForm input[name="csrf_token"]').value;
+    const clientId = Math.random().toString(36).slice(2);
+    const status = document.getElementById('liveStatus');
+
+    const form = document.getElementById('noteForm');
+    let version = parseInt(textarea.dataset.version, 10);
+    let pending = null;               // sent, not yet acknowledged
+    let shadow = textarea.value;      // server text with our pending operation applied
+    let polling = false;
+    let submitWhenSaved = false;     // the Lagre button waits for our edits to be acknowledged
+
+    // -- Sync with the server ----------------------------------------------
+
+    function setStatus(text) {
+        if (status) status.textContent = text;
+    }
+
+    function replaceText(text, op) {
+        // Keep the cursor where it was relative to the text around it
+        const start = movePosition(chars(textarea.value.slice(0, textarea.selectionStart)).length, op);
+        const end = movePosition(chars(textarea.value.slice(0, textarea.selectionEnd)).length, op);
+        textarea.value = text;
+        const units = n => chars(text).slice(0, n).join('').length;
+        textarea.setSelectionRange(units(start), units(end));
+    }
+
+    function sendPending() {
+        if (pending || textarea.value === shadow) return;
+        pending = diff(shadow, textarea.value);
+        shadow = textarea.value;
+        setStatus('Lagrer...');
+        fetch(liveUrl, {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json', 'X-CSRFToken': csrfToken},
+            body: JSON.stringify({version: version, op: pending, client_id: clientId})
+        })
+        .then(response => response.ok ? response.json() : Promise.reject(response.status))
+        .then(entry => receive(entry))
+        .catch(error => {
+            console.error('Kunne ikke sende endring:', error);
+            reload();
+        });
+    }
+
+    // An applied operation from the server: our own acknowledgement or someone else's edit
+    function receive(entry) {
+        if (entry.version <= version) return;
+        if (entry.version !== version + 1) {
+            catchUp();
+            return;
+        }
+        version = entry.version;
+        if (entry.client_id === clientId) {
+            pending = null;
+            setStatus('Lagret');
+            sendPending();
+            if (!pending && submitWhenSaved) {
+                submitWhenSaved = false;
+                form.requestSubmit();
+            }
+            return;
+        }
+        const rebased = rebase(shadow, pending, textarea.value, entry.op);
+        pending = rebased.pending;
+        shadow = rebased.shadow;
+        replaceText(rebased.text, rebased.op);
+    }
+
+    function catchUp() {
+        return fetch(`${liveUrl}?since=${version}`)
+            .then(response => response.ok ? response.json() : Promise.reject(response.status))
+            .then(data => data.ops.forEach(receive))
+            .catch(() => reload());
+    }
+
+    // Start over from the server's text (our unsent edits are lost)
+    function reload() {
+        fetch(liveUrl)
+            .then(response => response.json())
+            .then(data => {
+                version = data.version;
+                pending = null;
+                submitWhenSaved = false;
+                shadow = data.content;
+                textarea.value = data.content;
+                setStatus('Oppdatert');
+            });
+    }
+
+    // Without a stream: wait for operations with a long-poll
+    function poll() {
+        polling = true;
+        fetch(`${liveUrl}?since=${version}&wait=1`)
+            .then(response => response.ok ? response.json() : Promise.reject(response.status))
+            .then(data => {
+                data.ops.forEach(receive);
+                // The server is busy with other long-polls: ask again in a while
+                if (data.retry_after) setTimeout(poll, data.retry_after * 1000);
+                else poll();
+            })
+            .catch(() => {
+                reload();
+                setTimeout(poll, 5000);
+            });
+    }
+
+    textarea.addEventListener('input', sendPending);
+
+    // The form is diffed against its base text at its version on the server.
+    // Send our edits the live way first, then post the acknowledged text, so
+    // nothing that arrived live is applied twice.
+    form.addEventListener('submit', event => {
+        if (pending || textarea.value !== shadow) {
+            event.preventDefault();
+            submitWhenSaved = true;
+            sendPending();
+            return;
+        }
+        form.elements.version.value = version;
+        form.elements.base.value = shadow;
+    });
+
+    if (window.liveUpdates && 'EventSource' in window) {
+        liveUpdates.on('note.ops', entry => {
+            if (entry.note_id === noteId) receive(entry);
+        });
+        liveUpdates.on('reset', () => catchUp());
+    } else if (!polling) {
+        poll();
+    }
+})();
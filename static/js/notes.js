@@ -6,17 +6,39 @@ document.addEventListener('DOMContentLoaded', function() {
     const saveNoteBtn = document.getElementById('save-note');
     const addNoteModal = new bootstrap.Modal(document.getElementById('addNoteModal'));
     
-    // Load notes when notes tab is active
+    // Current notes: loaded once, then kept up to date by live updates
+    let ownNotes = [];
+    let sharedNotes = [];
+    let notesLoaded = false;
+    
+    // Load notes the first time the notes tab is active
     if (notesList) {
         // Initial load if noteboard tab is active by default
         if (document.querySelector('#noteboard.active')) {
             loadNotes();
         }
         
-        // Tab change event - load notes when tab becomes active
+        // Tab change event - load notes the first time the tab becomes active
         document.querySelector('button[data-bs-target="#noteboard"]').addEventListener('shown.bs.tab', function(e) {
-            loadNotes();
+            if (!notesLoaded) {
+                loadNotes();
+            }
         });
+        
+        if (window.liveUpdates) {
+            liveUpdates.on('note.created', note => applyNote(note, ownNotes));
+            liveUpdates.on('note.shared', note => applyNote(note, sharedNotes));
+            liveUpdates.on('note.updated', changes => updateNote(changes.id, {
+                title: changes.title,
+                content: changes.content,
+                updated_at: changes.updated_at
+            }));
+            liveUpdates.on('note.member_joined', changes => updateNote(changes.id, {members: changes.members}));
+            // The stream lost events: start over from a full load
+            liveUpdates.on('reset', () => {
+                if (notesLoaded) loadNotes();
+            });
+        }
     }
     
     // Save new note
@@ -65,8 +87,7 @@ document.addEventListener('DOMContentLoaded', function() {
         if (!notesList) return;
         
         // Clear previous notes (except loading and empty elements)
-        const noteCards = notesList.querySelectorAll('.note-card');
-        noteCards.forEach(card => card.remove());
+        clearNotes();
         
         notesLoading.classList.remove('d-none');
         noNotes.classList.add('d-none');
@@ -77,22 +98,10 @@ document.addEventListener('DOMContentLoaded', function() {
                 // Hide loading spinner
                 notesLoading.classList.add('d-none');
                 
-                // Combine own and shared notes
-                const notes = [...(data.own_notes || []), ...(data.shared_notes || [])];
-                
-                if (notes.length === 0) {
-                    noNotes.classList.remove('d-none');
-                    return;
-                }
-                
-                // Sort notes by creation date (newest first)
-                notes.sort((a, b) => new Date(b.created_at) - new Date(a.created_at));
-                
-                // Render notes
-                notes.forEach(note => {
-                    const isOwn = note.creator_email === null || data.own_notes.some(n => n.id === note.id);
-                    renderNote(note, isOwn);
-                });
+                ownNotes = data.own_notes || [];
+                sharedNotes = data.shared_notes || [];
+                notesLoaded = true;
+                renderNotes();
             })
             .catch(error => {
                 console.error('Error loading notes:', error);
@@ -102,6 +111,50 @@ document.addEventListener('DOMContentLoaded', function() {
             });
     }
     
+    function clearNotes() {
+        notesList.querySelectorAll('.note-card').forEach(card => card.parentElement.remove());
+    }
+    
+    // Render all notes, newest first
+    function renderNotes() {
+        clearNotes();
+        
+        // Combine own and shared notes
+        const notes = [...ownNotes, ...sharedNotes];
+        
+        if (notes.length === 0) {
+            noNotes.classList.remove('d-none');
+            return;
+        }
+        noNotes.classList.add('d-none');
+        
+        // Sort notes by creation date (newest first)
+        notes.sort((a, b) => new Date(b.created_at) - new Date(a.created_at));
+        
+        notes.forEach(note => {
+            const isOwn = note.creator_email === null || ownNotes.some(n => n.id === note.id);
+            renderNote(note, isOwn);
+        });
+    }
+    
+    // Add a note from a live update (ignored until the notes have been loaded)
+    function applyNote(note, list) {
+        if (!notesLoaded) return;
+        const index = list.findIndex(n => n.id === note.id);
+        if (index >= 0) {
+            list[index] = note;
+        } else {
+            list.push(note);
+        }
+        renderNotes();
+    }
+    
+    function updateNote(id, changes) {
+        if (!notesLoaded) return;
+        [...ownNotes, ...sharedNotes].filter(n => n.id === id).forEach(n => Object.assign(n, changes));
+        renderNotes();
+    }
+    
     // Render a single note
     function renderNote(note, isOwn) {
         const col = document.createElement('div');
@@ -8,14 +8,27 @@ document.addEventListener('DOMContentLoaded', function() {
     const saveReminderBtn = document.getElementById('save-reminder');
     const addReminderModal = new bootstrap.Modal(document.getElementById('addReminderModal'));
     
-    // Load reminders when reminders tab is active
+    // Current lists: loaded once, then kept up to date by live updates
+    let ownReminders = [];
+    let sharedReminders = [];
+    
+    // Load reminders once, then apply the changes from /api/stream
     if (remindersList) {
         loadReminders();
         
-        // Tab change event - reload reminders when tab becomes active
-        document.querySelector('button[data-bs-target="#reminders"]').addEventListener('shown.bs.tab', function(e) {
-            loadReminders();
-        });
+        if (window.liveUpdates) {
+            liveUpdates.on('reminder.created', reminder => applyReminder(reminder, false));
+            liveUpdates.on('reminder.updated', reminder => applyReminder(reminder, !!reminder.is_shared));
+            liveUpdates.on('reminder.completed', reminder => applyReminder(reminder, !!reminder.is_shared));
+            liveUpdates.on('reminder.shared', reminder => applyReminder(reminder, true));
+            liveUpdates.on('reminder.deleted', data => {
+                ownReminders = ownReminders.filter(r => r.id !== data.id);
+                sharedReminders = sharedReminders.filter(r => r.id !== data.id);
+                renderAll();
+            });
+            // The stream lost events: start over from a full load
+            liveUpdates.on('reset', loadReminders);
+        }
     }
     
     // Save new reminder
@@ -76,13 +89,9 @@ document.addEventListener('DOMContentLoaded', function() {
                 // Hide loading spinner
                 remindersLoading.classList.add('d-none');
                 
-                // Process own reminders
-                const ownReminders = data.own_reminders || [];
-                renderReminders(ownReminders, remindersList, noReminders);
-                
-                // Process shared reminders
-                const sharedReminders = data.shared_reminders || [];
-                renderReminders(sharedReminders, sharedRemindersList, noSharedReminders, true);
+                ownReminders = data.own_reminders || [];
+                sharedReminders = data.shared_reminders || [];
+                renderAll();
             })
             .catch(error => {
                 console.error('Error loading reminders:', error);
@@ -92,6 +101,23 @@ document.addEventListener('DOMContentLoaded', function() {
             });
     }
     
+    // Replace (or add) one reminder in its list and redraw
+    function applyReminder(reminder, isShared) {
+        const list = isShared ? sharedReminders : ownReminders;
+        const index = list.findIndex(r => r.id === reminder.id);
+        if (index >= 0) {
+            list[index] = reminder;
+        } else {
+            list.push(reminder);
+        }
+        renderAll();
+    }
+    
+    function renderAll() {
+        renderReminders(ownReminders, remindersList, noReminders);
+        renderReminders(sharedReminders, sharedRemindersList, noSharedReminders, true);
+    }
+    
     // Render reminders to a container
     function renderReminders(reminders, container, emptyMessage, isShared = false) {
         container.innerHTML = '';
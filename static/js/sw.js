@@ -40,7 +40,7 @@ self.addEventListener('activate', function(event) {
         caches.keys().then(function(cacheNames) {
             return Promise.all(
                 cacheNames.filter(function(cacheName) {
-                    return cacheName !== CACHE_NAME;
+                    return cacheName !== CACHE_NAME && cacheName !== SYNC_CACHE;
                 }).map(function(cacheName) {
                     return caches.delete(cacheName);
                 })
@@ -50,6 +50,11 @@ self.addEventListener('activate', function(event) {
 });
 
 self.addEventListener('fetch', function(event) {
+    // API calls (and the /api/stream event stream) always go to the network
+    if (new URL(event.request.url).pathname.startsWith('/api/')) {
+        return;
+    }
+    
     // Skip cross-origin requests
     if (!event.request.url.startsWith(self.location.origin) && 
         !event.request.url.includes('bootstrap')) {
@@ -90,3 +95,49 @@ self.addEventListener('fetch', function(event) {
             })
     );
 });
+
+
+// Background sync: fetch only what changed since the last sync (/api/sync)
+// and keep the merged result in its own cache for offline use
+const SYNC_CACHE = 'sync-v1';
+const SYNC_STATE_URL = '/__sync-state';
+
+self.addEventListener('sync', function(event) {
+    if (event.tag === 'sync-reminders') {
+        event.waitUntil(pullChanges());
+    }
+});
+
+async function pullChanges() {
+    const cache = await caches.open(SYNC_CACHE);
+    const saved = await cache.match(SYNC_STATE_URL);
+    const state = saved ? await saved.json() : {cursor: 0, collections: {}};
+    let more = true;
+    
+    while (more) {
+        const response = await fetch('/api/sync?since=' + state.cursor, {credentials: 'same-origin'});
+        if (!response.ok) {
+            return;
+        }
+        const data = await response.json();
+        if (data.reset) {
+            // Full sync: the response replaces everything we had
+            state.collections = {};
+        }
+        Object.keys(data.changes).forEach(function(name) {
+            const records = state.collections[name] = state.collections[name] || {};
+            data.changes[name].forEach(function(record) {
+                records[record.id] = record;
+            });
+            data.deleted[name].forEach(function(id) {
+                delete records[id];
+            });
+        });
+        state.cursor = data.cursor;
+        more = data.more;
+    }
+    
+    await cache.put(SYNC_STATE_URL, new Response(JSON.stringify(state), {
+        headers: {'Content-Type': 'application/json'}
+    }));
+}
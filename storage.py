@@ -0,0 +1,745 @@
+"""JSON storage for SmartReminder.
+
+Every collection lives in ``data/<type>.json`` (the snapshot) plus
+``data/<type>.journal``, an append-only log with one operation per line::
+
+    {"op": "upsert", "id": "...", "record": {...}}
+    {"op": "delete", "id": "..."}
+
+Single-record writes only append to the journal, so they cost O(record)
+instead of rewriting the whole file. Loading replays the journal on top of
+the snapshot, and a background compactor folds the journal back into the
+snapshot once it grows past a threshold.
+
+``users`` is stored as a dict keyed by user id; every other collection is a
+list of records with an ``id`` field.
+
+Parsed collections are cached per process and revalidated with stat():
+when only the journal has grown, just the new tail is read and applied.
+``read_data`` hands out the shared cached structure and must be treated as
+read-only; ``load_data`` and ``get_record`` return private copies for
+callers that want to modify what they get back.
+
+Collections can declare secondary indexes on fields (``'user_id'``), list
+fields (``'shared_with'``) or fields of nested lists (``'members.email'``).
+They are kept in step with every applied operation, so ``find`` costs
+O(matches) rather than a scan over the whole collection.
+
+With ``layout='sharded'`` the collections declared in ``shards`` are split
+per user into ``data/users/<user>/<type>.json``, keyed by one field of the
+record. Lookups on that field only touch the user's own shard. Fields
+listed under ``cross_index`` (e.g. who a note is shared with) are copied
+into a small global ``data/<type>_index`` collection that points at the
+owning shard. ``split_shards`` converts an existing monolithic data dir.
+
+``watch`` registers a callback that sees every change this process applies
+to a collection, whether written here or picked up from another worker's
+journal, so in-memory structures such as the notification queue can be
+maintained incrementally instead of rescanning. Call ``refresh`` to pick
+up other processes' writes. ``on_write`` is the counterpart that fires
+once, in the process that made the write (used for the sync change log).
+
+Several gunicorn workers may share one data dir. Snapshots are written to
+a temp file, fsynced and renamed into place, so readers never see a
+truncated file. Writers take a per-collection advisory lock
+(``<name>.lock``, fcntl) only for the duration of an append, a compaction
+or a read-modify-write via ``update``; different collections can be
+written in parallel. Readers take no lock: they re-check the snapshot
+after reading and retry if a compaction replaced it underneath them.
+"""
+import json
+import logging
+import os
+import pickle
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Collections stored as {id: record} instead of [record, ...]
+DICT_COLLECTIONS = {'users'}
+
+SHARD_DIR = 'users'
+
+
+def _file_key(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+class CorruptDataError(ValueError):
+    """A snapshot exists but cannot be parsed; refuse to treat it as empty."""
+
+
+def _copy(data):
+    return pickle.loads(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+
+
+def _index_keys(record, path):
+    """Values of a dotted field path, flattening lists along the way."""
+    values = [record]
+    for part in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                value = value.get(part)
+                if isinstance(value, list):
+                    found.extend(value)
+                elif value is not None:
+                    found.append(value)
+        values = found
+    return {v for v in values if isinstance(v, (str, int, float, bool))}
+
+
+class _CacheEntry:
+    """Parsed state of one collection as of a snapshot/journal position."""
+
+    def __init__(self, is_dict, records, snapshot_key, journal_offset, index_fields=(), journal_ino=None):
+        self.is_dict = is_dict
+        self.records = records  # {id: record}, in file order
+        self.snapshot_key = snapshot_key
+        self.journal_offset = journal_offset
+        self.journal_ino = journal_ino
+        self._view = None
+        # {field: {key: {record_id: None}}}; dicts keep ids in insertion order
+        self.indexes = {field: {} for field in index_fields}
+        for record_id, record in records.items():
+            self._index(record_id, None, record)
+
+    def _index(self, record_id, old, new):
+        for field, index in self.indexes.items():
+            old_keys = _index_keys(old, field) if old is not None else set()
+            new_keys = _index_keys(new, field) if new is not None else set()
+            for key in old_keys - new_keys:
+                ids = index.get(key)
+                if ids is not None:
+                    ids.pop(record_id, None)
+                    if not ids:
+                        del index[key]
+            for key in new_keys - old_keys:
+                index.setdefault(key, {})[record_id] = None
+
+    def apply(self, ops):
+        for op in ops:
+            old = self.records.get(op['id'])
+            if op['op'] == 'upsert':
+                self.records[op['id']] = op['record']
+                self._index(op['id'], old, op['record'])
+            elif op['op'] == 'delete' and old is not None:
+                del self.records[op['id']]
+                self._index(op['id'], old, None)
+        if ops:
+            self._view = None
+
+    def view(self):
+        # Rebuilt only after a change. Records are replaced, never mutated,
+        # so views handed out earlier stay consistent.
+        if self._view is None:
+            self._view = dict(self.records) if self.is_dict else list(self.records.values())
+        return self._view
+
+
+class DataManager:
+    def __init__(self, data_dir='data', compact_threshold=256 * 1024, compact_interval=60,
+                 indexes=None, layout='monolithic', shards=None):
+        self.data_dir = data_dir
+        self.indexes = indexes or {}
+        self.layout = layout
+        # {data_type: {'key': field, 'cross_index': (field, ...)}}
+        self.shards = shards or {}
+        self.compact_threshold = compact_threshold
+        self.compact_interval = compact_interval
+        self._lock = threading.RLock()
+        self._compactor = None
+        self._compact_wakeup = threading.Event()
+        self._cache = {}
+        self._stats = {'hits': 0, 'misses': 0, 'tail_reads': 0}
+        self._name_locks = {}
+        self._held = threading.local()
+        self._watchers = {}  # {data_type: [callback, ...]}
+        self._write_hooks = {}  # {data_type: [callback, ...]}
+
+    # -- Collection files -------------------------------------------------
+
+    def _snapshot_path(self, name):
+        return os.path.join(self.data_dir, f'{name}.json')
+
+    def _journal_path(self, name):
+        return os.path.join(self.data_dir, f'{name}.journal')
+
+    def _lock_path(self, name):
+        return os.path.join(self.data_dir, f'{name}.lock')
+
+    @contextmanager
+    def _locked(self, name):
+        """Exclusive per-collection lock, across threads and processes.
+
+        Re-entrant within a thread. Must be taken before ``self._lock``,
+        never while holding it.
+        """
+        held = self._held.__dict__.setdefault('names', set())
+        if name in held:
+            yield
+            return
+        with self._lock:
+            thread_lock = self._name_locks.setdefault(name, threading.Lock())
+        with thread_lock:
+            fd = None
+            try:
+                if fcntl is not None:
+                    os.makedirs(os.path.dirname(self._lock_path(name)), exist_ok=True)
+                    fd = os.open(self._lock_path(name), os.O_RDWR | os.O_CREAT, 0o644)
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                held.add(name)
+                yield
+            finally:
+                held.discard(name)
+                if fd is not None:
+                    os.close(fd)  # releases the flock
+
+    @staticmethod
+    def _base_type(name):
+        return name.rsplit('/', 1)[-1]
+
+    @classmethod
+    def _empty(cls, name):
+        return {} if cls._base_type(name) in DICT_COLLECTIONS else []
+
+    def _index_fields(self, name):
+        base = self._base_type(name)
+        if base.endswith('_index') and base[:-len('_index')] in self.shards:
+            return self.shards[base[:-len('_index')]].get('cross_index', ())
+        return self.indexes.get(base, ())
+
+    def _read_snapshot(self, name):
+        """Return (data, key) where key identifies the file actually read."""
+        try:
+            with open(self._snapshot_path(name), 'r') as f:
+                st = os.fstat(f.fileno())
+                return json.load(f), (st.st_ino, st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return self._empty(name), None
+        except json.JSONDecodeError as e:
+            logger.error(f"Corrupt snapshot for {name}: {e}")
+            raise CorruptDataError(f"{self._snapshot_path(name)} is not valid JSON") from e
+
+    def _read_journal(self, name, offset=0):
+        """Return (ops, end_offset) for journal entries starting at offset."""
+        ops = []
+        try:
+            with open(self._journal_path(name), 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # Half-written trailing entry from an interrupted append
+                        logger.warning(f"Ignoring incomplete journal entry in {name}")
+                        break
+                    offset += len(line)
+                    try:
+                        ops.append(json.loads(line))
+                    except json.JSONDecodeError as e:
+                        logger.error(f"Skipping corrupt journal entry in {name}: {e}")
+        except FileNotFoundError:
+            pass
+        return ops, offset
+
+    def _entry(self, name):
+        """Return an up-to-date cache entry, reloading only what changed."""
+        snapshot_key = _file_key(self._snapshot_path(name))
+        journal_key = _file_key(self._journal_path(name))
+        journal_size = journal_key[2] if journal_key else 0
+        journal_ino = journal_key[0] if journal_key else None
+
+        entry = self._cache.get(name)
+        if entry is not None and entry.snapshot_key == snapshot_key:
+            if journal_size == entry.journal_offset:
+                self._stats['hits'] += 1
+                return entry
+            same_journal = journal_ino == entry.journal_ino or (
+                entry.journal_ino is None and entry.journal_offset == 0)
+            if journal_size > entry.journal_offset and same_journal:
+                ops, offset = self._read_journal(name, entry.journal_offset)
+                # A compaction between the stats and the read means this tail
+                # belongs to a different snapshot; fall back to a full reload.
+                if _file_key(self._snapshot_path(name)) == snapshot_key:
+                    entry.apply(ops)
+                    entry.journal_offset = offset
+                    entry.journal_ino = journal_ino
+                    self._stats['tail_reads'] += 1
+                    self._notify(name, entry, ops)
+                    return entry
+
+        self._stats['misses'] += 1
+        for _ in range(5):
+            data, snapshot_key = self._read_snapshot(name)
+            journal_key = _file_key(self._journal_path(name))
+            ops, offset = self._read_journal(name)
+            if _file_key(self._snapshot_path(name)) == snapshot_key:
+                break
+            # Compacted while we were reading: snapshot and journal don't match
+        if isinstance(data, dict):
+            records = dict(data)
+        else:
+            records = {r.get('id'): r for r in data if isinstance(r, dict)}
+        entry = _CacheEntry(isinstance(data, dict), records, snapshot_key, offset,
+                            self._index_fields(name), journal_key[0] if journal_key else None)
+        entry.apply(ops)
+        self._cache[name] = entry
+        self._notify(name, entry, None)
+        return entry
+
+    def _notify(self, name, entry, ops):
+        """Tell watchers about applied ops; ops=None means entry was (re)loaded."""
+        watchers = self._watchers.get(self._base_type(name))
+        if not watchers:
+            return
+        if ops is None:
+            changes, reset = list(entry.records.items()), True
+        else:
+            changes = [(op['id'], entry.records.get(op['id'])) for op in ops]
+            reset = False
+        for callback in watchers:
+            try:
+                callback(name, changes, reset)
+            except Exception as e:
+                logger.error(f"Watcher for {name} failed: {e}")
+
+    def _write_snapshot(self, name, data):
+        """Atomically replace a snapshot and drop its journal. Caller holds the lock."""
+        path = self._snapshot_path(name)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(data, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        if hasattr(os, 'O_DIRECTORY'):
+            # Make the rename itself durable
+            fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        try:
+            os.remove(self._journal_path(name))
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self._cache.pop(name, None)
+
+    def _append(self, name, ops):
+        os.makedirs(os.path.dirname(self._journal_path(name)), exist_ok=True)
+        lines = [json.dumps(op, separators=(',', ':')) + '\n' for op in ops]
+        payload = ''.join(lines).encode('utf-8')
+        with self._locked(name):
+            with self._lock:
+                entry = self._entry(name)
+            with open(self._journal_path(name), 'ab') as f:
+                start = f.tell()
+                f.write(payload)
+                f.flush()
+                size = f.tell()
+                journal_ino = os.fstat(f.fileno()).st_ino
+            with self._lock:
+                if self._cache.get(name) is entry and start == entry.journal_offset:
+                    # Everything before our append is already applied: apply our
+                    # own ops in place. Re-parsing keeps the cache independent of
+                    # the caller's objects.
+                    applied = [json.loads(line) for line in lines]
+                    entry.apply(applied)
+                    entry.journal_offset = size
+                    entry.journal_ino = journal_ino
+                    self._notify(name, entry, applied)
+        if size >= self.compact_threshold:
+            self._schedule_compaction()
+
+    # -- Sharding ---------------------------------------------------------
+
+    def is_sharded(self, data_type):
+        return self.layout == 'sharded' and data_type in self.shards
+
+    @staticmethod
+    def shard_name(key):
+        return re.sub(r'[^a-z0-9@._-]', '_', str(key).lower()) or '_'
+
+    def _shard(self, data_type, key):
+        return f'{SHARD_DIR}/{self.shard_name(key)}/{data_type}'
+
+    def _shard_names(self, data_type):
+        root = os.path.join(self.data_dir, SHARD_DIR)
+        try:
+            users = sorted(os.listdir(root))
+        except FileNotFoundError:
+            return []
+        return [
+            f'{SHARD_DIR}/{user}/{data_type}' for user in users
+            if os.path.exists(os.path.join(root, user, f'{data_type}.json'))
+            or os.path.exists(os.path.join(root, user, f'{data_type}.journal'))
+        ]
+
+    def _locator(self, data_type, record_id):
+        """Shard collection holding a record, via the cross-shard index."""
+        if not self.shards[data_type].get('cross_index'):
+            return None
+        entry = self._entry(f'{data_type}_index').records.get(record_id)
+        return self._shard(data_type, entry['shard']) if entry else None
+
+    def _locator_record(self, data_type, record_id, record):
+        spec = self.shards[data_type]
+        locator = {'id': record_id, 'shard': record.get(spec['key'])}
+        for field in spec.get('cross_index', ()):
+            locator[field] = sorted(_index_keys(record, field), key=str)
+        return locator
+
+    def _group_by_shard(self, data_type, records, record_ids):
+        key = self.shards[data_type]['key']
+        groups = {}
+        for rid, record in zip(record_ids, records):
+            groups.setdefault(self._shard(data_type, record.get(key)), []).append((rid, record))
+        return groups
+
+    # -- Public API -------------------------------------------------------
+
+    def read_data(self, data_type):
+        """Shared, cached view of a collection. Do not modify the result."""
+        with self._lock:
+            if self.is_sharded(data_type):
+                records = []
+                for name in self._shard_names(data_type):
+                    records.extend(self._entry(name).view())
+                return records
+            return self._entry(data_type).view()
+
+    def refresh(self, data_type):
+        """Pick up changes made by other processes (watchers are notified).
+
+        Costs a few stat() calls per collection file when nothing changed.
+        """
+        with self._lock:
+            names = self._shard_names(data_type) if self.is_sharded(data_type) else [data_type]
+            for name in names:
+                self._entry(name)
+
+    def watch(self, data_type, callback):
+        """Call ``callback(name, changes, reset)`` whenever records change.
+
+        ``name`` is the collection file (a shard name when sharded),
+        ``changes`` a list of ``(record_id, record or None if deleted)``.
+        With ``reset=True`` the changes are the complete contents of that
+        file and anything else previously seen from it is gone. Files that
+        are already cached are replayed to the callback right away.
+        Callbacks run under the cache lock: they must be quick, must not
+        modify the records and must not call back into the DataManager.
+        """
+        with self._lock:
+            self._watchers.setdefault(data_type, []).append(callback)
+            for name, entry in self._cache.items():
+                if self._base_type(name) == data_type and (name == data_type or self.is_sharded(data_type)):
+                    callback(name, list(entry.records.items()), True)
+
+    def unwatch(self, data_type, callback):
+        with self._lock:
+            watchers = self._watchers.get(data_type, [])
+            if callback in watchers:
+                watchers.remove(callback)
+
+    def on_write(self, data_type, callback):
+        """Call ``callback(data_type, changes)`` after this process writes records.
+
+        ``changes`` is a list of ``(record_id, old, new)``, with ``new=None``
+        for a delete. Unlike ``watch`` it runs once, in the writing process
+        and outside the cache lock, so it may do I/O. ``old`` is read just
+        before the write; only writes made through ``update`` are certain
+        that nobody changed it in between. Neither record may be modified.
+        """
+        with self._lock:
+            self._write_hooks.setdefault(data_type, []).append(callback)
+
+    def _previous(self, data_type, record_ids, shards):
+        """Current (shared) records for the write hooks, None where missing."""
+        with self._lock:
+            found = []
+            for rid, shard in zip(record_ids, shards):
+                if self.is_sharded(data_type):
+                    name = self._shard(data_type, shard) if shard is not None else self._locator(data_type, rid)
+                else:
+                    name = data_type
+                found.append(self._entry(name).records.get(rid) if name else None)
+            return found
+
+    def _written(self, data_type, changes):
+        for callback in self._write_hooks.get(data_type, ()):
+            try:
+                callback(data_type, changes)
+            except Exception as e:
+                logger.error(f"Write hook for {data_type} failed: {e}")
+
+    def load_data(self, data_type):
+        """Private copy of a collection that the caller may modify."""
+        return _copy(self.read_data(data_type))
+
+    def get_record(self, data_type, record_id, shard=None):
+        """Private copy of a single record, or None.
+
+        For sharded collections ``shard`` is the record's shard key (e.g. the
+        owner's email); without it the cross-shard index is consulted.
+        """
+        with self._lock:
+            if self.is_sharded(data_type):
+                name = self._shard(data_type, shard) if shard is not None else self._locator(data_type, record_id)
+                record = self._entry(name).records.get(record_id) if name else None
+            else:
+                record = self._entry(data_type).records.get(record_id)
+        return _copy(record) if record is not None else None
+
+    def _find_entries(self, data_type, field, value):
+        """(entry, record ids) pairs for an indexed lookup."""
+        if not self.is_sharded(data_type):
+            entry = self._entry(data_type)
+            if field not in entry.indexes:
+                raise KeyError(f"No index on {data_type}.{field}")
+            return [(entry, list(entry.indexes[field].get(value, ())))]
+
+        spec = self.shards[data_type]
+        if field == spec['key']:
+            entry = self._entry(self._shard(data_type, value))
+            return [(entry, [rid for rid, r in entry.records.items() if r.get(field) == value])]
+        if field in spec.get('cross_index', ()):
+            index = self._entry(f'{data_type}_index')
+            by_shard = {}
+            for rid in index.indexes[field].get(value, ()):
+                by_shard.setdefault(index.records[rid]['shard'], []).append(rid)
+            return [(self._entry(self._shard(data_type, shard)), ids) for shard, ids in by_shard.items()]
+        raise KeyError(f"No shard or cross-shard index on {data_type}.{field}")
+
+    def find_ids(self, data_type, field, value):
+        """Ids of records whose indexed field contains value."""
+        with self._lock:
+            return [rid for entry, ids in self._find_entries(data_type, field, value)
+                    for rid in ids if rid in entry.records]
+
+    def find(self, data_type, field, value):
+        """Records whose indexed field contains value. Do not modify the result."""
+        with self._lock:
+            return [entry.records[rid] for entry, ids in self._find_entries(data_type, field, value)
+                    for rid in ids if rid in entry.records]
+
+    def find_one(self, data_type, field, value):
+        found = self.find(data_type, field, value)
+        return found[0] if found else None
+
+    def cache_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses'] + stats['tail_reads']
+        stats['hit_rate'] = (stats['hits'] + stats['tail_reads']) / lookups if lookups else 0.0
+        return stats
+
+    def save_data(self, data_type, data):
+        """Replace a whole collection. This also compacts its journal."""
+        try:
+            if self.is_sharded(data_type):
+                self._write_shards(data_type, data)
+            else:
+                with self._locked(data_type):
+                    self._write_snapshot(data_type, data)
+            return True
+        except Exception as e:
+            logger.error(f"Error saving data: {e}")
+            return False
+
+    def _write_shards(self, data_type, records):
+        groups = self._group_by_shard(data_type, records, [r.get('id') for r in records])
+        for name in self._shard_names(data_type):
+            groups.setdefault(name, [])
+        if self.shards[data_type].get('cross_index'):
+            name = f'{data_type}_index'
+            with self._locked(name):
+                self._write_snapshot(name, [
+                    self._locator_record(data_type, r.get('id'), r) for r in records
+                ])
+        for name, items in groups.items():
+            with self._locked(name):
+                self._write_snapshot(name, [record for _, record in items])
+
+    def upsert(self, data_type, record, record_id=None):
+        """Insert or replace a single record."""
+        return self.upsert_many(data_type, [record], [record_id] if record_id is not None else None)
+
+    def upsert_many(self, data_type, records, record_ids=None):
+        """Insert or replace several records with one journal append per file."""
+        if record_ids is None:
+            record_ids = [r['id'] for r in records]
+        try:
+            old = None
+            if self._write_hooks.get(data_type):
+                key = self.shards[data_type]['key'] if self.is_sharded(data_type) else None
+                old = self._previous(data_type, record_ids, [r.get(key) if key else None for r in records])
+            if not self.is_sharded(data_type):
+                self._append(data_type, [
+                    {'op': 'upsert', 'id': rid, 'record': record}
+                    for rid, record in zip(record_ids, records)
+                ])
+                if old is not None:
+                    self._written(data_type, list(zip(record_ids, old, records)))
+                return True
+
+            for name, items in self._group_by_shard(data_type, records, record_ids).items():
+                self._append(name, [{'op': 'upsert', 'id': rid, 'record': record} for rid, record in items])
+            if self.shards[data_type].get('cross_index'):
+                self._append(f'{data_type}_index', [
+                    {'op': 'upsert', 'id': rid, 'record': self._locator_record(data_type, rid, record)}
+                    for rid, record in zip(record_ids, records)
+                ])
+            if old is not None:
+                self._written(data_type, list(zip(record_ids, old, records)))
+            return True
+        except Exception as e:
+            logger.error(f"Error saving {data_type} record: {e}")
+            return False
+
+    def update(self, data_type, record_id, fn, shard=None):
+        """Read-modify-write one record under the collection's write lock.
+
+        ``fn`` receives a private copy of the record and modifies it in place
+        (returning False aborts the write). Concurrent updates from other
+        threads or workers are serialized, so none of them is lost. Returns
+        the updated record, or None if it doesn't exist or was not written.
+        """
+        with self._lock:
+            if self.is_sharded(data_type):
+                name = self._shard(data_type, shard) if shard is not None else self._locator(data_type, record_id)
+            else:
+                name = data_type
+        if name is None:
+            return None
+        with self._locked(name):
+            record = self.get_record(data_type, record_id, shard=shard)
+            if record is None or fn(record) is False:
+                return None
+            if not self.upsert(data_type, record, record_id=record_id):
+                return None
+            return record
+
+    def delete(self, data_type, record_id, shard=None):
+        try:
+            old = self._previous(data_type, [record_id], [shard]) if self._write_hooks.get(data_type) else None
+            if not self.is_sharded(data_type):
+                self._append(data_type, [{'op': 'delete', 'id': record_id}])
+                if old is not None:
+                    self._written(data_type, [(record_id, old[0], None)])
+                return True
+
+            with self._lock:
+                name = self._shard(data_type, shard) if shard is not None else self._locator(data_type, record_id)
+            if name is None:
+                return False
+            self._append(name, [{'op': 'delete', 'id': record_id}])
+            if self.shards[data_type].get('cross_index'):
+                self._append(f'{data_type}_index', [{'op': 'delete', 'id': record_id}])
+            if old is not None:
+                self._written(data_type, [(record_id, old[0], None)])
+            return True
+        except Exception as e:
+            logger.error(f"Error deleting {data_type} record {record_id}: {e}")
+            return False
+
+    def split_shards(self):
+        """One-shot migration of monolithic collections into per-user shards.
+
+        The original ``<type>.json`` is kept as ``<type>.json.migrated``.
+        Returns {data_type: number of records moved}.
+        """
+        if self.layout != 'sharded':
+            raise RuntimeError("split_shards requires layout='sharded'")
+        moved = {}
+        for data_type in self.shards:
+            snapshot = self._snapshot_path(data_type)
+            journal = self._journal_path(data_type)
+            with self._locked(data_type):
+                if not (os.path.exists(snapshot) or os.path.exists(journal)):
+                    continue
+                with self._lock:
+                    records = self._entry(data_type).view()
+                # Merge with anything already written in the sharded layout
+                existing = {r.get('id'): r for r in self.read_data(data_type)}
+                existing.update((r.get('id'), r) for r in records)
+                self._write_shards(data_type, list(existing.values()))
+                if os.path.exists(snapshot):
+                    os.replace(snapshot, snapshot + '.migrated')
+                if os.path.exists(journal):
+                    os.replace(journal, journal + '.migrated')
+                with self._lock:
+                    self._cache.pop(data_type, None)
+            moved[data_type] = len(records)
+            logger.info(f"Split {len(records)} {data_type} records into per-user shards")
+        return moved
+
+    # -- Compaction -------------------------------------------------------
+
+    def compact(self, name):
+        """Fold the journal of one collection file into its snapshot."""
+        with self._locked(name):
+            if not os.path.exists(self._journal_path(name)):
+                return False
+            with self._lock:
+                data = self._entry(name).view()
+            self._write_snapshot(name, data)
+            logger.info(f"Compacted {name} journal")
+            return True
+
+    def _journals(self):
+        for root, _, files in os.walk(self.data_dir):
+            for file in files:
+                if file.endswith('.journal'):
+                    path = os.path.join(root, file)
+                    name = os.path.relpath(path, self.data_dir)[:-len('.journal')]
+                    yield name.replace(os.sep, '/'), path
+
+    def compact_all(self):
+        for name, _ in list(self._journals()):
+            try:
+                self.compact(name)
+            except Exception as e:
+                logger.error(f"Compaction of {name} failed: {e}")
+
+    def _schedule_compaction(self):
+        with self._lock:
+            if self._compactor is None or not self._compactor.is_alive():
+                self._compactor = threading.Thread(
+                    target=self._compaction_loop, name='journal-compactor', daemon=True
+                )
+                self._compactor.start()
+        self._compact_wakeup.set()
+
+    def _compaction_loop(self):
+        while True:
+            self._compact_wakeup.wait(self.compact_interval)
+            self._compact_wakeup.clear()
+            for name, path in list(self._journals()):
+                try:
+                    if os.path.getsize(path) >= self.compact_threshold:
+                        self.compact(name)
+                except OSError:
+                    continue
+                except Exception as e:
+                    logger.error(f"Background compaction of {name} failed: {e}")
+            # Debounce bursts of writes
+            time.sleep(1)
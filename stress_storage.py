@@ -0,0 +1,93 @@
+"""Stress test for the JSON storage engine (storage.py) across processes.
+
+Starts several worker processes that hammer one data directory at the same
+time, like gunicorn workers do: each one adds reminders, completes them with
+a read-modify-write update and bumps a shared counter record. A tiny
+compaction threshold makes compactions run in the middle of all this.
+Afterwards the data is reloaded from disk and checked for lost updates.
+
+Usage: python stress_storage.py [--workers 8] [--ops 200] [--sharded]
+"""
+import argparse
+import multiprocessing
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+from storage import DataManager
+
+INDEXES = {'reminders': ('user_id',)}
+SHARDS = {'reminders': {'key': 'user_id'}}
+
+
+def make_dm(data_dir, sharded, compact_threshold=4096):
+    return DataManager(data_dir, compact_threshold=compact_threshold, compact_interval=0.5,
+                       indexes=INDEXES, layout='sharded' if sharded else 'monolithic', shards=SHARDS)
+
+
+def worker(data_dir, sharded, worker_id, ops):
+    dm = make_dm(data_dir, sharded)
+    # Two workers share each user so shards see concurrent writers too
+    user = f'user{worker_id // 2}@test.com'
+    for i in range(ops):
+        reminder_id = str(uuid.uuid4())
+        dm.upsert('reminders', {
+            'id': reminder_id,
+            'user_id': user,
+            'title': f'w{worker_id}-{i}',
+            'completed': False,
+        })
+        if dm.update('reminders', reminder_id, lambda r: r.update(completed=True), shard=user) is None:
+            raise RuntimeError(f"worker {worker_id}: update of {reminder_id} found no record")
+        dm.update('counters', 'ops', lambda c: c.update(value=c['value'] + 1))
+        if i % 50 == 0:
+            dm.compact('counters')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--ops', type=int, default=200)
+    parser.add_argument('--sharded', action='store_true')
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix='smartreminder-stress-')
+    try:
+        make_dm(data_dir, args.sharded).save_data('counters', [{'id': 'ops', 'value': 0}])
+
+        started = time.time()
+        procs = [
+            multiprocessing.Process(target=worker, args=(data_dir, args.sharded, n, args.ops))
+            for n in range(args.workers)
+        ]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        elapsed = time.time() - started
+
+        failed = [p.exitcode for p in procs if p.exitcode != 0]
+        dm = make_dm(data_dir, args.sharded)
+        expected = args.workers * args.ops
+        reminders = dm.read_data('reminders')
+        counter = dm.get_record('counters', 'ops')['value']
+        incomplete = [r['id'] for r in reminders if not r.get('completed')]
+        indexed = sum(len(dm.find('reminders', 'user_id', f'user{n}@test.com'))
+                      for n in range((args.workers + 1) // 2))
+
+        print(f"{args.workers} workers x {args.ops} ops in {elapsed:.2f}s "
+              f"({3 * expected / elapsed:.0f} writes/s)")
+        print(f"reminders: {len(reminders)}/{expected}, indexed: {indexed}/{expected}, "
+              f"incomplete: {len(incomplete)}, counter: {counter}/{expected}")
+
+        ok = not failed and len(reminders) == expected == indexed == counter and not incomplete
+        print("OK" if ok else "LOST UPDATES")
+        return 0 if ok else 1
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
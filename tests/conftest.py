@@ -0,0 +1,38 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top level of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """app.py on a scratch database and data directory (imported once per run).
+
+    The JSON data directory and the database path are relative, so the run
+    stays in the scratch directory until the session ends.
+    """
+    root = tmp_path_factory.mktemp('app')
+    cwd = os.getcwd()
+    os.chdir(root)
+    os.environ['DATABASE_PATH'] = str(root / 'smartreminder.db')
+    try:
+        import app
+        app.app.config['WTF_CSRF_ENABLED'] = False
+        assert app.init_db()
+        yield app
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture
+def login(app_module):
+    """login(email) -> a test client with a registered, logged-in user."""
+    def login(email, password='password123'):
+        client = app_module.app.test_client()
+        client.post('/register', data={'username': email, 'password': password})
+        client.post('/login', data={'username': email, 'password': password})
+        return client
+    return login
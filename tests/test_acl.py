@@ -0,0 +1,91 @@
+import pytest
+
+from acl import AccessList
+from storage import DataManager
+
+OWNER, EDITOR, VIEWER, STRANGER = 'owner@example.com', 'editor@example.com', 'viewer@example.com', 'x@example.com'
+
+
+@pytest.fixture
+def acl(tmp_path):
+    dm = DataManager(data_dir=str(tmp_path / 'data'), indexes={'acl': ('item', 'principal')})
+    acl = AccessList(dm)
+    acl.grant('note', 'n1', [EDITOR], role='editor', owner=OWNER)
+    acl.grant('note', 'n1', [VIEWER], role='viewer', owner=OWNER)
+    return acl
+
+
+@pytest.mark.parametrize('principal, role, allowed', [
+    (OWNER, 'viewer', True), (OWNER, 'editor', True), (OWNER, 'owner', True),
+    (EDITOR, 'viewer', True), (EDITOR, 'editor', True), (EDITOR, 'owner', False),
+    (VIEWER, 'viewer', True), (VIEWER, 'editor', False), (VIEWER, 'owner', False),
+    (STRANGER, 'viewer', False), (None, 'viewer', False),
+])
+def test_can_ranks_roles(acl, principal, role, allowed):
+    assert acl.can('note', 'n1', principal, role, owner=OWNER) is allowed
+
+
+def test_roles_are_per_item_and_case_insensitive(acl):
+    assert acl.role('note', 'n1', 'Editor@Example.com', owner=OWNER) == 'editor'
+    assert acl.role('note', 'n1', 'OWNER@example.com', owner=OWNER) == 'owner'
+    assert acl.role('note', 'n2', EDITOR, owner=OWNER) is None
+    assert acl.role('reminder', 'n1', EDITOR, owner=OWNER) is None
+
+
+def test_shared_with_lists_what_a_principal_can_see(acl):
+    acl.grant('reminder', 'r1', [VIEWER], owner=OWNER)
+
+    assert [e['item'] for e in acl.shared_with(EDITOR)] == ['note:n1']
+    assert sorted(e['item'] for e in acl.shared_with(' Viewer@example.com ')) == ['note:n1', 'reminder:r1']
+    assert [e['item_id'] for e in acl.shared_with(VIEWER, 'reminder')] == ['r1']
+    assert acl.shared_with(OWNER) == [] and acl.shared_with(STRANGER) == []
+
+
+def test_grant_skips_the_owner_and_duplicates(acl):
+    entries = acl.grant('reminder', 'r1', [OWNER, 'a@example.com', 'A@example.com ', ''], owner=OWNER)
+    assert [e['principal'] for e in entries] == ['a@example.com']
+    assert acl.entry('reminder', 'r1', 'a@example.com')['role'] == 'editor'
+
+    # Granting again changes the role in place
+    acl.grant('note', 'n1', [VIEWER], role='editor', owner=OWNER)
+    assert sorted(acl.principals('note', 'n1')) == [EDITOR, VIEWER]
+    assert acl.can('note', 'n1', VIEWER, 'editor', owner=OWNER)
+
+
+def test_revoke(acl):
+    acl.revoke('note', 'n1', EDITOR)
+    assert not acl.can('note', 'n1', EDITOR, owner=OWNER)
+    assert acl.shared_with(EDITOR) == []
+
+    acl.revoke_all('note', 'n1')
+    assert acl.entries('note', 'n1') == [] and acl.shared_with(VIEWER) == []
+
+
+def test_migrate_sharing_turns_copies_and_member_lists_into_entries(app_module):
+    dm, acl = app_module.dm, app_module.acl
+    owner, a, b, c = 'mig-owner@example.com', 'mig-a@example.com', 'mig-b@example.com', 'mig-c@example.com'
+    dm.upsert('reminders', {'id': 'mig-r1', 'user_id': owner, 'title': 'Møte', 'shared_with': [a]})
+    dm.upsert('reminders', {'id': 'mig-r2', 'user_id': owner, 'title': 'Lunsj'})
+    dm.upsert('shared_reminders', {'id': 'mig-copy', 'original_id': 'mig-r2', 'shared_by': owner,
+                                   'shared_with': b, 'is_shared': True, 'title': 'Lunsj'})
+    dm.upsert('shared_reminders', {'id': 'mig-orphan', 'original_id': 'gone', 'shared_by': owner,
+                                   'shared_with': c, 'is_shared': True, 'title': 'Borte'})
+    dm.upsert('shared_notes', {'id': 'mig-n1', 'user_id': owner, 'title': 'Liste', 'shared_with': b,
+                               'members': [{'email': owner}, {'email': c}]})
+
+    result = app_module.app.test_cli_runner().invoke(args=['migrate-sharing'])
+    assert result.exit_code == 0
+    assert '4 access entries granted, 1 orphaned copies kept' in result.output
+
+    assert acl.role('reminder', 'mig-r1', a, owner=owner) == 'editor'
+    assert acl.role('reminder', 'mig-r2', b, owner=owner) == 'editor'
+    assert sorted(acl.principals('note', 'mig-n1')) == [b, c]
+    assert 'shared_with' not in dm.get_record('reminders', 'mig-r1', shard=owner)
+    assert 'members' not in dm.get_record('shared_notes', 'mig-n1')
+    assert dm.find('shared_reminders', 'shared_with', b) == [] and dm.find('shared_reminders', 'shared_with', c) == []
+    kept = dm.find('reminders', 'user_id', c)
+    assert [(r['id'], r['title']) for r in kept] == [('mig-orphan', 'Borte')] and 'original_id' not in kept[0]
+
+    # Nothing left to migrate the second time
+    again = app_module.app.test_cli_runner().invoke(args=['migrate-sharing'])
+    assert '0 access entries granted, 0 orphaned copies kept' in again.output
@@ -0,0 +1,145 @@
+import sqlite3
+
+import changes
+from database_upgrade import run_migrations
+
+
+def make_db(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'changes.db'))
+    run_migrations(conn)
+    return conn
+
+
+def audience(record):
+    return [record['user_id']] + record.get('shared_with', [])
+
+
+def log(conn, changed):
+    changes.record_changes(conn, 'reminders', changed, audience)
+    conn.commit()
+
+
+# -- changes.py ----------------------------------------------------------------
+
+def test_writes_are_logged_for_everyone_who_sees_the_record(tmp_path):
+    conn = make_db(tmp_path)
+    r1 = {'id': 'r1', 'user_id': 'a@example.com', 'shared_with': ['b@example.com'], 'title': 'x'}
+    log(conn, [('r1', None, r1)])
+
+    for principal in ('a@example.com', 'b@example.com'):
+        changed, cursor, more, reset = changes.changes_since(conn, principal, 0)
+        assert changed == [('reminders', 'r1', changes.UPSERT)] and not more and not reset
+    assert changes.changes_since(conn, 'c@example.com', 0)[0] == []
+
+
+def test_losing_access_and_deleting_leave_tombstones(tmp_path):
+    conn = make_db(tmp_path)
+    shared = {'id': 'r1', 'user_id': 'a@example.com', 'shared_with': ['b@example.com']}
+    log(conn, [('r1', None, shared)])
+    cursor = changes.current_cursor(conn)
+
+    unshared = dict(shared, shared_with=[])
+    log(conn, [('r1', shared, unshared)])
+    assert changes.changes_since(conn, 'b@example.com', cursor)[0] == [('reminders', 'r1', changes.DELETE)]
+
+    log(conn, [('r1', unshared, None)])
+    assert changes.changes_since(conn, 'a@example.com', cursor)[0] == [('reminders', 'r1', changes.DELETE)]
+
+
+def test_dispatcher_bookkeeping_is_not_a_change(tmp_path):
+    conn = make_db(tmp_path)
+    r1 = {'id': 'r1', 'user_id': 'a@example.com'}
+    log(conn, [('r1', None, r1)])
+    cursor = changes.current_cursor(conn)
+
+    log(conn, [('r1', r1, dict(r1, claim_token='w1:0:1', claim_until=1.0))])
+
+    assert changes.changes_since(conn, 'a@example.com', cursor)[:2] == ([], cursor)
+
+
+def test_only_the_latest_op_per_record_and_paging(tmp_path):
+    conn = make_db(tmp_path)
+    records = [{'id': f'r{n}', 'user_id': 'a@example.com'} for n in range(3)]
+    log(conn, [(r['id'], None, r) for r in records])
+    log(conn, [('r0', records[0], dict(records[0], title='changed'))])
+    log(conn, [('r1', records[1], None)])
+
+    changed, cursor, more, _ = changes.changes_since(conn, 'a@example.com', 0, limit=2)
+    assert changed == [('reminders', 'r0', 'upsert'), ('reminders', 'r1', 'upsert')] and more
+    changed, cursor, more, _ = changes.changes_since(conn, 'a@example.com', cursor, limit=2)
+    assert changed == [('reminders', 'r2', 'upsert'), ('reminders', 'r0', 'upsert')] and more
+    changed, cursor, more, _ = changes.changes_since(conn, 'a@example.com', cursor, limit=2)
+    assert changed == [('reminders', 'r1', 'delete')] and not more
+    assert cursor == changes.current_cursor(conn)
+
+
+def test_unknown_and_expired_cursors_reset(tmp_path):
+    conn = make_db(tmp_path)
+    log(conn, [('r1', None, {'id': 'r1', 'user_id': 'a@example.com'})])
+    old = changes.current_cursor(conn)
+    log(conn, [('r2', None, {'id': 'r2', 'user_id': 'a@example.com'})])
+
+    assert changes.changes_since(conn, 'a@example.com', old + 100)[3]
+    assert changes.changes_since(conn, 'a@example.com', -1)[3]
+
+    assert changes.prune(conn, -1) == 2  # everything is older than "now + 1 s"
+    assert changes.changes_since(conn, 'a@example.com', old)[3]
+    # Up to date before the prune: nothing was lost
+    assert not changes.changes_since(conn, 'a@example.com', changes.current_cursor(conn))[3]
+
+
+# -- /api/sync -------------------------------------------------------------------
+
+def add_reminder(client, title, share_with=''):
+    client.post('/add_reminder', data={'title': title, 'description': '', 'date': '2030-01-01', 'time': '10:00',
+                                       'priority': 'Lav', 'category': 'Jobb', 'share_with': share_with})
+
+
+def test_sync_returns_changes_and_deletes_after_the_cursor(app_module, login):
+    client = login('sync-a@example.com')
+    add_reminder(client, 'Før')
+    full = client.get('/api/sync').json
+    assert full['reset'] and [r['title'] for r in full['changes']['reminders']] == ['Før']
+
+    add_reminder(client, 'Etter')
+    delta = client.get(f"/api/sync?since={full['cursor']}").json
+    assert not delta['reset']
+    assert [r['title'] for r in delta['changes']['reminders']] == ['Etter']
+
+    before = app_module.dm.find('reminders', 'user_id', 'sync-a@example.com')[0]['id']
+    client.get(f'/delete_reminder/{before}')
+    delta = client.get(f"/api/sync?since={delta['cursor']}").json
+    assert delta['deleted']['reminders'] == [before] and delta['changes']['reminders'] == []
+
+
+def test_sync_tells_a_recipient_when_sharing_stops(app_module, login):
+    owner, recipient = login('sync-owner@example.com'), login('sync-recipient@example.com')
+    cursor = recipient.get('/api/sync').json['cursor']
+    add_reminder(owner, 'Felles', share_with='sync-recipient@example.com')
+    reminder_id = app_module.dm.find('reminders', 'user_id', 'sync-owner@example.com')[0]['id']
+
+    delta = recipient.get(f'/api/sync?since={cursor}').json
+    assert [r['id'] for r in delta['changes']['reminders']] == [reminder_id]
+
+    app_module.acl.revoke('reminder', reminder_id, 'sync-recipient@example.com')
+    delta = recipient.get(f"/api/sync?since={delta['cursor']}").json
+    assert delta['deleted']['reminders'] == [reminder_id]
+
+
+def test_sync_with_a_bad_or_expired_cursor(app_module, login):
+    client = login('sync-b@example.com')
+    add_reminder(client, 'Gammel')
+    cursor = client.get('/api/sync').json['cursor']
+
+    assert client.get('/api/sync?since=abc').status_code == 400
+    unknown = client.get(f'/api/sync?since={cursor + 10 ** 6}').json
+    assert unknown['reset'] and [r['title'] for r in unknown['changes']['reminders']] == ['Gammel']
+
+    add_reminder(client, 'Ny')
+    conn = sqlite3.connect(app_module.DB_PATH)
+    try:
+        changes.prune(conn, -1)
+    finally:
+        conn.close()
+    expired = client.get(f'/api/sync?since={cursor}').json
+    assert expired['reset'] and sorted(r['title'] for r in expired['changes']['reminders']) == ['Gammel', 'Ny']
@@ -0,0 +1,155 @@
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import threading
+
+import pytest
+
+import collab
+from database_upgrade import run_migrations
+
+COLLAB_JS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'js', 'collab.js')
+
+
+class Storage:
+    """The shared_notes collection, as far as CollabHub sees it."""
+
+    def __init__(self, **notes):
+        self.notes = {note_id: (text, 0) for note_id, text in notes.items()}
+
+    def load(self, note_id):
+        return self.notes.get(note_id)
+
+    def save(self, note_id, text, version):
+        if self.notes[note_id][1] < version:
+            self.notes[note_id] = (text, version)
+
+
+def make_hubs(tmp_path, storage, count=2):
+    path = str(tmp_path / 'collab.db')
+    conn = sqlite3.connect(path)
+    run_migrations(conn)
+    conn.close()
+    # One hub per web process, all on the same database file
+    return [collab.CollabHub(storage.load, storage.save, path=path, checkpoint_interval=3600, history=2)
+            for _ in range(count)]
+
+
+def test_concurrent_edits_in_two_processes_converge(tmp_path):
+    storage = Storage(n1='hello')
+    web1, web2 = make_hubs(tmp_path, storage)
+    assert web1.snapshot('n1') == ('hello', 0) == web2.snapshot('n1')
+
+    # Both made against version 0
+    first = web1.submit('n1', 0, [5, ' world'])
+    second = web2.submit('n1', 0, ['Oh, ', 5])
+    assert (first['version'], second['version']) == (1, 2)
+
+    assert web1.snapshot('n1') == ('Oh, hello world', 2) == web2.snapshot('n1')
+    assert [e['version'] for e in web1.since('n1', 1)] == [2]
+
+
+def test_long_poll_sees_an_operation_from_another_process(tmp_path):
+    storage = Storage(n1='')
+    web1, web2 = make_hubs(tmp_path, storage)
+    web1.poll_interval = 0.05
+    web1.snapshot('n1')
+    received = []
+    poller = threading.Thread(target=lambda: received.extend(web1.since('n1', 0, wait=5)))
+    poller.start()
+
+    web2.submit('n1', 0, ['hi'], author='b@example.com')
+    poller.join(5)
+
+    assert [(e['version'], e['op'], e['author']) for e in received] == [(1, ['hi'], 'b@example.com')]
+
+
+def test_operations_after_the_checkpoint_survive_a_restart(tmp_path):
+    storage = Storage(n1='')
+    web1, _ = make_hubs(tmp_path, storage)
+    for version, char in enumerate('abcde'):
+        web1.submit('n1', version, [version, char])
+    web1.checkpoint()
+    web1.submit('n1', 5, [5, 'f'])
+    assert storage.notes['n1'] == ('abcde', 5)
+
+    # Not checkpointed yet; a new process still gets it from note_ops
+    restarted, = make_hubs(tmp_path, storage, count=1)
+    assert restarted.snapshot('n1') == ('abcdef', 6)
+
+
+def test_a_process_behind_the_pruned_operations_reloads(tmp_path):
+    storage = Storage(n1='')
+    web1, web2 = make_hubs(tmp_path, storage)
+    assert web2.snapshot('n1') == ('', 0)
+    for version, char in enumerate('abcde'):
+        web1.submit('n1', version, [version, char])
+    # Saves version 5 and drops the operations up to 3
+    web1.checkpoint()
+
+    assert web2.snapshot('n1') == ('abcde', 5)
+    assert web2.stats()['reloads'] == 1
+
+
+def run_js(expression, data):
+    """Evaluate expression (with ``ops`` = collab.js's collabOps and ``data``) under node."""
+    if shutil.which('node') is None:
+        pytest.skip('node is not installed')
+    script = (f"const ops = require({json.dumps(COLLAB_JS)});"
+              f"const data = JSON.parse(require('fs').readFileSync(0, 'utf8'));"
+              f"process.stdout.write(JSON.stringify({expression}));")
+    result = subprocess.run(['node', '-e', script], input=json.dumps(data), capture_output=True, text=True,
+                            check=True)
+    return json.loads(result.stdout)
+
+
+def random_op(rng, text):
+    op, index = [], 0
+    while index < len(text):
+        n = rng.randint(1, len(text) - index)
+        kind = rng.random()
+        if kind < 0.3:
+            collab._push(op, -n)
+        else:
+            collab._push(op, n)
+        if kind > 0.7:
+            collab._push(op, rng.choice(['x', 'yz', '\u00e6\u00f8', '\U0001f600']))
+        index += n
+    if rng.random() < 0.5:
+        collab._push(op, rng.choice(['end', '!']))
+    return op
+
+
+def test_javascript_transform_matches_python():
+    rng = random.Random(21)
+    cases = []
+    for _ in range(200):
+        text = ''.join(rng.choice('abc\u00e5\U0001f600') for _ in range(rng.randint(0, 12)))
+        cases.append((text, random_op(rng, text), random_op(rng, text)))
+
+    results = run_js("data.map(([text, a, b]) => ops.transform(a, b))", cases)
+
+    for (text, a, b), (a_js, b_js) in zip(cases, results):
+        assert [a_js, b_js] == [list(x) for x in collab.transform(a, b)]
+        assert collab.apply(collab.apply(text, a), b_js) == collab.apply(collab.apply(text, b), a_js)
+
+
+def test_client_rebases_a_remote_edit_over_pending_and_unsent_edits():
+    doc = collab.LiveDocument('n1', 'abcd')
+    # Sent, not yet acknowledged; then the user deletes the "a" locally
+    pending = [4, 'X']
+    shadow, value = 'abcdX', 'bcdX'
+    remote = doc.submit(0, [2, 'Z', 2], client_id='other')
+
+    state = run_js("ops.rebase(...data)", [shadow, pending, value, remote['op']])
+
+    # Our edit reaches the server, then whatever is left in the textarea
+    doc.submit(0, pending, client_id='me')
+    assert state['shadow'] == doc.text == 'abZcdX'
+    assert state['text'] == 'bZcdX'
+    unsent = run_js("ops.diff(...data)", [state['shadow'], state['text']])
+    doc.submit(doc.version, unsent, client_id='me')
+    assert doc.text == state['text']
@@ -0,0 +1,263 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from database_upgrade import run_migrations
+from dispatcher import HighWaterMark, ReminderDispatcher, partition_of
+from leases import Lease, live_holders
+from storage import DataManager
+from worker import DispatchPartitions, SchedulerWorker
+
+
+def make_db(tmp_path):
+    path = str(tmp_path / 'dispatch.db')
+    conn = sqlite3.connect(path)
+    run_migrations(conn)
+    conn.close()
+    return path
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+class Service:
+    def __init__(self, token=None):
+        self.token = token
+        self.running = False
+
+    def start(self):
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def stats(self):
+        return {}
+
+
+# -- Leases ----------------------------------------------------------------
+
+def test_a_lease_has_one_holder_until_it_expires(tmp_path):
+    path = make_db(tmp_path)
+    worker1 = Lease('scheduler', ttl=0.3, holder='w1', path=path)
+    worker2 = Lease('scheduler', ttl=0.3, holder='w2', path=path)
+
+    assert worker1.try_acquire()
+    assert not worker2.try_acquire()
+    assert worker1.try_acquire()  # renewed
+    assert worker2.current_holder() == 'w1'
+
+    time.sleep(0.4)  # w1 stopped renewing
+    assert worker2.try_acquire()
+    assert not worker1.try_acquire()
+
+
+def test_a_released_lease_is_free_at_once(tmp_path):
+    path = make_db(tmp_path)
+    worker1 = Lease('scheduler', ttl=60, holder='w1', path=path)
+    worker2 = Lease('scheduler', ttl=60, holder='w2', path=path)
+    worker1.try_acquire()
+
+    worker1.release()
+
+    assert worker2.try_acquire()
+    assert live_holders('sched', path) == {'scheduler': 'w2'}
+
+
+def test_the_scheduler_fails_over_to_the_other_worker(tmp_path):
+    path = make_db(tmp_path)
+    workers = [SchedulerWorker(Lease('scheduler', ttl=0.3, holder=holder, path=path)) for holder in ('w1', 'w2')]
+    services = [Service(), Service()]
+    ran = []
+    for worker, service in zip(workers, services):
+        worker.add_service(service)
+        worker.scheduler.start(paused=True)
+    job = workers[0].guard(lambda: ran.append('w1'))
+    try:
+        workers[0].heartbeat()
+        workers[1].heartbeat()
+        assert [w.leading for w in workers] == [True, False]
+        assert [s.running for s in services] == [True, False]
+        job()
+
+        time.sleep(0.4)  # w1 hangs past its lease
+        workers[1].heartbeat()
+        workers[0].heartbeat()
+        assert [w.leading for w in workers] == [False, True]
+        assert [s.running for s in services] == [False, True]
+        with pytest.raises(RuntimeError):
+            job()
+        assert ran == ['w1']
+    finally:
+        for worker in workers:
+            worker.scheduler.shutdown(wait=False)
+
+
+def test_dispatch_partitions_are_shared_and_taken_over(tmp_path):
+    path = make_db(tmp_path)
+    started = []
+
+    def make_service(k, token):
+        started.append(token)
+        return Service(token)
+
+    workers = [DispatchPartitions(4, make_service, holder, ttl=0.5, path=path) for holder in ('w1', 'w2')]
+    workers[0].heartbeat()
+    assert sorted(workers[0].running) == [0, 1, 2, 3]
+
+    # w2 joins: w1 hands back its share above ceil(4 / 2), w2 takes it
+    workers[1].heartbeat()
+    workers[0].heartbeat()
+    workers[1].heartbeat()
+    assert len(workers[0].running) == len(workers[1].running) == 2
+    assert not set(workers[0].running) & set(workers[1].running)
+
+    time.sleep(0.6)  # w1 stops heartbeating
+    workers[1].heartbeat()
+    assert sorted(workers[1].running) == [0, 1, 2, 3]
+    # Every tenure gets its own claim token
+    assert len(set(started)) == len(started)
+
+
+# -- High-water mark and catch-up ------------------------------------------
+
+def test_the_high_water_mark_never_moves_back(tmp_path):
+    path = make_db(tmp_path)
+    mark1, mark2 = HighWaterMark(path=path), HighWaterMark(path=path)
+    assert mark1.load() is None
+
+    mark1.save(200.0)
+    mark2.save(100.0)  # an overlapping dispatcher that is behind
+
+    assert mark2.load() == 200.0
+
+
+def make_dispatcher(tmp_path, path, notified, **kwargs):
+    dm = DataManager(data_dir=str(tmp_path / 'data'))
+
+    def notify(items):
+        notified.extend(items)
+        return []
+
+    return dm, ReminderDispatcher(dm, notify, advance_minutes=0, refresh_interval=0.05,
+                                  high_water=HighWaterMark(path=path), **kwargs)
+
+
+def test_reminders_due_during_downtime_are_caught_up(tmp_path):
+    path = make_db(tmp_path)
+    now = int(time.time())
+    HighWaterMark(path=path).save(now - 600)
+    notified = []
+    dm, dispatcher = make_dispatcher(tmp_path, path, notified)
+    dm.upsert_many('reminders', [
+        {'id': 'late', 'user_id': 'a@example.com', 'due_ts': now - 300},
+        {'id': 'too-old', 'user_id': 'a@example.com', 'due_ts': now - 900},
+        {'id': 'sent', 'user_id': 'a@example.com', 'due_ts': now - 300, 'notification_sent': True},
+        {'id': 'upcoming', 'user_id': 'a@example.com', 'due_ts': now + 3600},
+    ])
+
+    dispatcher.start()
+    try:
+        assert wait_for(lambda: notified)
+        assert wait_for(lambda: dispatcher.stats()['missed'] == 1)
+    finally:
+        dispatcher.stop()
+
+    assert [item['id'] for item in notified] == ['late']
+    assert dispatcher.stats()['late'] == 1
+    assert HighWaterMark(path=path).load() >= now
+
+
+def test_partitions_split_the_recipients(tmp_path):
+    path = make_db(tmp_path)
+    now = int(time.time())
+    emails = [f'user{n}@example.com' for n in range(8)]
+    notified = [[], []]
+    dispatchers = []
+    for k in range(2):
+        dm, dispatcher = make_dispatcher(tmp_path, path, notified[k], partition=(k, 2))
+        dispatchers.append(dispatcher)
+    dm.upsert_many('reminders', [{'id': email, 'user_id': email, 'due_ts': now + 1} for email in emails])
+
+    for dispatcher in dispatchers:
+        dispatcher.start()
+    try:
+        assert wait_for(lambda: len(notified[0]) + len(notified[1]) == len(emails))
+    finally:
+        for dispatcher in dispatchers:
+            dispatcher.stop()
+
+    for k in range(2):
+        assert {item['email'] for item in notified[k]} == {e for e in emails if partition_of(e, 2) == k}
+
+
+# -- Claim tokens (app.claim_notification / mark_notification_sent) ---------
+
+def reminder_item(app_module, reminder_id, email, title='Tannlege'):
+    due_at = int(time.time()) - 60
+    app_module.dm.upsert('reminders', {'id': reminder_id, 'user_id': email, 'title': title,
+                                       'datetime': '2030-01-01 10:00', 'due_ts': due_at})
+    return {'id': reminder_id, 'email': email, 'source': 'reminders', 'title': title, 'description': '',
+            'priority': None, 'datetime': '2030-01-01 10:00', 'occurrence': None, 'due_at': due_at}
+
+
+def test_only_the_claim_holder_marks_a_reminder_sent(app_module):
+    item = reminder_item(app_module, 'claim-1', 'claim@example.com')
+
+    assert app_module.claim_notification(item, 'w1:0:1')
+    assert not app_module.claim_notification(item, 'w2:0:2')
+    app_module.mark_notification_sent(item, 'w2:0:2')
+    assert not app_module.dm.get_record('reminders', 'claim-1').get('notification_sent')
+
+    app_module.mark_notification_sent(item, 'w1:0:1')
+    assert app_module.dm.get_record('reminders', 'claim-1')['notification_sent']
+    assert not app_module.claim_notification(item, 'w2:0:2')
+
+
+def test_an_expired_claim_passes_to_the_next_holder(app_module):
+    item = reminder_item(app_module, 'claim-2', 'claim@example.com')
+    app_module.claim_notification(item, 'w1:0:1')
+    app_module.dm.update('reminders', 'claim-2', lambda r: r.update(claim_until=time.time() - 1))
+
+    assert app_module.claim_notification(item, 'w2:0:2')
+    # The first holder finishing late doesn't count any more
+    app_module.mark_notification_sent(item, 'w1:0:1')
+    assert not app_module.dm.get_record('reminders', 'claim-2').get('notification_sent')
+
+
+def test_overlapping_dispatchers_send_a_reminder_once(app_module, login, monkeypatch):
+    # Only queued in the outbox; nothing is sent
+    monkeypatch.setitem(app_module.app.config, 'MAIL_USERNAME', 'smartreminder@example.com')
+    monkeypatch.setitem(app_module.app.config, 'MAIL_PASSWORD', 'secret')
+    login('overlap@example.com')
+    dentist = reminder_item(app_module, 'claim-3', 'overlap@example.com', 'Tannlege')
+    haircut = reminder_item(app_module, 'claim-4', 'overlap@example.com', 'Frisør')
+    # A partition's old and new holder overlap; their batches differ, so the
+    # outbox's dedupe key alone would let the dentist reminder out twice
+    batches = {'w1:0:1': [dentist], 'w2:0:2': [dentist, haircut]}
+    failed = []
+    threads = [threading.Thread(target=lambda t=token: failed.extend(app_module.send_reminder_notifications(batches[t], t)))
+               for token in batches]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    conn = sqlite3.connect(app_module.DB_PATH)
+    try:
+        queued = [html for html, in conn.execute(
+            "SELECT html FROM outbox WHERE recipients LIKE '%overlap@example.com%' AND subject LIKE 'Påminnelse%'")]
+    finally:
+        conn.close()
+    assert failed == []
+    assert sum('Tannlege' in html for html in queued) == 1
+    assert sum('Frisør' in html for html in queued) == 1
+    assert app_module.dm.get_record('reminders', 'claim-3')['notification_sent']
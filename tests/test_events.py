@@ -0,0 +1,64 @@
+import sqlite3
+
+from database_upgrade import run_migrations
+from events import EventBroker, Slots
+
+
+def make_db(tmp_path):
+    path = str(tmp_path / 'events.db')
+    conn = sqlite3.connect(path)
+    run_migrations(conn)
+    conn.close()
+    return path
+
+
+def test_events_published_in_one_process_reach_another(tmp_path):
+    path = make_db(tmp_path)
+    # Two brokers on one database file stand in for two web processes
+    web1, web2 = EventBroker(path), EventBroker(path)
+    sub = web1.subscribe('a@example.com')
+
+    web2.publish(['a@example.com', 'b@example.com'], 'note.created', {'id': 'n1'})
+    web1.poll()
+
+    event = sub.get(timeout=1)
+    assert event['type'] == 'note.created' and event['data'] == {'id': 'n1'}
+    assert sub.get(timeout=0.01) is None
+
+
+def test_reconnecting_elsewhere_replays_what_was_missed(tmp_path):
+    path = make_db(tmp_path)
+    web1, web2 = EventBroker(path), EventBroker(path)
+    sub = web1.subscribe('a@example.com')
+    web1.publish(['a@example.com'], 'reminder.created', {'id': 'r1'})
+    web1.poll()
+    seen = sub.get(timeout=1)
+    web1.unsubscribe(sub)
+
+    web1.publish(['a@example.com'], 'reminder.deleted', {'id': 'r1'})
+    web1.publish(['b@example.com'], 'reminder.created', {'id': 'r2'})
+
+    resumed = web2.subscribe('a@example.com', last_event_id=seen['id'])
+    assert not resumed.reset
+    assert resumed.get(timeout=1)['type'] == 'reminder.deleted'
+    assert resumed.get(timeout=0.01) is None
+
+    events, reset, newest = web2.replay('a@example.com', seen['id'])
+    assert [e['type'] for e in events] == ['reminder.deleted'] and not reset
+    assert newest == int(events[0]['id']) + 1
+
+
+def test_unknown_last_event_id_resets(tmp_path):
+    broker = EventBroker(make_db(tmp_path))
+    broker.publish(['a@example.com'], 'note.created', {'id': 'n1'})
+    assert broker.subscribe('a@example.com', last_event_id='999').reset
+    assert broker.subscribe('a@example.com', last_event_id='1700000000-3').reset
+
+
+def test_slots_refuse_above_the_limit():
+    slots = Slots(2)
+    assert slots.acquire() and slots.acquire()
+    assert not slots.acquire()
+    slots.release()
+    assert slots.acquire()
+    assert slots.stats() == {'limit': 2, 'in_use': 2, 'rejected': 1}
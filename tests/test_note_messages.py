@@ -0,0 +1,112 @@
+import sqlite3
+import threading
+
+import note_messages
+from database_upgrade import run_migrations
+
+
+def make_db(tmp_path):
+    path = str(tmp_path / 'messages.db')
+    conn = sqlite3.connect(path)
+    run_migrations(conn)
+    return conn, path
+
+
+def test_pages_walk_back_from_the_latest_message(tmp_path):
+    conn, _ = make_db(tmp_path)
+    for n in range(1, 8):
+        note_messages.post(conn, 'n1', 'a@example.com', f'melding {n}')
+    note_messages.post(conn, 'n2', 'a@example.com', 'annet notat')
+
+    messages, cursor = note_messages.page(conn, 'n1', limit=3)
+    assert [m['seq'] for m in messages] == [5, 6, 7] and cursor == 5
+    messages, cursor = note_messages.page(conn, 'n1', before=cursor, limit=3)
+    assert [m['seq'] for m in messages] == [2, 3, 4] and cursor == 2
+    messages, cursor = note_messages.page(conn, 'n1', before=cursor, limit=3)
+    assert [m['content'] for m in messages] == ['melding 1'] and cursor is None
+
+    assert note_messages.count(conn, 'n1') == 7
+    assert note_messages.page(conn, 'empty') == ([], None)
+
+
+def test_an_exact_last_page_has_no_cursor(tmp_path):
+    conn, _ = make_db(tmp_path)
+    for n in range(4):
+        note_messages.post(conn, 'n1', 'a@example.com', str(n))
+
+    messages, cursor = note_messages.page(conn, 'n1', limit=2)
+    messages, cursor = note_messages.page(conn, 'n1', before=cursor, limit=2)
+    assert [m['seq'] for m in messages] == [1, 2] and cursor is None
+
+
+def test_concurrent_posts_get_distinct_seqs(tmp_path):
+    _, path = make_db(tmp_path)
+
+    def poster(name):
+        conn = sqlite3.connect(path, timeout=10)
+        for n in range(20):
+            note_messages.post(conn, 'n1', name, str(n))
+        conn.close()
+
+    threads = [threading.Thread(target=poster, args=(f'{i}@example.com',)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    conn = sqlite3.connect(path)
+    messages, _ = note_messages.page(conn, 'n1', limit=100)
+    assert [m['seq'] for m in messages] == list(range(1, 81))
+
+
+def test_import_embedded_runs_once_per_note(tmp_path):
+    conn, _ = make_db(tmp_path)
+    embedded = [{'sender': 'a@example.com', 'content': 'hei', 'timestamp': '2024-01-01T10:00:00'},
+                {'sender': 'b@example.com', 'content': 'hallo'}]
+
+    assert note_messages.import_embedded(conn, 'n1', embedded) == 2
+    assert note_messages.import_embedded(conn, 'n1', embedded) == 0
+
+    messages, _ = note_messages.page(conn, 'n1')
+    assert [(m['seq'], m['sender'], m['timestamp']) for m in messages] == \
+        [(1, 'a@example.com', '2024-01-01T10:00:00'), (2, 'b@example.com', '')]
+
+
+def create_note(app_module, owner):
+    response = owner.post('/shared-notes/create', data={'title': 'Prat', 'content': ''})
+    return response.headers['Location'].rsplit('/', 1)[-1]
+
+
+def test_messages_api_pages_through_the_chat(app_module, login):
+    owner = login('chat-owner@example.com')
+    note_id = create_note(app_module, owner)
+    for n in range(5):
+        owner.post(f'/shared-notes/message/{note_id}', data={'message': f'melding {n}'})
+
+    page = owner.get(f'/shared-notes/messages/{note_id}?limit=2').json
+    assert [m['content'] for m in page['messages']] == ['melding 3', 'melding 4']
+    assert page['count'] == 5 and page['before'] == 4
+    page = owner.get(f"/shared-notes/messages/{note_id}?limit=2&before={page['before']}").json
+    assert [m['content'] for m in page['messages']] == ['melding 1', 'melding 2']
+
+    outsider = login('chat-outsider@example.com')
+    assert outsider.get(f'/shared-notes/messages/{note_id}').status_code == 404
+
+
+def test_migrate_note_messages_moves_embedded_lists(app_module, login):
+    owner = login('migrate-chat@example.com')
+    note_id = create_note(app_module, owner)
+    embedded = [{'sender': 'migrate-chat@example.com', 'content': f'gammel {n}',
+                 'timestamp': f'2024-01-0{n + 1}T10:00:00'} for n in range(3)]
+    app_module.dm.update('shared_notes', note_id, lambda n: n.update(messages=embedded))
+
+    runner = app_module.app.test_cli_runner()
+    result = runner.invoke(args=['migrate-note-messages'])
+    assert result.exit_code == 0 and '3 message(s) moved' in result.output
+
+    assert 'messages' not in app_module.dm.get_record('shared_notes', note_id)
+    page = owner.get(f'/shared-notes/messages/{note_id}').json
+    assert [m['content'] for m in page['messages']] == ['gammel 0', 'gammel 1', 'gammel 2']
+
+    # A second run finds nothing left to move
+    assert '0 message(s) moved' in runner.invoke(args=['migrate-note-messages']).output
@@ -0,0 +1,63 @@
+import sqlite3
+import time
+
+from database_upgrade import run_migrations
+from outbox import OutboxSender, enqueue
+
+
+class FakeSession:
+    connections = 1
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+    def close(self):
+        pass
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_sent_rows_are_purged_while_the_sender_runs(tmp_path):
+    path = str(tmp_path / 'outbox.db')
+    conn = sqlite3.connect(path)
+    run_migrations(conn)
+
+    sessions = []
+
+    def open_session():
+        sessions.append(FakeSession())
+        return sessions[-1]
+
+    sender = OutboxSender(path, open_session, threads=2, poll_interval=0.05, keep_sent_days=1,
+                          purge_interval=0.1)
+    sender.start()
+    try:
+        first = enqueue(conn, 'a@example.com', 'first', '<p>1</p>')
+        assert wait_for(lambda: conn.execute("SELECT status FROM outbox WHERE id = ?",
+                                             (first,)).fetchone()[0] == 'sent')
+
+        # Sent two days ago, i.e. past the retention period
+        conn.execute("UPDATE outbox SET sent_at = ? WHERE id = ?", (time.time() - 2 * 86400, first))
+        conn.commit()
+        recent = enqueue(conn, 'b@example.com', 'recent', '<p>2</p>')
+
+        assert wait_for(lambda: conn.execute("SELECT COUNT(*) FROM outbox WHERE id = ?",
+                                             (first,)).fetchone()[0] == 0)
+        assert wait_for(lambda: conn.execute("SELECT status FROM outbox WHERE id = ?",
+                                             (recent,)).fetchone()[0] == 'sent')
+        time.sleep(0.3)
+        assert conn.execute("SELECT COUNT(*) FROM outbox WHERE id = ?", (recent,)).fetchone()[0] == 1
+        assert sender.stats()['purged'] == 1
+    finally:
+        sender.stop()
+        conn.close()
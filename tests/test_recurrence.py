@@ -0,0 +1,113 @@
+from datetime import datetime
+
+import recurrence
+import timekeys
+
+MONTHLY = {'freq': 'monthly'}
+
+
+def occurrences(start, rule, range_start, range_end):
+    return [recurrence.format_occurrence(dt)
+            for dt in recurrence.occurrences_between(start, rule, range_start, range_end)]
+
+
+# -- Month ends --------------------------------------------------------------
+
+def test_the_31st_falls_on_the_last_day_of_shorter_months():
+    assert occurrences('2024-01-31 09:00', MONTHLY, '2024-01-01', '2024-06-01') == [
+        '2024-01-31 09:00:00', '2024-02-29 09:00:00', '2024-03-31 09:00:00', '2024-04-30 09:00:00',
+        '2024-05-31 09:00:00']
+    assert recurrence.next_occurrence('2025-01-31 09:00', MONTHLY, after='2025-02-01') == datetime(2025, 2, 28, 9)
+
+
+def test_jumping_ahead_lands_in_the_right_month():
+    # The period is found arithmetically, not by walking from the start
+    assert recurrence.next_occurrence('2020-01-31 09:00', MONTHLY, after='2025-05-15') == datetime(2025, 5, 31, 9)
+    assert recurrence.next_occurrence('2020-01-31 09:00', {'freq': 'monthly', 'interval': 3},
+                                      after='2025-05-15') == datetime(2025, 7, 31, 9)
+
+
+# -- Daylight saving time ----------------------------------------------------
+
+def test_a_daily_reminder_keeps_its_wall_clock_time_across_dst():
+    spring = occurrences('2025-03-29 08:00', {'freq': 'daily'}, '2025-03-29', '2025-04-01')
+    assert spring == ['2025-03-29 08:00:00', '2025-03-30 08:00:00', '2025-03-31 08:00:00']
+    epochs = [timekeys.to_epoch(dt, 'Europe/Oslo') for dt in spring]
+    assert epochs[1] - epochs[0] == 23 * 3600  # clocks went forward in the night
+
+    autumn = occurrences('2025-10-25 08:00', {'freq': 'daily'}, '2025-10-25', '2025-10-27')
+    epochs = [timekeys.to_epoch(dt, 'Europe/Oslo') for dt in autumn]
+    assert epochs[1] - epochs[0] == 25 * 3600
+
+
+def test_weekly_occurrences_in_another_timezone_stay_local():
+    rule = {'freq': 'weekly', 'byweekday': [0]}
+    dates = occurrences('2025-03-03 18:00', rule, '2025-03-03', '2025-03-18')
+    assert dates == ['2025-03-03 18:00:00', '2025-03-10 18:00:00', '2025-03-17 18:00:00']
+    # New York moved to summer time on March 9
+    epochs = [timekeys.to_epoch(dt, 'America/New_York') for dt in dates]
+    assert epochs[1] - epochs[0] == 7 * 86400 - 3600
+
+
+# -- Skipped, completed and lapsed occurrences -------------------------------
+
+def test_exdates_are_skipped_and_count_still_includes_them():
+    rule = {'freq': 'daily', 'count': 3, 'exdates': ['2025-06-02 08:00']}
+    assert occurrences('2025-06-01 08:00', rule, '2025-06-01', '2025-07-01') == [
+        '2025-06-01 08:00:00', '2025-06-03 08:00:00']
+
+
+def test_pending_occurrence_skips_lapsed_and_completed_ones():
+    reminder = {'datetime': '2025-06-01 08:00', 'recurrence': {'freq': 'daily'}, 'timezone': 'Europe/Oslo'}
+    now = datetime(2025, 6, 10, 12, 0)
+
+    # Today's 08:00 has passed but is still today's to do
+    assert recurrence.pending_occurrence(reminder, now) == datetime(2025, 6, 10, 8)
+    reminder['completed_through'] = '2025-06-10 08:00:00'
+    assert recurrence.pending_occurrence(reminder, now) == datetime(2025, 6, 11, 8)
+
+
+def test_pending_occurrence_is_none_once_the_series_has_ended():
+    reminder = {'datetime': '2025-06-01 08:00', 'recurrence': {'freq': 'daily', 'until': '2025-06-05'}}
+    assert recurrence.pending_occurrence(reminder, datetime(2025, 6, 5, 23, 0)) == datetime(2025, 6, 5, 8)
+    assert recurrence.pending_occurrence(reminder, datetime(2025, 6, 6, 0, 0)) is None
+
+
+def test_skip_occurrence_adds_an_exception(app_module, login):
+    client = login('skip@example.com')
+    app_module.dm.upsert('reminders', {
+        'id': 'skip-1', 'user_id': 'skip@example.com', 'title': 'Trening', 'datetime': '2030-01-31 07:00',
+        'recurrence': {'freq': 'monthly', 'count': 2}, 'timezone': 'Europe/Oslo'})
+
+    client.get('/skip_occurrence/skip-1')
+    reminder = app_module.dm.get_record('reminders', 'skip-1')
+    assert reminder['recurrence']['exdates'] == ['2030-01-31 07:00:00']
+    assert recurrence.pending_occurrence(reminder) == datetime(2030, 2, 28, 7)
+    assert not reminder.get('completed')
+
+    # Skipping the last one ends the series
+    client.get('/skip_occurrence/skip-1')
+    assert app_module.dm.get_record('reminders', 'skip-1')['completed']
+
+
+def test_only_the_owner_can_skip_an_occurrence(app_module, login):
+    login('skip-owner@example.com')
+    other = login('skip-other@example.com')
+    app_module.dm.upsert('reminders', {
+        'id': 'skip-2', 'user_id': 'skip-owner@example.com', 'datetime': '2030-01-01 07:00',
+        'recurrence': {'freq': 'daily'}})
+
+    other.get('/skip_occurrence/skip-2')
+
+    assert 'exdates' not in app_module.dm.get_record('reminders', 'skip-2')['recurrence']
+
+
+# -- describe() ---------------------------------------------------------------
+
+def test_describe():
+    assert recurrence.describe({'freq': 'daily'}) == 'Hver dag'
+    assert recurrence.describe({'freq': 'weekly', 'interval': 2}) == 'Hver 2. uke'
+    assert recurrence.describe({'freq': 'monthly', 'until': '2025-12-31'}) == 'Hver måned til 2025-12-31'
+    assert recurrence.describe({'freq': 'daily', 'count': 5}) == 'Hver dag (5 ganger)'
+    assert recurrence.describe({'freq': 'yearly'}) == ''
+    assert recurrence.describe(None) == ''
@@ -0,0 +1,45 @@
+def create_note(app_module, owner, member, content):
+    response = owner.post('/shared-notes/create', data={'title': 'Handleliste', 'content': content})
+    note_id = response.headers['Location'].rsplit('/', 1)[-1]
+    code = app_module.dm.get_record('shared_notes', note_id)['access_code']
+    member.post('/shared-notes/join', data={'access_code': code})
+    return note_id
+
+
+def test_saving_the_form_keeps_edits_made_after_the_page_was_loaded(app_module, login):
+    owner, member = login('form-owner@example.com'), login('form-member@example.com')
+    note_id = create_note(app_module, owner, member, 'melk\nbrød')
+    text, version = app_module.collab_hub.snapshot(note_id)
+
+    # The member adds a line live while the owner has the form open
+    member.post(f'/shared-notes/live/{note_id}', json={'version': version, 'op': [len(text), '\nost']})
+    response = owner.post(f'/shared-notes/update/{note_id}',
+                          data={'content': 'melk\r\nbrød\r\negg', 'base': text, 'version': version})
+
+    assert response.status_code == 302
+    content, _ = app_module.collab_hub.snapshot(note_id)
+    assert content in ('melk\nbrød\negg\nost', 'melk\nbrød\nost\negg')
+    assert app_module.dm.get_record('shared_notes', note_id)['content'] == content
+
+
+def test_saving_against_pruned_history_is_refused(app_module, login):
+    owner, member = login('stale-owner@example.com'), login('stale-member@example.com')
+    note_id = create_note(app_module, owner, member, 'a')
+    app_module.collab_hub.submit(note_id, 0, [1, 'b'])
+    # As if the operations since version 0 were no longer kept
+    app_module.collab_hub.document(note_id).ops.clear()
+
+    response = owner.post(f'/shared-notes/update/{note_id}', data={'content': 'x', 'base': 'a', 'version': 0},
+                          follow_redirects=True)
+
+    assert 'last notatet på nytt' in response.get_data(as_text=True)
+    assert app_module.collab_hub.snapshot(note_id)[0] == 'ab'
+
+
+def test_a_form_without_a_version_does_not_overwrite(app_module, login):
+    owner, member = login('old-form-owner@example.com'), login('old-form-member@example.com')
+    note_id = create_note(app_module, owner, member, 'a')
+
+    owner.post(f'/shared-notes/update/{note_id}', data={'content': 'x'})
+
+    assert app_module.collab_hub.snapshot(note_id)[0] == 'a'
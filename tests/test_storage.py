@@ -0,0 +1,211 @@
+import json
+import os
+import threading
+
+import pytest
+
+from storage import CorruptDataError, DataManager
+
+INDEXES = {'reminders': ('user_id', 'shared_with'), 'shared_notes': ('members.email',)}
+SHARDS = {'reminders': {'key': 'user_id'}, 'shared_notes': {'key': 'user_id', 'cross_index': ('access_code',)}}
+
+
+def make_dm(tmp_path, **kwargs):
+    kwargs.setdefault('indexes', INDEXES)
+    return DataManager(data_dir=str(tmp_path / 'data'), **kwargs)
+
+
+# -- Journal (user-001) ---------------------------------------------------
+
+def test_single_record_writes_append_to_the_journal(tmp_path):
+    dm = make_dm(tmp_path)
+    dm.save_data('reminders', [{'id': 'r1', 'title': 'a'}])
+    dm.upsert('reminders', {'id': 'r2', 'title': 'b'})
+    dm.upsert('reminders', {'id': 'r1', 'title': 'a2'})
+    dm.delete('reminders', 'r2')
+
+    with open(tmp_path / 'data' / 'reminders.json') as f:
+        assert json.load(f) == [{'id': 'r1', 'title': 'a'}]
+    with open(tmp_path / 'data' / 'reminders.journal') as f:
+        assert [json.loads(line)['op'] for line in f] == ['upsert', 'upsert', 'delete']
+    # A fresh process replays the journal over the snapshot
+    assert make_dm(tmp_path).read_data('reminders') == [{'id': 'r1', 'title': 'a2'}]
+
+
+def test_compaction_folds_the_journal_into_the_snapshot(tmp_path):
+    dm = make_dm(tmp_path)
+    for n in range(3):
+        dm.upsert('reminders', {'id': f'r{n}', 'title': str(n)})
+
+    assert dm.compact('reminders')
+
+    assert not os.path.exists(tmp_path / 'data' / 'reminders.journal')
+    with open(tmp_path / 'data' / 'reminders.json') as f:
+        assert [r['id'] for r in json.load(f)] == ['r0', 'r1', 'r2']
+    assert [r['id'] for r in make_dm(tmp_path).read_data('reminders')] == ['r0', 'r1', 'r2']
+
+
+def test_a_half_written_journal_entry_is_ignored(tmp_path):
+    dm = make_dm(tmp_path)
+    dm.upsert('reminders', {'id': 'r1'})
+    with open(tmp_path / 'data' / 'reminders.journal', 'a') as f:
+        f.write('{"op":"upsert","id":"r2","rec')
+
+    assert [r['id'] for r in make_dm(tmp_path).read_data('reminders')] == ['r1']
+
+
+def test_a_corrupt_snapshot_is_not_treated_as_empty(tmp_path):
+    os.makedirs(tmp_path / 'data')
+    with open(tmp_path / 'data' / 'reminders.json', 'w') as f:
+        f.write('[{"id": "r1"')
+
+    with pytest.raises(CorruptDataError):
+        make_dm(tmp_path).read_data('reminders')
+
+
+# -- Per-process cache (user-002) ------------------------------------------
+
+def test_another_process_writes_are_picked_up_from_the_journal_tail(tmp_path):
+    web1, web2 = make_dm(tmp_path), make_dm(tmp_path)
+    web1.upsert('reminders', {'id': 'r1', 'user_id': 'a@example.com'})
+    assert len(web2.read_data('reminders')) == 1
+
+    web1.upsert('reminders', {'id': 'r2', 'user_id': 'a@example.com'})
+    assert [r['id'] for r in web2.find('reminders', 'user_id', 'a@example.com')] == ['r1', 'r2']
+    assert web2.cache_stats()['tail_reads'] == 1
+
+
+def test_load_data_and_get_record_return_private_copies(tmp_path):
+    dm = make_dm(tmp_path)
+    dm.upsert('reminders', {'id': 'r1', 'title': 'a'})
+
+    dm.get_record('reminders', 'r1')['title'] = 'changed'
+    dm.load_data('reminders')[0]['title'] = 'changed'
+
+    assert dm.read_data('reminders') == [{'id': 'r1', 'title': 'a'}]
+
+
+def test_watchers_see_changes_from_other_processes(tmp_path):
+    web1, web2 = make_dm(tmp_path), make_dm(tmp_path)
+    seen = []
+    web2.watch('reminders', lambda name, changes, reset: seen.append((name, changes, reset)))
+    web2.refresh('reminders')
+
+    web1.upsert('reminders', {'id': 'r1'})
+    web1.delete('reminders', 'r1')
+    web2.refresh('reminders')
+
+    assert seen == [('reminders', [], True), ('reminders', [('r1', None), ('r1', None)], False)]
+
+
+# -- Secondary indexes (user-003) ------------------------------------------
+
+def test_indexes_follow_updates_and_deletes(tmp_path):
+    dm = make_dm(tmp_path)
+    dm.upsert_many('reminders', [
+        {'id': 'r1', 'user_id': 'a@example.com', 'shared_with': ['b@example.com', 'c@example.com']},
+        {'id': 'r2', 'user_id': 'b@example.com', 'shared_with': []},
+    ])
+    assert [r['id'] for r in dm.find('reminders', 'shared_with', 'c@example.com')] == ['r1']
+
+    dm.update('reminders', 'r1', lambda r: r.update(user_id='b@example.com', shared_with=['b@example.com']))
+    assert dm.find('reminders', 'user_id', 'a@example.com') == []
+    assert dm.find_ids('reminders', 'user_id', 'b@example.com') == ['r2', 'r1']
+    assert dm.find('reminders', 'shared_with', 'c@example.com') == []
+
+    dm.delete('reminders', 'r2')
+    assert dm.find_ids('reminders', 'user_id', 'b@example.com') == ['r1']
+    with pytest.raises(KeyError):
+        dm.find('reminders', 'title', 'x')
+
+
+def test_nested_list_fields_are_indexed(tmp_path):
+    dm = make_dm(tmp_path)
+    dm.upsert('shared_notes', {'id': 'n1', 'members': [{'email': 'a@example.com'}, {'email': 'b@example.com'}]})
+
+    assert dm.find_one('shared_notes', 'members.email', 'b@example.com')['id'] == 'n1'
+    # Rebuilt the same way when loaded from disk
+    assert make_dm(tmp_path).find_ids('shared_notes', 'members.email', 'a@example.com') == ['n1']
+
+
+def test_update_returning_false_writes_nothing(tmp_path):
+    dm = make_dm(tmp_path)
+    dm.upsert('reminders', {'id': 'r1', 'title': 'a'})
+
+    assert dm.update('reminders', 'r1', lambda r: False) is None
+    assert dm.update('reminders', 'missing', lambda r: None) is None
+    with open(tmp_path / 'data' / 'reminders.journal') as f:
+        assert len(f.readlines()) == 1
+
+
+# -- Sharded layout (user-004) ---------------------------------------------
+
+def test_sharded_records_live_in_their_owners_directory(tmp_path):
+    dm = make_dm(tmp_path, layout='sharded', shards=SHARDS)
+    dm.upsert('reminders', {'id': 'r1', 'user_id': 'A@Example.com'})
+    dm.upsert('reminders', {'id': 'r2', 'user_id': 'b@example.com'})
+
+    assert os.path.exists(tmp_path / 'data' / 'users' / 'a@example.com' / 'reminders.journal')
+    assert [r['id'] for r in dm.find('reminders', 'user_id', 'b@example.com')] == ['r2']
+    assert dm.get_record('reminders', 'r1', shard='A@Example.com')['id'] == 'r1'
+    assert sorted(r['id'] for r in dm.read_data('reminders')) == ['r1', 'r2']
+
+    dm.delete('reminders', 'r2', shard='b@example.com')
+    assert dm.find('reminders', 'user_id', 'b@example.com') == []
+
+
+def test_cross_index_finds_records_in_other_shards(tmp_path):
+    dm = make_dm(tmp_path, layout='sharded', shards=SHARDS)
+    dm.upsert('shared_notes', {'id': 'n1', 'user_id': 'a@example.com', 'access_code': 'ABC123'})
+
+    assert dm.find_one('shared_notes', 'access_code', 'ABC123')['id'] == 'n1'
+    # No shard given: located through data/shared_notes_index
+    assert dm.get_record('shared_notes', 'n1')['user_id'] == 'a@example.com'
+    updated = dm.update('shared_notes', 'n1', lambda n: n.update(access_code='XYZ789'))
+    assert updated['access_code'] == 'XYZ789'
+    assert dm.find('shared_notes', 'access_code', 'ABC123') == []
+
+    assert dm.delete('shared_notes', 'n1')
+    assert dm.get_record('shared_notes', 'n1') is None
+
+
+def test_split_shards_moves_a_monolithic_collection(tmp_path):
+    make_dm(tmp_path).save_data('reminders', [
+        {'id': 'r1', 'user_id': 'a@example.com'}, {'id': 'r2', 'user_id': 'b@example.com'}])
+    dm = make_dm(tmp_path, layout='sharded', shards=SHARDS)
+
+    assert dm.split_shards() == {'reminders': 2}
+
+    assert os.path.exists(tmp_path / 'data' / 'reminders.json.migrated')
+    assert [r['id'] for r in dm.find('reminders', 'user_id', 'a@example.com')] == ['r1']
+    assert [r['id'] for r in dm.find('reminders', 'user_id', 'b@example.com')] == ['r2']
+
+
+# -- Several workers on one data dir (user-005) ----------------------------
+
+def test_concurrent_updates_from_two_processes_are_not_lost(tmp_path):
+    web1, web2 = make_dm(tmp_path), make_dm(tmp_path)
+    web1.upsert('reminders', {'id': 'r1', 'count': 0})
+
+    def increment(dm):
+        for _ in range(25):
+            dm.update('reminders', 'r1', lambda r: r.update(count=r['count'] + 1))
+
+    threads = [threading.Thread(target=increment, args=(dm,)) for dm in (web1, web2, web1, web2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert make_dm(tmp_path).get_record('reminders', 'r1')['count'] == 100
+
+
+def test_readers_see_a_complete_snapshot_after_compaction_elsewhere(tmp_path):
+    web1, web2 = make_dm(tmp_path), make_dm(tmp_path)
+    web1.upsert_many('reminders', [{'id': f'r{n}'} for n in range(10)])
+    assert len(web2.read_data('reminders')) == 10
+
+    web1.compact('reminders')
+    web1.upsert('reminders', {'id': 'r10'})
+
+    assert len(web2.read_data('reminders')) == 11
@@ -0,0 +1,58 @@
+import threading
+
+from usercache import UserCache
+
+
+def test_put_after_an_interleaved_invalidate_is_skipped():
+    cache = UserCache()
+    loaded = threading.Event()
+    invalidated = threading.Event()
+
+    def request_loading_the_user():
+        assert cache.get('u1') is None
+        generation = cache.generation()
+        user = {'id': 'u1', 'app_mode': 'DEFAULT'}  # read from the database
+        loaded.set()
+        invalidated.wait(5)
+        cache.put('u1', user, generation)
+
+    loader = threading.Thread(target=request_loading_the_user)
+    loader.start()
+    assert loaded.wait(5)
+    # Another request changes the mode meanwhile
+    cache.invalidate('u1')
+    invalidated.set()
+    loader.join(5)
+
+    assert cache.get('u1') is None
+    assert cache.stats()['stale'] == 1
+
+
+def test_put_without_an_invalidation_is_cached():
+    cache = UserCache()
+    generation = cache.generation()
+    cache.put('u1', 'user', generation)
+    assert cache.get('u1') == 'user'
+
+    cache.invalidate('u1')
+    assert cache.get('u1') is None
+    generation = cache.generation()
+    cache.put('u1', 'reloaded', generation)
+    assert cache.get('u1') == 'reloaded'
+
+
+def test_user_save_invalidates_after_the_row_is_written(app_module, monkeypatch):
+    seen = []
+
+    def invalidate(user_id):
+        conn = app_module.sqlite3.connect(app_module.DB_PATH)
+        try:
+            seen.append(conn.execute('SELECT email FROM users WHERE id = ?', (user_id,)).fetchone())
+        finally:
+            conn.close()
+
+    monkeypatch.setattr(app_module.user_cache, 'invalidate', invalidate)
+    with app_module.app.test_request_context():
+        app_module.User('cache-save-1', 'cache', 'cache-save@example.com', 'hash').save()
+
+    assert seen == [('cache-save@example.com',)]
@@ -0,0 +1,112 @@
+"""Rate and concurrency control for the outbox senders (outbox.py).
+
+- ``TokenBucket``: at most ``rate`` messages per second with bursts of up
+  to ``burst``, one bucket per mail provider (recipient domain), so a big
+  batch to one provider doesn't get us greylisted there.
+- ``AIMDLimiter``: how many sends may be in flight at once. Grows by about
+  one per round of successful sends (additive increase) and halves when
+  the server pushes back with a 4xx reply or a timeout (multiplicative
+  decrease), like TCP congestion control.
+- ``LatencyTracker``: recent send latencies for p50/p99 in the stats.
+"""
+import collections
+import smtplib
+import threading
+import time
+
+
+def is_throttle_error(error):
+    """True for temporary SMTP failures that mean "slow down"."""
+    if isinstance(error, (TimeoutError, smtplib.SMTPServerDisconnected)):
+        return True
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+        return bool(codes) and all(400 <= code < 500 for code in codes)
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return False
+
+
+def provider_of(recipients):
+    """Mail provider a message goes to: the domain of its first recipient."""
+    address = recipients[0] if recipients else ''
+    return address.rsplit('@', 1)[-1].lower()
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, rate))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token; returns how many seconds to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def state(self):
+        with self._lock:
+            tokens = min(self.burst, self._tokens + (time.monotonic() - self._updated) * self.rate)
+        return {'rate': self.rate, 'tokens': round(tokens, 2)}
+
+
+class AIMDLimiter:
+    def __init__(self, initial=2, minimum=1, maximum=8, decrease=0.5, cooldown=1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        # Only back off once per cooldown, not once per failed send in flight
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.throttled = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.in_flight < int(self.limit), timeout):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, throttled=False):
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                now = time.monotonic()
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def state(self):
+        with self._cond:
+            return {'limit': round(self.limit, 2), 'in_flight': self.in_flight, 'throttled': self.throttled}
+
+
+class LatencyTracker:
+    def __init__(self, size=1000):
+        self._samples = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentiles(self):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return {'p50_ms': None, 'p99_ms': None}
+        pick = lambda q: round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 1)
+        return {'p50_ms': pick(0.50), 'p99_ms': pick(0.99)}
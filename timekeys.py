@@ -0,0 +1,101 @@
+"""Canonical reminder times.
+
+Reminder times are entered and shown as local wall-clock strings
+('2024-05-01 14:30'). Next to that string every reminder stores
+``due_ts``, the same instant as integer seconds since the epoch (UTC), and
+``timezone``, the IANA zone the string is in. Ordering, range queries and
+due checks compare ``due_ts``; the string is only for display.
+
+``stamp`` keeps the two in sync and is called wherever ``datetime`` is
+written. In the SQLite reminders table a trigger clears ``due_ts`` when
+the date columns change, and ``stamp_sql_reminders`` fills it in again
+(database_upgrade.py for the backfill, load_pending_sql_reminders after
+that).
+"""
+import functools
+import os
+from datetime import datetime
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+# Zone for reminders that don't name one; the app's users are in Norway
+DEFAULT_TIMEZONE = os.environ.get('APP_TIMEZONE', 'Europe/Oslo')
+
+
+@functools.lru_cache(maxsize=64)
+def zone(name=None):
+    try:
+        return ZoneInfo(name or DEFAULT_TIMEZONE)
+    except (ZoneInfoNotFoundError, ValueError):
+        return ZoneInfo(DEFAULT_TIMEZONE)
+
+
+def parse_local(value):
+    """'2024-05-01 14:30[:00]' -> naive datetime, or None."""
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value).replace(' ', 'T'))
+    except (TypeError, ValueError):
+        return None
+
+
+def to_epoch(value, tz=None):
+    """Local time (string or naive datetime) in zone tz -> epoch seconds, or None."""
+    dt = parse_local(value)
+    if dt is None:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=zone(tz))
+    return int(dt.timestamp())
+
+
+def from_epoch(ts, tz=None):
+    """Epoch seconds -> naive local datetime in zone tz."""
+    return datetime.fromtimestamp(ts, zone(tz)).replace(tzinfo=None)
+
+
+def local_now(tz=None):
+    return datetime.now(zone(tz)).replace(tzinfo=None)
+
+
+def stamp(record, tz=None):
+    """Set record['due_ts'] and record['timezone'] from record['datetime']."""
+    record['timezone'] = record.get('timezone') or tz or DEFAULT_TIMEZONE
+    record['due_ts'] = to_epoch(record.get('datetime'), record['timezone'])
+    return record
+
+
+def is_stamped(record):
+    return isinstance(record.get('due_ts'), int) and bool(record.get('timezone'))
+
+
+def due_ts(record):
+    """The record's due_ts; parsed from the string only for unstamped records."""
+    if isinstance(record.get('due_ts'), int):
+        return record['due_ts']
+    return to_epoch(record.get('datetime'), record.get('timezone'))
+
+
+def sort_key(record):
+    """Key for sorting reminders by due time, undated ones last."""
+    ts = due_ts(record)
+    return (ts is None, ts or 0)
+
+
+def stamp_sql_reminders(conn, tz=None):
+    """Fill in due_ts/timezone for SQLite reminders rows that lack it.
+
+    Does not commit. Returns the number of rows stamped.
+    """
+    rows = conn.execute("""
+        SELECT id, COALESCE(date, due_date), timezone FROM reminders
+        WHERE due_ts IS NULL AND COALESCE(date, due_date) IS NOT NULL
+    """).fetchall()
+    updates = []
+    for reminder_id, value, row_tz in rows:
+        row_tz = row_tz or tz or DEFAULT_TIMEZONE
+        ts = to_epoch(value, row_tz)
+        if ts is not None:
+            updates.append((ts, row_tz, reminder_id))
+    conn.executemany("UPDATE reminders SET due_ts = ?, timezone = ? WHERE id = ?", updates)
+    return len(updates)
@@ -0,0 +1,102 @@
+"""Cross-request cache of loaded users (Flask-Login's user_loader).
+
+Every authenticated request used to load its user from SQLite, falling
+back to parsing ``users.json``. ``UserCache`` keeps up to ``max_size``
+users keyed by id, least recently used first out, each for at most
+``ttl`` seconds, so a busy session costs no user-table query at all.
+
+Writers call ``invalidate(user_id)`` after changing a user (``save``,
+the ``app_mode`` setter, ``/set_mode``). A loader reads ``generation()``
+before it loads and hands it to ``put``; if anything was invalidated in
+between, the loaded copy may predate the change and is not cached. That
+covers this process; the TTL bounds how long another process may serve
+the old copy. With a
+``signal`` (a DataManager collection, see storage.py) invalidations are
+also written there, one record per user. Every process watches it and
+drops the users it sees change; ``poll`` picks up other processes'
+writes for the cost of a stat() call, so nothing is queried either.
+"""
+import collections
+import threading
+import time
+
+
+class UserCache:
+    def __init__(self, max_size=1000, ttl=300, signal=None, dm=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.signal = signal
+        self.dm = dm
+        self._users = collections.OrderedDict()  # id -> (expires, user)
+        self._lock = threading.Lock()
+        # Bumped by every invalidation, see put()
+        self._generation = 0
+        self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0, 'invalidated': 0, 'stale': 0}
+        if signal:
+            dm.watch(signal, self._signalled)
+
+    def get(self, user_id):
+        """The cached user, or None (a miss)."""
+        self.poll()
+        with self._lock:
+            cached = self._users.get(user_id)
+            if cached is None:
+                self._stats['misses'] += 1
+                return None
+            expires, user = cached
+            if expires < time.monotonic():
+                del self._users[user_id]
+                self._stats['expired'] += 1
+                self._stats['misses'] += 1
+                return None
+            self._users.move_to_end(user_id)
+            self._stats['hits'] += 1
+            return user
+
+    def generation(self):
+        """Read before loading a user; pass it to put()."""
+        with self._lock:
+            return self._generation
+
+    def put(self, user_id, user, generation=None):
+        """Cache a loaded user, unless an invalidation came after ``generation``."""
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                self._stats['stale'] += 1
+                return
+            self._users[user_id] = (time.monotonic() + self.ttl, user)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_size:
+                self._users.popitem(last=False)
+                self._stats['evicted'] += 1
+
+    def invalidate(self, user_id):
+        """Forget a user here and, with a signal, in the other processes."""
+        self._drop(user_id)
+        if self.signal:
+            self.dm.upsert(self.signal, {'id': user_id, 'at': time.time()})
+
+    def poll(self):
+        """Pick up invalidations from other processes."""
+        if self.signal:
+            self.dm.refresh(self.signal)
+
+    def _drop(self, user_id):
+        with self._lock:
+            self._generation += 1
+            if self._users.pop(user_id, None) is not None:
+                self._stats['invalidated'] += 1
+
+    def _signalled(self, name, changes, reset):
+        # Runs under the DataManager's cache lock: only touch our own dict
+        if reset:
+            with self._lock:
+                self._generation += 1
+                self._users.clear()
+            return
+        for user_id, _ in changes:
+            self._drop(user_id)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, size=len(self._users))
@@ -0,0 +1,340 @@
+"""Dedicated scheduler process for SmartReminder.
+
+Background jobs used to be started at import time in app.py, so every
+gunicorn worker ran its own copy of the reminder scan. Web workers now carry
+no scheduler threads; this process runs the reminder dispatcher
+(dispatcher.py), the e-mail outbox senders (outbox.py) and the periodic
+jobs instead:
+
+    python worker.py
+
+Any number of copies may run (one per container via entrypoint.sh, or a
+``worker`` process type). They elect a leader through the ``scheduler``
+lease in SQLite (see leases.py): every process heartbeats the lease, only
+the holder's scheduler is resumed, and when the leader dies another process
+takes over once the lease has expired. Services such as the outbox
+sender are started when a process becomes leader and stopped when it
+loses the lease.
+
+Reminder dispatching is not tied to the leader: the reminders are split
+into DISPATCH_PARTITIONS partitions by hash(recipient), and the processes
+share those between them (see DispatchPartitions), so more processes
+means more dispatch throughput.
+"""
+import json
+import logging
+import math
+import os
+import signal
+import sqlite3
+import sys
+import threading
+import time
+
+from apscheduler.schedulers.background import BackgroundScheduler
+
+import changes
+import events
+from database import DB_PATH
+from database_upgrade import run_migrations
+from dispatcher import HighWaterMark, ReminderDispatcher, partition_of
+from outbox import OutboxSender
+from leases import Lease, live_holders
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_LEASE = 'scheduler'
+LEASE_TTL = int(os.environ.get('SCHEDULER_LEASE_TTL', 30))
+# Renew well before expiry so a slow heartbeat doesn't hand the lease away
+HEARTBEAT_INTERVAL = LEASE_TTL / 3
+# Reminders are split into this many partitions by hash(recipient); each is
+# dispatched by whichever worker process holds its lease
+DISPATCH_PARTITIONS = max(1, int(os.environ.get('DISPATCH_PARTITIONS', 1)))
+# How often the dispatcher looks for reminders written by the web workers
+DISPATCH_REFRESH_SECONDS = float(os.environ.get('DISPATCH_REFRESH_SECONDS', 5))
+# Catching up after downtime: batch size, pause between batches, how far back
+CATCHUP_BATCH = int(os.environ.get('CATCHUP_BATCH', 100))
+CATCHUP_PAUSE_SECONDS = float(os.environ.get('CATCHUP_PAUSE_SECONDS', 1))
+CATCHUP_MAX_HOURS = float(os.environ.get('CATCHUP_MAX_HOURS', 24))
+# Upper bound for concurrent SMTP sends; the AIMD limiter works below it
+OUTBOX_SENDERS = int(os.environ.get('OUTBOX_SENDERS', 8))
+# Messages/second per recipient domain, e.g. OUTBOX_PROVIDER_RATES="gmail.com=10,hotmail.com=2"
+OUTBOX_PROVIDER_RATE = float(os.environ.get('OUTBOX_PROVIDER_RATE', 5))
+OUTBOX_PROVIDER_RATES = {
+    domain.strip().lower(): float(rate)
+    for domain, rate in (item.split('=', 1) for item in os.environ.get('OUTBOX_PROVIDER_RATES', '').split(',') if '=' in item)
+}
+STATS_INTERVAL_SECONDS = 15
+# Sync cursors older than this get a full sync instead of a delta (changes.py)
+CHANGE_LOG_RETENTION_DAYS = float(os.environ.get('CHANGE_LOG_RETENTION_DAYS', 30))
+# Live events (events.py) are replayed to reconnecting streams for this long
+EVENT_RETENTION_SECONDS = float(os.environ.get('EVENT_RETENTION_SECONDS', 3600))
+SQL_RESYNC_SECONDS = 15 * 60
+
+
+def publish_stats(holder, stats, name=SCHEDULER_LEASE, path=DB_PATH):
+    """Store stats in SQLite so the web workers can show them in /health."""
+    conn = sqlite3.connect(path, timeout=5)
+    try:
+        with conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO worker_stats (name, holder, stats, updated_at) VALUES (?, ?, ?, ?)
+            """, (name, holder, json.dumps(stats), time.time()))
+    finally:
+        conn.close()
+
+
+class SchedulerWorker:
+    def __init__(self, lease):
+        self.lease = lease
+        self.leading = False
+        self._valid_until = 0.0
+        self.scheduler = BackgroundScheduler()
+        self.services = []
+        self.members = []
+
+    def guard(self, func):
+        """Wrap func so it only runs while this process holds the lease."""
+        def guarded(*args, **kwargs):
+            # The heartbeat may have stalled; don't run on a lease that can
+            # already belong to someone else
+            if time.time() < self._valid_until:
+                return func(*args, **kwargs)
+            raise RuntimeError(f"Not running {func.__name__}: scheduler lease not held")
+        guarded.__name__ = func.__name__
+        return guarded
+
+    def add_job(self, func, **trigger):
+        self.scheduler.add_job(func=self.guard(func), id=func.__name__, name=func.__name__, **trigger)
+
+    def add_service(self, service):
+        """Something with start()/stop() that runs only on the leader."""
+        self.services.append(service)
+
+    def add_member(self, member):
+        """Something with heartbeat()/stop() that runs in every process (DispatchPartitions)."""
+        self.members.append(member)
+
+    def heartbeat(self):
+        for member in self.members:
+            try:
+                member.heartbeat()
+            except Exception as e:
+                logger.error(f"Heartbeat of {type(member).__name__} failed: {e}")
+        started = time.time()
+        if self.lease.try_acquire():
+            self._valid_until = started + self.lease.ttl
+            if not self.leading:
+                self.leading = True
+                self.scheduler.resume()
+                for service in self.services:
+                    service.start()
+                logger.info(f"Scheduler leader: {self.lease.holder}")
+        else:
+            self._valid_until = 0.0
+            if self.leading:
+                self.leading = False
+                self.scheduler.pause()
+                for service in self.services:
+                    service.stop()
+                logger.warning(f"Lost scheduler lease, {self.lease.holder} is standing by")
+
+    def run(self, stop):
+        self.scheduler.start(paused=True)
+        try:
+            while True:
+                self.heartbeat()
+                if stop.wait(HEARTBEAT_INTERVAL):
+                    break
+        finally:
+            for member in self.members:
+                member.stop()
+            if self.leading:
+                for service in self.services:
+                    service.stop()
+            self.scheduler.shutdown(wait=True)
+            if self.leading:
+                self.lease.release()
+                logger.info("Scheduler lease released")
+            else:
+                self.lease.close()
+
+
+class DispatchPartitions:
+    """The dispatch partitions this process holds, rebalanced on every heartbeat.
+
+    Every process registers a ``member:<holder>`` lease; with N live members
+    each one aims for ceil(K / N) of the K ``dispatch:<k>/<K>`` leases. It
+    renews the ones it has, hands back any above its share (so a process
+    that joins later gets some) and takes free ones up to its share. A
+    partition's service (a ReminderDispatcher) runs only while its lease is
+    held.
+    """
+
+    def __init__(self, count, make_service, holder, ttl=LEASE_TTL, path=DB_PATH):
+        self.count = count
+        self.make_service = make_service  # (k, token) -> object with start()/stop()/stats()
+        self.holder = holder
+        self.path = path
+        self.member = Lease(f'member:{holder}', ttl=ttl, holder=holder, path=path)
+        self.leases = {k: Lease(f'dispatch:{k}/{count}', ttl=ttl, holder=holder, path=path) for k in range(count)}
+        self.running = {}  # {k: service}
+        self._valid_until = {}
+        self._last_stats = 0.0
+
+    def guard(self, k, func):
+        """Like SchedulerWorker.guard, for the lease of partition k."""
+        def guarded(*args, **kwargs):
+            if time.time() < self._valid_until.get(k, 0.0):
+                return func(*args, **kwargs)
+            raise RuntimeError(f"Not running {func.__name__}: dispatch partition {k} not held")
+        guarded.__name__ = func.__name__
+        return guarded
+
+    def _start(self, k, started):
+        self._valid_until[k] = started + self.leases[k].ttl
+        # A fresh token per tenure: claims of an earlier tenure of ours don't count
+        service = self.make_service(k, f"{self.holder}:{k}:{int(started)}")
+        self.running[k] = service
+        service.start()
+        logger.info(f"Dispatch partition {k}/{self.count} taken by {self.holder}")
+
+    def _stop(self, k, release):
+        self._valid_until.pop(k, None)
+        self.running.pop(k).stop()
+        if release:
+            self.leases[k].release()
+        logger.info(f"Dispatch partition {k}/{self.count} {'handed back' if release else 'lost'}")
+
+    def heartbeat(self):
+        started = time.time()
+        self.member.try_acquire()
+        try:
+            members = max(1, len(live_holders('member:', self.path)))
+        except sqlite3.Error as e:
+            logger.error(f"Could not count worker processes: {e}")
+            members = 1
+        share = math.ceil(self.count / members)
+
+        for k in list(self.running):
+            if self.leases[k].try_acquire():
+                self._valid_until[k] = started + self.leases[k].ttl
+            else:
+                self._stop(k, release=False)
+        for k in sorted(self.running)[share:]:
+            self._stop(k, release=True)
+        # Start looking at a different partition in every process
+        first = partition_of(self.holder, self.count)
+        for k in [(first + i) % self.count for i in range(self.count)]:
+            if len(self.running) >= share:
+                break
+            if k not in self.running and self.leases[k].try_acquire():
+                self._start(k, started)
+
+        if started - self._last_stats >= STATS_INTERVAL_SECONDS:
+            self._last_stats = started
+            for k, service in list(self.running.items()):
+                try:
+                    publish_stats(self.holder, service.stats(), name=f'dispatch:{k}/{self.count}', path=self.path)
+                except sqlite3.Error as e:
+                    logger.error(f"Could not publish dispatch stats: {e}")
+
+    def stop(self):
+        for k in list(self.running):
+            self._stop(k, release=True)
+        self.member.release()
+
+
+def build_worker():
+    from app import (app, dm, MailSession, load_pending_sql_reminders, notification_digest_window,
+                     send_reminder_notifications)
+
+    worker = SchedulerWorker(Lease(SCHEDULER_LEASE, ttl=LEASE_TTL))
+    sender = OutboxSender(DB_PATH, MailSession, threads=OUTBOX_SENDERS,
+                          provider_rate=OUTBOX_PROVIDER_RATE, provider_rates=OUTBOX_PROVIDER_RATES)
+
+    def make_dispatcher(k, token):
+        def notify(items):
+            failed = send_reminder_notifications(items, token=token)
+            # The messages were just queued in this process: no need to wait for the next poll
+            sender.wake()
+            return failed
+
+        return ReminderDispatcher(
+            dm,
+            notify=partitions.guard(k, notify),
+            advance_minutes=app.config['NOTIFICATION_ADVANCE_MINUTES'],
+            refresh_interval=DISPATCH_REFRESH_SECONDS,
+            sql_source=load_pending_sql_reminders,
+            sql_resync_interval=SQL_RESYNC_SECONDS,
+            coalesce=notification_digest_window,
+            high_water=HighWaterMark(
+                name='reminders' if DISPATCH_PARTITIONS == 1 else f'reminders:{k}/{DISPATCH_PARTITIONS}',
+                path=DB_PATH),
+            catchup_batch=CATCHUP_BATCH,
+            catchup_pause=CATCHUP_PAUSE_SECONDS,
+            catchup_max_age=CATCHUP_MAX_HOURS * 3600,
+            partition=(k, DISPATCH_PARTITIONS),
+        )
+
+    partitions = DispatchPartitions(DISPATCH_PARTITIONS, make_dispatcher, worker.lease.holder)
+    worker.add_member(partitions)
+    # One shared outbox: its batch claims are safe from any process, but the
+    # per-provider pacing is per process, so it stays on the leader
+    worker.add_service(sender)
+
+    def publish_worker_stats():
+        publish_stats(worker.lease.holder, {'outbox_sender': sender.stats()})
+    worker.add_job(publish_worker_stats, trigger='interval', seconds=STATS_INTERVAL_SECONDS)
+
+    def prune_change_log():
+        conn = sqlite3.connect(DB_PATH, timeout=5)
+        try:
+            removed = changes.prune(conn, CHANGE_LOG_RETENTION_DAYS * 86400)
+        finally:
+            conn.close()
+        if removed:
+            logger.info(f"Pruned {removed} change log rows")
+    worker.add_job(prune_change_log, trigger='interval', hours=6)
+
+    def prune_events():
+        conn = sqlite3.connect(DB_PATH, timeout=5)
+        try:
+            removed = events.prune(conn, EVENT_RETENTION_SECONDS)
+        finally:
+            conn.close()
+        if removed:
+            logger.info(f"Pruned {removed} live events")
+    worker.add_job(prune_events, trigger='interval', minutes=10)
+    return worker
+
+
+def start_in_background():
+    """Run the worker in a daemon thread (for `python app.py` during development)."""
+    stop = threading.Event()
+    thread = threading.Thread(target=build_worker().run, args=(stop,), name='scheduler-worker', daemon=True)
+    thread.start()
+    return stop
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    # The lease table comes from a migration; make sure it exists even when
+    # the worker is started before the web process
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        run_migrations(conn)
+    finally:
+        conn.close()
+
+    stop = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: stop.set())
+
+    build_worker().run(stop)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())